@@ -0,0 +1,134 @@
+import time
+import asyncio
+import logging
+from collections import deque
+
+from errors import QueueFullError, QueueTimeoutError
+
+logger = logging.getLogger(__name__)
+
+# Port -> the `Limit` of the `server.Server` listening on it
+server_limits = {}
+
+
+class Limit:
+    """A cap on how many requests can be active at once, with a queue of the requests waiting
+
+    The limit itself does not hand out slots, the caller checks `full` and
+    counts its own requests with `acquire` and `release`. Waiting requests are
+    woken one at a time, in the order they started waiting, as slots are given
+    back (see `wait`).
+
+    :param int max_active: (optional) Requests allowed at once, 0 for no cap
+    :param int queue_size: (optional) Requests allowed to wait, more than that are turned away
+    """
+    __slots__ = ('max_active', 'queue_size', 'active', 'waiters', 'waited', 'wait_time', 'full_rejected',
+                 'timeout_rejected')
+
+    def __init__(self, max_active=0, queue_size=100):
+        self.max_active = max_active
+        self.queue_size = queue_size
+        self.active = 0
+        self.waiters = deque()  # Futures of the waiting requests, oldest first
+        self.waited = 0  # Requests that had to wait
+        self.wait_time = 0.0  # Seconds spent waiting, over all of them
+        self.full_rejected = 0  # Turned away because the queue was full
+        self.timeout_rejected = 0  # Waited until their deadline without getting a slot
+
+    @property
+    def full(self):
+        return self.max_active and self.active >= self.max_active
+
+    def acquire(self):
+        self.active += 1
+
+    def release(self):
+        self.active -= 1
+        self.wake()
+
+    def wake(self):
+        """Let the longest waiting request try again"""
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+    def wake_all(self):
+        while self.waiters:
+            self.wake()
+
+    def update(self, max_active, queue_size):
+        """Change the caps, for when the config is reloaded
+
+        Returns:
+            Limit -- This limit, with its active requests and queue as they were
+        """
+        raised = not max_active or (self.max_active and max_active > self.max_active)
+        self.max_active = max_active
+        self.queue_size = queue_size
+        if raised:
+            self.wake_all()  # Let them check if there is a slot for them now
+        return self
+
+    def stats(self):
+        return {'active': self.active,
+                'max_active': self.max_active,
+                'queued': len(self.waiters),
+                'waited': self.waited,
+                'wait_time': self.wait_time,
+                'rejected': {'queue_full': self.full_rejected, 'queue_timeout': self.timeout_rejected},
+                }
+
+
+async def wait(limits, timeout, loop=None):
+    """Wait until any of the limits gives back a slot
+
+    The request joins the queue of each limit, so it is woken by whichever
+    frees up first. Being woken does not reserve the slot, the caller has to
+    check again and wait some more if another request got to it first.
+
+    Arguments:
+        limits {list} -- `Limit`s that are full
+        timeout {float} -- Max seconds to wait
+
+    Raises:
+        QueueFullError -- Every one of the queues is full
+        QueueTimeoutError -- No slot came free within `timeout`
+    """
+    open_limits = [limit for limit in limits if len(limit.waiters) < limit.queue_size]
+    if not open_limits:
+        for limit in limits:
+            limit.full_rejected += 1
+        raise QueueFullError('Queue full')
+    if timeout <= 0:
+        for limit in open_limits:
+            limit.timeout_rejected += 1
+        raise QueueTimeoutError('Queue timeout')
+
+    loop = loop or asyncio.get_event_loop()
+    waiter = loop.create_future()
+    for limit in open_limits:
+        limit.waiters.append(waiter)
+    started = time.monotonic()
+    try:
+        await asyncio.wait_for(waiter, timeout)
+    except asyncio.TimeoutError:
+        for limit in open_limits:
+            limit.timeout_rejected += 1
+        raise QueueTimeoutError('Queue timeout')
+    except asyncio.CancelledError:
+        if waiter.done() and not waiter.cancelled():
+            # Woken but not going to use the slot, pass it on to the next one waiting
+            for limit in open_limits:
+                limit.wake()
+        raise
+    finally:
+        waited = time.monotonic() - started
+        for limit in open_limits:
+            limit.waited += 1
+            limit.wait_time += waited
+            try:
+                limit.waiters.remove(waiter)
+            except ValueError:
+                pass  # Already taken off by `wake`
@@ -4,6 +4,10 @@ from aiohttp import web
 import logging
 import sqlite3
 from utils import db_conn
+from workers import global_stats
+from stats import to_prometheus
+from reloader import config_reloader
+from pools import pool_table
 logger = logging.getLogger(__name__)
 
 @asyncio.coroutine
@@ -13,9 +17,112 @@ def proxies(request):
                         content_type='application/json')
 
 
+async def connections(request):
+    return web.Response(status=200,
+                        body=json.dumps((await global_stats())['connections']),
+                        content_type='application/json')
+
+
+async def stats(request):
+    return web.Response(status=200,
+                        body=json.dumps(await global_stats()),
+                        content_type='application/json')
+
+
+async def metrics(request):
+    return web.Response(status=200,
+                        text=to_prometheus(await global_stats()),
+                        content_type='text/plain')
+
+
+async def profile(request):
+    """Stacks of slow requests in the folded format, ready for a flame graph"""
+    stacks = (await global_stats(detail=False))['profile']['stacks']
+    return web.Response(status=200,
+                        text=''.join(f'{stack} {count}\n' for stack, count in stacks.items()),
+                        content_type='text/plain')
+
+
+def _json(data, status=200):
+    return web.Response(status=status,
+                        body=json.dumps(data),
+                        content_type='application/json')
+
+
+async def _change_config(change):
+    """Apply a change to the config and respond with what is in use now"""
+    try:
+        await change
+    except ValueError as e:
+        return _json({'error': str(e)}, status=400)
+    except LookupError as e:
+        return _json({'error': str(e)}, status=404)
+    return _json(_config_summary())
+
+
+def _config_summary():
+    config = config_reloader.config
+    return {'pools': len(config['Pools']),
+            'proxies': sum(len(pool) for pool in pool_table),
+            'rules': len(config['Rules']),
+            'ports': sorted({int(rule['Port']) for rule in config['Rules']}),
+            'reloads': config_reloader.reloads,
+            }
+
+
+async def _read_json(request):
+    try:
+        return await request.json()
+    except ValueError:
+        raise web.HTTPBadRequest(text='The body must be json')
+
+
+async def config(request):
+    """The `Pools` and `Rules` in use"""
+    return _json(config_reloader.config)
+
+
+async def reload(request):
+    """Read the config file again, the same as sending SIGHUP"""
+    return await _change_config(config_reloader.reload_file())
+
+
+async def add_proxy(request):
+    proxy = await _read_json(request)
+    return await _change_config(config_reloader.add_proxy(request.match_info['pool'], proxy))
+
+
+async def remove_proxy(request):
+    host, _, port = request.match_info['proxy'].rpartition(':')
+    if not host or not port.isdigit():
+        return _json({'error': 'The proxy must be written as host:port'}, status=400)
+    return await _change_config(config_reloader.remove_proxy(request.match_info['pool'], host, int(port)))
+
+
+async def set_rule(request):
+    rule = await _read_json(request)
+    if isinstance(rule, dict):
+        rule['Name'] = request.match_info['rule']
+    return await _change_config(config_reloader.set_rule(rule))
+
+
+async def remove_rule(request):
+    return await _change_config(config_reloader.remove_rule(request.match_info['rule']))
+
+
 def start_server(host, port):
     app = web.Application()
     app.router.add_route('GET', '/proxies', proxies)
+    app.router.add_route('GET', '/connections', connections)
+    app.router.add_route('GET', '/stats', stats)
+    app.router.add_route('GET', '/metrics', metrics)
+    app.router.add_route('GET', '/profile', profile)
+    app.router.add_route('GET', '/config', config)
+    app.router.add_route('POST', '/reload', reload)
+    app.router.add_route('POST', '/pools/{pool}/proxies', add_proxy)
+    app.router.add_route('DELETE', '/pools/{pool}/proxies/{proxy}', remove_proxy)
+    app.router.add_route('PUT', '/rules/{rule}', set_rule)
+    app.router.add_route('DELETE', '/rules/{rule}', remove_rule)
 
     loop = asyncio.get_event_loop()
     f = loop.create_server(app.make_handler(), host, port)
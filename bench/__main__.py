@@ -0,0 +1,256 @@
+"""Benchmark the balancer against local stand-in proxies and an origin
+
+Run from the root of the repo:
+
+    python -m bench --clients 1000 --duration 30 --output results.json
+    python -m bench --clients 1000 --duration 30 --compare results.json
+"""
+import os
+import sys
+import json
+import time
+import yaml
+import socket
+import asyncio
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+
+from bench import standins
+from bench.loadgen import LoadGenerator
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Results where a higher number is better, anything else is better when lower
+HIGHER_IS_BETTER = {'requests_per_s', 'bytes_per_s'}
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError(f'Nothing is listening on port {port}')
+
+
+def _set_value(text):
+    """`Key=Value` from the command line, the value is parsed as yaml"""
+    key, _, val = text.partition('=')
+    return key, yaml.safe_load(val)
+
+
+def build_config(args, port, api_port, proxy_ports):
+    """The balancer's config, with every proxy in one pool and every host sent to it"""
+    server = {'Host': '127.0.0.1',
+              'API_Port': api_port,
+              'Workers': args.workers,
+              'Relay': args.relay,
+              'Log_Requests': not args.no_log,
+              }
+    server.update(dict(args.set))
+    proxies = [{'Host': '127.0.0.1', 'Port': proxy_port, 'Types': ['http', 'https']}
+               for proxy_port in proxy_ports]
+    # Proxies that are not listening, to see how the balancer copes with failures
+    proxies += [{'Host': '127.0.0.1', 'Port': _free_port(), 'Types': ['http', 'https']}
+                for _ in range(args.dead_proxies)]
+    return {'Server': server,
+            'Rules': [{'Name': 'Bench', 'Port': port, 'Domains': ['.*'], 'Pools': ['Bench']}],
+            'Pools': [{'Name': 'Bench', 'Strategy': args.strategy, 'Proxies': proxies}],
+            }
+
+
+class ProcessUsage:
+    """CPU and memory used by a process and its children, read from `/proc`"""
+    def __init__(self, pid):
+        self.pid = pid
+        self._ticks = os.sysconf('SC_CLK_TCK')
+
+    def _pids(self):
+        pids = [self.pid]
+        try:
+            with open(f'/proc/{self.pid}/task/{self.pid}/children') as f:
+                pids += [int(pid) for pid in f.read().split()]
+        except OSError:
+            pass
+        return pids
+
+    def cpu_seconds(self):
+        total = 0
+        for pid in self._pids():
+            try:
+                with open(f'/proc/{pid}/stat') as f:
+                    # The command name can have spaces, the fields after it can not
+                    fields = f.read().rsplit(')', 1)[1].split()
+            except OSError:
+                continue
+            total += int(fields[11]) + int(fields[12])  # utime + stime
+        return total / self._ticks
+
+    def memory_mb(self):
+        """(Current RSS, Peak RSS) summed over the processes"""
+        rss = peak = 0
+        for pid in self._pids():
+            try:
+                with open(f'/proc/{pid}/status') as f:
+                    status = dict(line.split(':', 1) for line in f if ':' in line)
+            except OSError:
+                continue
+            rss += int(status.get('VmRSS', '0 kB').split()[0])
+            peak += int(status.get('VmHWM', '0 kB').split()[0])
+        return round(rss / 1024, 1), round(peak / 1024, 1)
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_bench(args):
+    # Thousands of clients need thousands of file descriptors
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    origin_port = _free_port()
+    proxy_ports = [_free_port() for _ in range(args.proxies)]
+    port = _free_port()
+    api_port = _free_port()
+
+    standins_process = multiprocessing.Process(
+        target=standins.run, args=(origin_port, proxy_ports, args.proxy_latency / 1000, args.fail_rate),
+        daemon=True)
+    standins_process.start()
+
+    workdir = tempfile.mkdtemp(prefix='plb-bench-')
+    os.makedirs(os.path.join(workdir, 'logs'))
+    config_file = os.path.join(workdir, 'config.yaml')
+    with open(config_file, 'w') as f:
+        yaml.safe_dump(build_config(args, port, api_port, proxy_ports), f)
+
+    command = args.balancer_cmd.format(python=sys.executable, run=os.path.join(args.repo, 'run.py'),
+                                       config=config_file).split()
+    with open(os.path.join(workdir, 'balancer.log'), 'w') as log:
+        balancer = subprocess.Popen(command, cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+    try:
+        _wait_for_port(origin_port)
+        _wait_for_port(port)
+        usage = ProcessUsage(balancer.pid)
+
+        loop = asyncio.new_event_loop()
+        if args.warmup:
+            loop.run_until_complete(LoadGenerator(port, origin_port, clients=min(args.clients, 50),
+                                                  duration=args.warmup, mode=args.mode,
+                                                  body_size=args.body_size).run())
+
+        cpu_before = usage.cpu_seconds()
+        generator = LoadGenerator(port, origin_port, clients=args.clients, requests=args.requests,
+                                  duration=args.duration, mode=args.mode, body_size=args.body_size,
+                                  keep_alive=not args.no_keep_alive)
+        result = loop.run_until_complete(generator.run()).to_dict()
+        cpu = usage.cpu_seconds() - cpu_before
+        result['cpu_seconds'] = round(cpu, 3)
+        result['cpu_percent'] = round(cpu / result['duration'] * 100, 1)
+        result['rss_mb'], result['peak_rss_mb'] = usage.memory_mb()
+        loop.close()
+    finally:
+        balancer.terminate()
+        balancer.wait(timeout=30)
+        standins_process.terminate()
+
+    return {'commit': _git_commit(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'cpus': os.cpu_count(),
+            'params': {key: val for key, val in vars(args).items() if key not in ('output', 'compare')},
+            'results': result,
+            'workdir': workdir,
+            }
+
+
+def compare(old, new, tolerance):
+    """Print how each result changed and return the ones that got worse by more than `tolerance`"""
+    rows = [('requests_per_s', old['requests_per_s'], new['requests_per_s']),
+            ('bytes_per_s', old['bytes_per_s'], new['bytes_per_s']),
+            ('cpu_percent', old['cpu_percent'], new['cpu_percent']),
+            ('peak_rss_mb', old['peak_rss_mb'], new['peak_rss_mb']),
+            ('error_rate', old['error_rate'], new['error_rate'])]
+    rows += [(f'latency_{name}_ms', old['latency_ms'][name], new['latency_ms'][name])
+             for name in ('p50', 'p90', 'p99')]
+
+    regressions = []
+    print(f'{"":20} {"before":>12} {"after":>12} {"change":>8}')
+    for name, before, after in rows:
+        if before is None or after is None:
+            continue
+        if before:
+            change = (after - before) / before
+        else:
+            change = float('inf') if after > before else 0.0
+        worse = -change if name in HIGHER_IS_BETTER else change
+        flag = ''
+        if worse > tolerance:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f'{name:20} {before:>12} {after:>12} {change:>+8.1%}{flag}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Proxy Load Balancer')
+    parser.add_argument('--clients', type=int, default=200, help='Concurrent clients (default: 200)')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds to send requests for (default: 10)')
+    parser.add_argument('--requests', type=int, help='Send this many requests instead of running for --duration')
+    parser.add_argument('--warmup', type=float, default=2, help='Seconds of load before measuring (default: 2)')
+    parser.add_argument('--mode', choices=('http', 'connect', 'mixed'), default='http',
+                        help='Plain HTTP requests, a CONNECT tunnel per request or both (default: http)')
+    parser.add_argument('--no-keep-alive', action='store_true', help='New client connection for each request')
+    parser.add_argument('--body-size', type=int, default=1024, help='Bytes in each response (default: 1024)')
+    parser.add_argument('--proxies', type=int, default=4, help='Stand-in proxies (default: 4)')
+    parser.add_argument('--dead-proxies', type=int, default=0, help='Proxies in the pool that refuse connections')
+    parser.add_argument('--proxy-latency', type=float, default=0, help='Milliseconds each proxy waits per request')
+    parser.add_argument('--fail-rate', type=float, default=0, help='Share of requests the proxies drop (0 - 1)')
+    parser.add_argument('--strategy', default='round_robin', help='Strategy of the pool (default: round_robin)')
+    parser.add_argument('--workers', type=int, default=1, help='`Workers` of the balancer (default: 1)')
+    parser.add_argument('--relay', default='stream', help='`Relay` of the balancer (default: stream)')
+    parser.add_argument('--no-log', action='store_true', help='Turn off the request log')
+    parser.add_argument('--set', type=_set_value, action='append', default=[], metavar='KEY=VALUE',
+                        help='Any other `Server` config value, can be used more than once')
+    parser.add_argument('--repo', default=REPO, help='Checkout of the balancer to benchmark (default: this one)')
+    parser.add_argument('--balancer-cmd', default='{python} {run} -c {config}',
+                        help='Command that starts the balancer (default: "{python} {run} -c {config}")')
+    parser.add_argument('--output', help='Save the results to this json file')
+    parser.add_argument('--compare', help='Results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='Share a result can get worse by before it counts as a regression (default: 0.1)')
+    args = parser.parse_args()
+
+    report = run_bench(args)
+    print(json.dumps(report['results'], indent=2))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        if compare(old['results'], report['results'], args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
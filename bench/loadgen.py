@@ -0,0 +1,149 @@
+"""Drives many concurrent clients through the balancer and times each request"""
+import time
+import random
+import asyncio
+
+
+class LoadResult:
+    """What happened to every request sent"""
+    def __init__(self):
+        self.latencies = []  # Seconds, of the requests that worked
+        self.errors = {}  # Error class -> count
+        self.bytes = 0  # Response bytes received
+        self.started = None
+        self.finished = None
+
+    def error(self, e):
+        name = type(e).__name__
+        self.errors[name] = self.errors.get(name, 0) + 1
+
+    def to_dict(self):
+        duration = self.finished - self.started
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            if not latencies:
+                return None
+            return round(latencies[min(int(len(latencies) * p / 100), len(latencies) - 1)] * 1000, 3)
+
+        requests = len(latencies)
+        return {'requests': requests,
+                'errors': dict(self.errors),
+                'error_rate': round(sum(self.errors.values()) / (requests + sum(self.errors.values()) or 1), 5),
+                'duration': round(duration, 3),
+                'requests_per_s': round(requests / duration, 1),
+                'bytes_per_s': round(self.bytes / duration),
+                'latency_ms': {'mean': round(sum(latencies) / requests * 1000, 3) if requests else None,
+                               'p50': percentile(50),
+                               'p90': percentile(90),
+                               'p99': percentile(99),
+                               'max': percentile(100),
+                               },
+                }
+
+
+async def _read_response(reader):
+    """Read one response
+
+    Returns:
+        tuple -- (Bytes in the response, If the server will close the connection)
+    """
+    head = await reader.readuntil(b'\r\n\r\n')
+    length = 0
+    close = False
+    for line in head.split(b'\r\n')[1:]:
+        name, _, val = line.partition(b':')
+        name = name.strip().lower()
+        if name == b'content-length':
+            length = int(val)
+        elif name == b'connection':
+            close = val.strip().lower() == b'close'
+    if length:
+        await reader.readexactly(length)
+    return len(head) + length, close
+
+
+class LoadGenerator:
+    """Sends requests from `clients` concurrent clients until `requests` are sent or `duration` is up
+
+    :param int port: Port of the balancer
+    :param int origin_port: Port of the stand-in origin the requests are for
+    :param str mode:
+        (optional) `http` sends plain requests, `connect` opens a CONNECT tunnel for each
+        request, `mixed` picks one of the two for each request
+    :param int body_size: (optional) Bytes in each response body
+    :param bool keep_alive: (optional) Send more than one plain request on a client connection
+    """
+    def __init__(self, port, origin_port, clients=100, requests=None, duration=10, mode='http',
+                 body_size=1024, keep_alive=True, timeout=30):
+        self.port = port
+        self.origin = f'127.0.0.1:{origin_port}'
+        self.clients = clients
+        self.requests = requests
+        self.duration = duration
+        self.mode = mode
+        self.keep_alive = keep_alive
+        self.timeout = timeout
+        self._path = f'/bytes/{body_size}'
+        self._sent = 0
+        self._deadline = None
+        self.result = LoadResult()
+
+    def _more(self):
+        if self.requests is not None:
+            self._sent += 1
+            return self._sent <= self.requests
+        return time.monotonic() < self._deadline
+
+    async def run(self):
+        self.result.started = time.monotonic()
+        self._deadline = self.result.started + self.duration
+        await asyncio.gather(*[self._client() for _ in range(self.clients)])
+        self.result.finished = time.monotonic()
+        return self.result
+
+    async def _client(self):
+        conn = None
+        while self._more():
+            use_connect = self.mode == 'connect' or (self.mode == 'mixed' and random.random() < 0.5)
+            started = time.monotonic()
+            try:
+                if use_connect:
+                    size = await asyncio.wait_for(self._tunnel_request(), self.timeout)
+                else:
+                    if conn is None:
+                        conn = await asyncio.open_connection('127.0.0.1', self.port)
+                    size, close = await asyncio.wait_for(self._plain_request(*conn), self.timeout)
+                    if close or not self.keep_alive:
+                        conn[1].close()
+                        conn = None
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError) as e:
+                self.result.error(e)
+                if conn is not None:
+                    conn[1].close()
+                    conn = None
+                continue
+
+            self.result.latencies.append(time.monotonic() - started)
+            self.result.bytes += size
+
+        if conn is not None:
+            conn[1].close()
+
+    async def _plain_request(self, reader, writer):
+        connection = b'keep-alive' if self.keep_alive else b'close'
+        writer.write(b'GET http://%s%s HTTP/1.1\r\nHost: %s\r\nConnection: %s\r\n\r\n'
+                     % (self.origin.encode(), self._path.encode(), self.origin.encode(), connection))
+        return await _read_response(reader)
+
+    async def _tunnel_request(self):
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.port)
+        try:
+            writer.write(b'CONNECT %s HTTP/1.1\r\nHost: %s\r\n\r\n' % (self.origin.encode(), self.origin.encode()))
+            await reader.readuntil(b'\r\n\r\n')
+            writer.write(b'GET %s HTTP/1.1\r\nHost: %s\r\nConnection: close\r\n\r\n'
+                         % (self._path.encode(), self.origin.encode()))
+            size, _ = await _read_response(reader)
+            return size
+        finally:
+            writer.close()
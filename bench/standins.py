@@ -0,0 +1,159 @@
+"""Local stand-ins for the origin servers and upstream proxies, so benchmarks do not need the internet"""
+import random
+import asyncio
+import logging
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+_bodies = {}
+
+
+def _body(size):
+    body = _bodies.get(size)
+    if body is None:
+        body = _bodies[size] = b'x' * size
+    return body
+
+
+async def _read_head(reader):
+    """The head of the next request, None once the client is done"""
+    try:
+        return await reader.readuntil(b'\r\n\r\n')
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        return None
+
+
+def _content_length(head):
+    for line in head.split(b'\r\n')[1:]:
+        name, _, val = line.partition(b':')
+        if name.strip().lower() == b'content-length':
+            return int(val)
+    return 0
+
+
+async def origin(reader, writer):
+    """HTTP origin, `GET /bytes/<n>` responds with n bytes. Keeps connections alive"""
+    try:
+        while True:
+            head = await _read_head(reader)
+            if head is None:
+                break
+            length = _content_length(head)
+            if length:
+                await reader.readexactly(length)
+
+            path = head.split(b' ', 2)[1]
+            try:
+                size = int(path.rsplit(b'/', 1)[1])
+            except ValueError:
+                size = 2
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\nContent-Type: text/plain\r\n\r\n' % size)
+            writer.write(_body(size))
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def _pipe(reader, writer):
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def _relay_response(reader, writer):
+    """Relay one Content-Length framed response"""
+    head = await reader.readuntil(b'\r\n\r\n')
+    writer.write(head)
+    left = _content_length(head)
+    while left > 0:
+        data = await reader.read(min(left, 65536))
+        if not data:
+            raise ConnectionError('Origin closed the connection')
+        left -= len(data)
+        writer.write(data)
+    await writer.drain()
+
+
+class StandInProxy:
+    """Forwarding HTTP proxy that also supports CONNECT
+
+    :param float latency: (optional) Seconds to wait before answering each request
+    :param float fail_rate: (optional) Share of requests where the connection is dropped without an answer
+    """
+    def __init__(self, latency=0, fail_rate=0):
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.requests = 0
+        self.failed = 0
+
+    async def handle(self, reader, writer):
+        upstream = {}  # (host, port) -> (reader, writer) kept open for the next request
+        try:
+            while True:
+                head = await _read_head(reader)
+                if head is None:
+                    break
+                self.requests += 1
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                if self.fail_rate and random.random() < self.fail_rate:
+                    self.failed += 1
+                    break
+
+                method, target, _ = head.split(b'\r\n', 1)[0].decode('latin-1').split(' ')
+                if method == 'CONNECT':
+                    host, port = target.rsplit(':', 1)
+                    up_reader, up_writer = await asyncio.open_connection(host, int(port))
+                    writer.write(b'HTTP/1.1 200 Connection established\r\n\r\n')
+                    await asyncio.gather(_pipe(reader, up_writer), _pipe(up_reader, writer))
+                    return
+
+                url = urlsplit(target)
+                key = (url.hostname, url.port or 80)
+                if key not in upstream:
+                    upstream[key] = await asyncio.open_connection(*key)
+                up_reader, up_writer = upstream[key]
+
+                length = _content_length(head)
+                up_writer.write(head)
+                if length:
+                    up_writer.write(await reader.readexactly(length))
+                await _relay_response(up_reader, writer)
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError) as e:
+            logger.debug(f'Stand-in proxy dropped a connection; Error: {e!r}')
+        finally:
+            for _, up_writer in upstream.values():
+                up_writer.close()
+            writer.close()
+
+
+async def start(origin_port, proxy_ports, latency=0, fail_rate=0):
+    """Start the origin and a stand-in proxy on each port
+
+    Returns:
+        list -- The started `asyncio` servers
+    """
+    servers = [await asyncio.start_server(origin, '127.0.0.1', origin_port, backlog=4096)]
+    for port in proxy_ports:
+        proxy = StandInProxy(latency=latency, fail_rate=fail_rate)
+        servers.append(await asyncio.start_server(proxy.handle, '127.0.0.1', port, backlog=4096))
+    return servers
+
+
+def run(origin_port, proxy_ports, latency=0, fail_rate=0):
+    """Run the stand-ins until the process is killed, meant to be the target of a `multiprocessing.Process`"""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(start(origin_port, proxy_ports, latency, fail_rate))
+    loop.run_forever()
@@ -4,6 +4,8 @@ import logging
 import argparse
 from pythonjsonlogger import jsonlogger
 
+from logsink import BatchingFileHandler, CompactFormatter
+
 
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -14,16 +16,35 @@ parser.add_argument('-c', '--config', help='yaml config file', required=True)
 # TODO: Make overrides for server config values
 args = parser.parse_args()
 
-# TODO: Add lots of validation to the config inputs
-with open(args.config, 'r') as stream:
-    CONFIG = yaml.load(stream)
+CONFIG_FILE = args.config
+
+
+def read_config(path):
+    """Read a yaml config file"""
+    # TODO: Add lots of validation to the config inputs
+    with open(path, 'r') as stream:
+        return yaml.load(stream)
+
+
+CONFIG = read_config(CONFIG_FILE)
 
 
-formatter = jsonlogger.JsonFormatter()
+_server_config = CONFIG.get('Server') or {}
+if _server_config.get('Log_Format', 'json') == 'compact':
+    formatter = CompactFormatter()
+else:
+    formatter = jsonlogger.JsonFormatter()
 
-handler = logging.FileHandler('logs/proxy_request.json')
+# Requests are queued and written to the file in batches from a background thread
+handler = BatchingFileHandler('logs/proxy_request.json',
+                              flush_interval=_server_config.get('Log_Flush_Interval', 1),
+                              batch_size=_server_config.get('Log_Batch_Size', 500),
+                              queue_size=_server_config.get('Log_Queue_Size', 10000),
+                              max_bytes=_server_config.get('Log_Max_Bytes', 0),
+                              backup_count=_server_config.get('Log_Backup_Count', 5))
 handler.setFormatter(formatter)
 
 request_logger = logging.getLogger('proxy_request')
 request_logger.setLevel(logging.INFO)
 request_logger.addHandler(handler)
+request_logger.propagate = False  # Do not also write every request to the console
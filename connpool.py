@@ -0,0 +1,148 @@
+import time
+import logging
+import threading
+from collections import deque
+
+from config import CONFIG
+
+logger = logging.getLogger(__name__)
+
+
+class ConnectionPool:
+    """Idle keep-alive connections to a single upstream proxy
+
+    :param int max_idle: Seconds a connection can sit unused before it is closed
+    :param int max_lifetime: Seconds a connection can be used for in total
+    :param int max_size: Max number of idle connections to keep
+    """
+    def __init__(self, max_idle=30, max_lifetime=300, max_size=10):
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.max_size = max_size
+        # (reader, writer, time created, time released), newest on the right
+        self._idle = deque()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._idle)
+
+    def _is_usable(self, reader, writer, created, released, now):
+        if now - released > self.max_idle or now - created > self.max_lifetime:
+            return False
+        # The proxy closed the connection or sent something it should not have
+        if writer.is_closing() or reader.at_eof() or reader.exception() is not None:
+            return False
+        return True
+
+    def acquire(self):
+        """Get a healthy idle connection
+
+        Returns:
+            tuple -- (reader, writer, time created), None if there is no usable connection
+        """
+        now = time.time()
+        while self._idle:
+            # Use the most recently released connection, it is the least likely to be stale
+            reader, writer, created, released = self._idle.pop()
+            if self._is_usable(reader, writer, created, released, now):
+                self.hits += 1
+                return reader, writer, created
+            writer.close()
+
+        self.misses += 1
+        return None
+
+    def release(self, reader, writer, created):
+        """Keep a connection around so it can be used again
+
+        The connection is closed instead if it is too old or the pool is full.
+        """
+        now = time.time()
+        # Close the connections that have been idle for too long
+        while self._idle and now - self._idle[0][3] > self.max_idle:
+            self._idle.popleft()[1].close()
+
+        if len(self._idle) >= self.max_size or not self._is_usable(reader, writer, created, now, now):
+            writer.close()
+            return
+        self._idle.append((reader, writer, created, now))
+
+    def close(self):
+        while self._idle:
+            self._idle.pop()[1].close()
+
+    def to_dict(self):
+        return {'idle': len(self._idle), 'hits': self.hits, 'misses': self.misses}
+
+
+class ConnectionPools:
+    """A `ConnectionPool` for each upstream proxy
+
+    Pools are made by `pools.PoolTable.build`, which can run in another
+    thread, so adding one and reading the list of them is done under a lock.
+
+    :param int max_size:
+        Max idle connections to keep per proxy, 0 turns off keep-alive
+    """
+    def __init__(self, max_idle=30, max_lifetime=300, max_size=10):
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.max_size = max_size
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def get(self, host, port, username=None):
+        """Get the pool for a proxy, None if keep-alive is turned off"""
+        if not self.enabled:
+            return None
+        key = (host, port, username)
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = self._pools[key] = ConnectionPool(self.max_idle, self.max_lifetime, self.max_size)
+        return pool
+
+    def _items(self):
+        with self._lock:
+            return list(self._pools.items())
+
+    def close(self):
+        for _, pool in self._items():
+            pool.close()
+
+    def stats(self, detail=True):
+        """Reuse stats for every proxy and the totals
+
+        Keyword Arguments:
+            detail {bool} -- Include the breakdown by proxy (default: {True})
+
+        Returns:
+            dict -- The totals and a breakdown by proxy, empty without `detail`
+        """
+        proxies = {}
+        hits = misses = idle = 0
+        for (host, port, username), pool in self._items():
+            if detail:
+                name = f'{username}@{host}:{port}' if username else f'{host}:{port}'
+                proxies[name] = pool.to_dict()
+            hits += pool.hits
+            misses += pool.misses
+            idle += len(pool)
+
+        return {'hits': hits,
+                'misses': misses,
+                'hit_rate': hits / (hits + misses) if hits + misses else None,
+                'idle': idle,
+                'proxies': proxies,
+                }
+
+
+_server_config = CONFIG.get('Server', {})
+connection_pools = ConnectionPools(max_idle=_server_config.get('Upstream_Max_Idle', 30),
+                                   max_lifetime=_server_config.get('Upstream_Max_Lifetime', 300),
+                                   max_size=_server_config.get('Upstream_Max_Per_Proxy', 10))
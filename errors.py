@@ -44,3 +44,15 @@ class BadStatusLine(Exception):
 
 class ErrorOnStream(Exception):
     errmsg = 'error_on_stream'
+
+
+class AdmissionError(Exception):
+    errmsg = 'no_capacity'
+
+
+class QueueFullError(AdmissionError):
+    errmsg = 'queue_full'
+
+
+class QueueTimeoutError(AdmissionError):
+    errmsg = 'queue_timeout'
@@ -0,0 +1,113 @@
+import asyncio
+import logging
+from urllib.parse import urlsplit
+
+from utils import parse_status_line
+from resolver import dns_cache
+
+logger = logging.getLogger(__name__)
+
+
+class HealthChecker:
+    """Check every proxy in the background and eject the ones that are down
+
+    Each proxy is probed once per round, no matter how many pools it is in.
+    Without a `url` the probe is just a TCP connect to the proxy, with one
+    a request for the url is sent through the proxy and any status below 500
+    counts as healthy. A failed probe ejects the proxy straight away, a
+    working probe lets an ejected proxy back in before its cooldown is over.
+
+    :param pool_table: The :class:`pools.PoolTable` to check
+    :param int interval: Seconds between each round of checks
+    :param int timeout: (optional) Seconds before a probe counts as failed
+    :param str url: (optional) `http://` url to request through each proxy
+    :param int concurrency: (optional) Max probes running at once
+    """
+    def __init__(self, pool_table, interval=30, timeout=5, url=None, concurrency=100, loop=None):
+        self._pool_table = pool_table
+        self.interval = interval
+        self.timeout = timeout
+        self.url = url
+        self._concurrency = concurrency
+        self._loop = loop or asyncio.get_event_loop()
+        self._task = None
+        self.rounds = 0
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run(), loop=self._loop)
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.check_all()
+            except Exception:
+                logger.exception("Failed to check the proxies")
+            await asyncio.sleep(self.interval)
+
+    async def check_all(self):
+        # The same proxy can be in more than one pool
+        proxies = {}
+        for pool in self._pool_table:
+            for member in pool.members:
+                key = (member.host, member.port, member.auth_header, member.ssl_context if member.tls else None)
+                proxies.setdefault(key, []).append(member)
+
+        semaphore = asyncio.Semaphore(self._concurrency)
+
+        async def _check(key, members):
+            async with semaphore:
+                healthy = await self.probe(*key)
+            for member in members:
+                if healthy:
+                    member.connect_succeeded()
+                else:
+                    member.check_failed()
+
+        await asyncio.gather(*[_check(key, members) for key, members in proxies.items()])
+        self.rounds += 1
+
+    async def probe(self, host, port, auth_header=None, ssl_context=None):
+        """Check a single proxy
+
+        Arguments:
+            host {str} -- Host of the proxy
+            port {int} -- Port of the proxy
+
+        Keyword Arguments:
+            auth_header {bytes} -- `Proxy-Authorization` header line to send with the request (default: {None})
+            ssl_context {ssl.SSLContext} -- Connect over TLS with this context (default: {None})
+
+        Returns:
+            bool -- True if the proxy is healthy
+        """
+        writer = None
+        try:
+            params = {'host': await dns_cache.resolve(host), 'port': port}
+            if ssl_context is not None:
+                params.update(ssl=ssl_context, server_hostname=host)
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(**params), self.timeout)
+            if self.url is None:
+                return True
+
+            request = f'GET {self.url} HTTP/1.1\r\nHost: {urlsplit(self.url).netloc}\r\n'.encode()
+            if auth_header is not None:
+                request += auth_header
+            request += b'Connection: close\r\n\r\n'
+            writer.write(request)
+
+            line = await asyncio.wait_for(reader.readline(), self.timeout)
+            status = parse_status_line(line.decode().strip()).get('Status')
+            return status is not None and status < 500
+
+        except Exception as e:
+            logger.debug(f"Health check failed for {host}:{port}; Error: {e!r}")
+            return False
+
+        finally:
+            if writer is not None:
+                writer.close()
@@ -0,0 +1,156 @@
+import os
+import json
+import time
+import queue
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Attributes every LogRecord has, anything else was passed in with `extra`
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+_STOP = object()
+
+
+class CompactFormatter(logging.Formatter):
+    """Only the fields passed in with `extra`, as json without any whitespace"""
+    def format(self, record):
+        data = {key: val for key, val in vars(record).items() if key not in _RECORD_ATTRS}
+        return json.dumps(data, separators=(',', ':'), default=str)
+
+
+class BatchingFileHandler(logging.Handler):
+    """Write log records to a file from a background thread
+
+    `emit` only puts the record on a queue, so logging a request does not
+    format or write anything on the event loop. The thread writes the queued
+    records in batches, either once `batch_size` records are waiting or every
+    `flush_interval` seconds. When the queue is full new records are dropped
+    and counted instead of blocking.
+
+    :param str filename: File to append the records to
+    :param float flush_interval: (optional) Max seconds a record waits before being written
+    :param int batch_size: (optional) Max records written at a time
+    :param int queue_size: (optional) Max records waiting to be written
+    :param int max_bytes: (optional) Rotate the file when it gets this big, 0 to never rotate
+    :param int backup_count: (optional) Number of rotated files to keep
+    """
+    def __init__(self, filename, flush_interval=1, batch_size=500, queue_size=10000,
+                 max_bytes=0, backup_count=5):
+        super().__init__()
+        self.filename = os.path.abspath(filename)
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._file = None
+        self._thread = None
+        self.queued = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self._start()
+
+        if hasattr(os, 'register_at_fork'):
+            # Threads do not survive a fork, the workers need their own
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _start(self):
+        self._file = open(self.filename, 'a', encoding='utf-8')
+        self._thread = threading.Thread(target=self._run, name='request-log', daemon=True)
+        self._thread.start()
+
+    def _after_fork(self):
+        self.createLock()
+        self._queue = queue.Queue(maxsize=self._queue.maxsize)
+        self.queued = self.written = self.dropped = self.failed = 0
+        self._start()
+
+    def emit(self, record):
+        try:
+            self._queue.put_nowait(record)
+            self.queued += 1
+        except queue.Full:
+            self.dropped += 1
+
+    def stats(self):
+        return {'queued': self.queued,
+                'written': self.written,
+                'dropped': self.dropped,
+                'failed': self.failed,
+                'waiting': self._queue.qsize(),
+                }
+
+    def close(self):
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join(timeout=self.flush_interval + 5)
+        super().close()
+
+    def _run(self):
+        stop = False
+        while not stop:
+            batch = []
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    record = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if record is _STOP:
+                    stop = True
+                    break
+                batch.append(record)
+
+            if batch:
+                self._write(batch)
+
+        self._file.close()
+
+    def _write(self, batch):
+        lines = []
+        for record in batch:
+            try:
+                lines.append(self.format(record))
+            except Exception:
+                self.failed += 1
+
+        try:
+            self._rotate()
+            self._file.write('\n'.join(lines) + '\n')
+            self._file.flush()
+            self.written += len(lines)
+        except OSError:
+            self.failed += len(lines)
+            logger.exception("Failed to write the request log")
+
+    def _rotate(self):
+        """Rotate the file when it is too big, or reopen it if another process already did"""
+        try:
+            stat = os.stat(self.filename)
+        except FileNotFoundError:
+            self._reopen()
+            return
+
+        if stat.st_ino != os.fstat(self._file.fileno()).st_ino:
+            self._reopen()
+        elif self.max_bytes and stat.st_size >= self.max_bytes:
+            for i in range(self.backup_count - 1, 0, -1):
+                src = f'{self.filename}.{i}'
+                if os.path.exists(src):
+                    os.replace(src, f'{self.filename}.{i + 1}')
+            if self.backup_count:
+                os.replace(self.filename, f'{self.filename}.1')
+            else:
+                os.remove(self.filename)
+            self._reopen()
+
+    def _reopen(self):
+        self._file.close()
+        self._file = open(self.filename, 'a', encoding='utf-8')
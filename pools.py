@@ -0,0 +1,694 @@
+import math
+import time
+import base64
+import random
+import hashlib
+import asyncio
+import logging
+import itertools
+from bisect import bisect
+from functools import reduce
+
+from connpool import connection_pools
+from tls import tls_sessions
+from admission import Limit
+from ratelimit import TokenBucket
+from proxylist import read_proxy_file
+
+logger = logging.getLogger(__name__)
+
+PROXY_TYPES = frozenset(('HTTP', 'HTTPS', 'CONNECT:80', 'CONNECT:25', 'SOCKS4', 'SOCKS5'))
+
+EWMA_ALPHA = 0.3  # How much weight the newest request has in the running scores
+ERROR_PENALTY = 5  # Seconds added to a proxy's latency for an error rate of 100%
+RATE_TRIES = 3  # Extra proxies looked at for one with a rate limit token free
+HASH_KEYS = ('client_ip', 'host', 'session')  # What a `consistent_hash` pool can keep sticky
+
+
+class ProxyScore:
+    """Running scores of how well a proxy has been doing
+
+    Each value is an exponentially weighted moving average, so recent
+    requests count the most and nothing needs to be stored per request.
+    Values are None until the proxy has been used.
+    """
+    __slots__ = ('connect_time', 'ttfb', 'throughput', 'error_rate', 'requests')
+
+    def __init__(self):
+        self.connect_time = None  # Seconds
+        self.ttfb = None  # Seconds from sending the request to the first byte back
+        self.throughput = None  # Bytes per second downloaded
+        self.error_rate = 0.0
+        self.requests = 0
+
+    @staticmethod
+    def _ewma(current, sample):
+        if sample is None:
+            return current
+        if current is None:
+            return sample
+        return current + EWMA_ALPHA * (sample - current)
+
+    def update(self, connect_time=None, ttfb=None, throughput=None, error=False):
+        """Add the results of a request to the scores
+
+        Keyword Arguments:
+            connect_time {float} -- Seconds to connect to the proxy (default: {None})
+            ttfb {float} -- Seconds until the first byte came back (default: {None})
+            throughput {float} -- Bytes per second downloaded (default: {None})
+            error {bool} -- If the proxy failed the request (default: {False})
+        """
+        self.requests += 1
+        self.connect_time = self._ewma(self.connect_time, connect_time)
+        self.ttfb = self._ewma(self.ttfb, ttfb)
+        self.throughput = self._ewma(self.throughput, throughput)
+        self.error_rate = self._ewma(self.error_rate, 1.0 if error else 0.0)
+
+    def cost(self, active=0):
+        """Expected seconds a new request will take, lower is better
+
+        Proxies that have not been used yet cost 0 so they get tried.
+        """
+        latency = (self.connect_time or 0) + (self.ttfb or 0)
+        return (latency + self.error_rate * ERROR_PENALTY) * (active + 1)
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class CircuitBreaker:
+    """Takes a proxy out of its pool after it fails to connect too many times in a row
+
+    Once open the proxy is left out for `cooldown` seconds, then it is let
+    back in on trial (half open). If the next connection works the breaker
+    closes, if it fails the breaker opens again and the cooldown doubles.
+
+    :param int threshold: Failed connections in a row before opening
+    :param int cooldown: Seconds to stay open before letting the proxy back in on trial
+    :param int max_cooldown: Longest the cooldown can get
+    """
+    __slots__ = ('threshold', 'base_cooldown', 'cooldown', 'max_cooldown', 'state', 'failures')
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, threshold=5, cooldown=30, max_cooldown=600):
+        self.threshold = threshold
+        self.base_cooldown = cooldown
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.state = self.CLOSED
+        self.failures = 0
+
+    def success(self):
+        """Record a working connection
+
+        Returns:
+            bool -- True if the breaker was not closed before
+        """
+        changed = self.state != self.CLOSED
+        self.state = self.CLOSED
+        self.failures = 0
+        self.cooldown = self.base_cooldown
+        return changed
+
+    def failure(self):
+        """Record a failed connection
+
+        Returns:
+            bool -- True if the breaker just opened
+        """
+        self.failures += 1
+        if self.state == self.HALF_OPEN:
+            self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+            return self.trip()
+        if self.state == self.CLOSED and self.failures >= self.threshold:
+            return self.trip()
+        return False
+
+    def trip(self):
+        """Open the breaker
+
+        Returns:
+            bool -- True if the breaker was not already open
+        """
+        changed = self.state != self.OPEN
+        self.state = self.OPEN
+        return changed
+
+
+class PoolMember:
+    """A proxy that belongs to a pool.
+
+    Built once when the pools are loaded and shared by every request that
+    goes through the proxy, so anything that does not change between
+    requests (like the auth header) is worked out here instead of per request.
+
+    :param str host: IP address of the proxy
+    :param int port: Port of the proxy
+    :param tuple types: (optional) Types (protocols) supported by the proxy
+    :param int weight: (optional) Share of the traffic for weighted strategies
+    :param bool tls: (optional) Connect to the proxy itself over TLS
+    :param bool verify_tls: (optional) Check the proxy's certificate when using TLS
+    :param int max_active: (optional) Requests allowed to use the proxy at once, 0 for no cap
+    :param float rate: (optional) Requests a second allowed through the proxy, None for no limit
+    :param float burst: (optional) Requests allowed through the proxy at once when it has been idle
+    """
+    __slots__ = ('host', 'port', 'username', 'password', 'types', 'weight', 'auth_header', 'tls', 'ssl_context',
+                 'connections', 'active', 'max_active', 'bucket', 'score', 'breaker', 'pool', 'previous',
+                 'successor')
+
+    def __init__(self, host, port=80, username=None, password=None, types=(), weight=1,
+                 tls=False, verify_tls=False, breaker_threshold=5, breaker_cooldown=30, max_active=0,
+                 rate=None, burst=None):
+        self.host = host
+        self.port = int(port)
+        if self.port > 65535:
+            raise ValueError('The port of proxy cannot be greater than 65535')
+        self.username = username
+        self.password = password
+        self.types = frozenset(map(str.upper, types)) & PROXY_TYPES
+        self.weight = max(int(weight), 1)
+
+        self.auth_header = None  # Added to the requests sent to the proxy
+        if username or password:
+            token = base64.b64encode(f'{username}:{password}'.encode())
+            self.auth_header = b'Proxy-Authorization: Basic ' + token + b'\r\n'
+        self.tls = tls
+        # Shared by every TLS proxy on the same port with the same verify mode
+        self.ssl_context = tls_sessions.context(self.port, verify_tls) if tls else None
+        self.connections = connection_pools.get(self.host, self.port, self.username)  # Idle keep-alive connections
+
+        self.active = 0  # Requests currently using this proxy
+        self.max_active = max_active
+        self.bucket = TokenBucket(rate, burst, time.monotonic()) if rate else None  # See `ratelimit`
+        self.score = ProxyScore()
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_cooldown)
+        self.pool = None  # Set when added to a Pool
+        self.previous = None  # The same proxy before a reload, until the new pools are swapped in
+        self.successor = None  # The same proxy after a reload, which took over the active requests
+
+    def __repr__(self):
+        return f'<PoolMember {self.host}:{self.port} active={self.active}>'
+
+    @property
+    def full(self):
+        return self.max_active and self.active >= self.max_active
+
+    def acquire(self):
+        """Count a request that is using the proxy"""
+        self.active += 1
+        if self.pool is not None:
+            self.pool.limit.acquire()
+
+    def release(self):
+        """The request is done with the proxy, a request waiting for the pool can have its slot"""
+        member = self
+        while member.successor is not None:
+            member = member.successor  # Counted on the member that replaced this one in a reload
+        member.active -= 1
+        if self.pool is not None:
+            self.pool.limit.release()
+
+    def connect_succeeded(self):
+        if self.breaker.success() and self.pool is not None:
+            self.pool.admit(self)
+
+    def connect_failed(self):
+        if self.breaker.failure() and self.pool is not None:
+            self.pool.eject(self)
+
+    def check_failed(self):
+        """A health check failed, take the proxy out of the pool right away"""
+        if self.breaker.trip() and self.pool is not None:
+            self.pool.eject(self)
+
+    def carry_over(self, previous):
+        """Keep what was learned about the same proxy before the config was reloaded
+
+        The scores are shared with the previous member, the breaker state is
+        copied, and the rate limit tokens are kept if the limit did not change.
+        The active requests are moved over by `take_over` once the new pools
+        are swapped in.
+        """
+        self.previous = previous
+        self.score = previous.score
+        self.breaker.state = previous.breaker.state
+        self.breaker.failures = previous.breaker.failures
+        self.breaker.cooldown = previous.breaker.cooldown
+        if (self.bucket is not None and previous.bucket is not None and
+                (self.bucket.rate, self.bucket.burst) == (previous.bucket.rate, previous.bucket.burst)):
+            self.bucket = previous.bucket
+
+    def take_over(self):
+        """Count the active requests of the previous member as this one's, they are released through it"""
+        previous, self.previous = self.previous, None
+        self.active += previous.active
+        previous.successor = self
+
+
+class RoundRobin:
+    """Hand out each proxy in turn"""
+    def __init__(self, members):
+        self._members = members
+        self._next = 0
+
+    def select(self):
+        if not self._members:
+            return None
+        member = self._members[self._next % len(self._members)]
+        self._next += 1
+        return member
+
+
+class WeightedRoundRobin:
+    """Round robin where a proxy with weight 3 gets 3x the requests of weight 1
+
+    The order is worked out once when the pool changes, so each selection is
+    just stepping through a list. Each proxy gets `weight` evenly spaced slots
+    so the heavy proxies are spread out instead of being used back to back.
+    """
+    def __init__(self, members):
+        self._schedule = []
+        self._next = 0
+
+        if not members:
+            return
+        gcd = reduce(math.gcd, (m.weight for m in members))
+        slots = []
+        for i, member in enumerate(members):
+            weight = member.weight // gcd
+            slots.extend(((n + 0.5) / weight, i) for n in range(weight))
+        slots.sort()
+        self._schedule = [members[i] for _, i in slots]
+
+    def select(self):
+        if not self._schedule:
+            return None
+        member = self._schedule[self._next % len(self._schedule)]
+        self._next += 1
+        return member
+
+
+class Random:
+    """Pick any proxy"""
+    def __init__(self, members):
+        self._members = members
+
+    def select(self):
+        if not self._members:
+            return None
+        return random.choice(self._members)
+
+
+class PowerOfTwo:
+    """Pick two random proxies and use the one with the fewest active requests"""
+    def __init__(self, members):
+        self._members = members
+
+    def select(self):
+        if len(self._members) < 2:
+            return self._members[0] if self._members else None
+        first, second = random.sample(self._members, 2)
+        return first if first.active <= second.active else second
+
+
+class LeastLatency:
+    """Pick two random proxies and use the one with the lowest expected latency
+
+    The latency comes from the proxy's running scores, weighted by its error
+    rate and how many requests it already has, so slow or flaky proxies get
+    less of the traffic.
+    """
+    def __init__(self, members):
+        self._members = members
+
+    def select(self):
+        if len(self._members) < 2:
+            return self._members[0] if self._members else None
+        first, second = random.sample(self._members, 2)
+        if first.score.cost(first.active) <= second.score.cost(second.active):
+            return first
+        return second
+
+
+def _ring_hash(key):
+    """Same value in every process, unlike `hash()` of a str"""
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+
+class ConsistentHash:
+    """Send the same key to the same proxy, for sticky sessions
+
+    Each proxy is put on a hash ring `replicas` times, a key goes to the first
+    proxy after the key's own place on the ring. When a proxy is added or
+    removed only the keys next to its places move, about 1/N of them, the rest
+    keep their proxy. Finding the proxy is a binary search of the ring.
+
+    The ring is built once, over every proxy in the pool. Ejected proxies stay
+    on it and are skipped by `usable`, so a breaker tripping does not touch
+    the ring at all. A reload builds new pools, and a new ring with them.
+
+    :param list members: The proxies to spread the keys over
+    :param int replicas: (optional) Places each proxy gets on the ring, more spreads the keys more evenly
+    """
+    def __init__(self, members, replicas=100):
+        self._members = list(members)
+        self._replicas = replicas
+        points = sorted([(point, m) for m in self._members for point in self._points(m)],
+                        key=lambda point: point[0])
+        self._hashes = [point for point, _ in points]
+        self._ring = [member for _, member in points]
+
+    def _points(self, member):
+        return [_ring_hash(f'{member.username or ""}@{member.host}:{member.port}#{i}')
+                for i in range(self._replicas)]
+
+    def select(self, key=None, usable=None):
+        """The proxy for the key
+
+        Keyword Arguments:
+            key {str} -- What to keep sticky, a random proxy is picked when it is None (default: {None})
+            usable {callable} -- If a proxy can be used, the ring is walked to the next one that can (default: {None})
+
+        Returns:
+            PoolMember -- None if there are no proxies, or none of them are usable
+        """
+        if not self._ring:
+            return None
+        if key is None:
+            member = random.choice(self._members)
+            if usable is None or usable(member):
+                return member
+            key = str(random.random())
+
+        start = bisect(self._hashes, _ring_hash(key))
+        size = len(self._ring)
+        for i in range(size):
+            member = self._ring[(start + i) % size]
+            if usable is None or usable(member):
+                return member
+        return None
+
+
+STRATEGIES = {'round_robin': RoundRobin,
+              'weighted_round_robin': WeightedRoundRobin,
+              'random': Random,
+              'power_of_two': PowerOfTwo,
+              'least_latency': LeastLatency,
+              'consistent_hash': ConsistentHash,
+              }
+
+
+class Pool:
+    """In memory list of the proxies in a pool
+
+    Proxies whose circuit breaker is open are ejected, they stay in `members`
+    but are left out of `available`, which is what the strategy picks from.
+    Proxies at their `max_active` are skipped, and nothing is picked while the
+    whole pool is at its own cap, see `limit`.
+
+    :param str name: Name of the pool from the config
+    :param str strategy:
+        (optional) How to pick a proxy, one of the keys in `STRATEGIES`
+    :param list members: (optional) The proxies in the pool
+    :param int max_active: (optional) Requests allowed to use the pool at once, 0 for no cap
+    :param int queue_size: (optional) Requests allowed to wait for the pool when it is full
+    :param str hash_key: (optional) What a `consistent_hash` pool keeps sticky, one of `HASH_KEYS`
+    :param int hash_replicas: (optional) Places each proxy gets on the ring of a `consistent_hash` pool
+    """
+    def __init__(self, name, strategy='random', members=(), max_active=0, queue_size=100,
+                 hash_key='client_ip', hash_replicas=100):
+        if strategy not in STRATEGIES:
+            raise ValueError(f'Unknown strategy `{strategy}` for pool `{name}`. '
+                             f'Must be one of: {", ".join(STRATEGIES)}')
+        if hash_key not in HASH_KEYS:
+            raise ValueError(f'Unknown hash key `{hash_key}` for pool `{name}`. '
+                             f'Must be one of: {", ".join(HASH_KEYS)}')
+        self.name = name
+        self.strategy = strategy
+        # Only set for `consistent_hash` pools, see `select`
+        self.hash_key = hash_key if strategy == 'consistent_hash' else None
+        self.hash_replicas = hash_replicas
+        self.members = list(members)
+        self.available = [m for m in self.members if m.breaker.state != CircuitBreaker.OPEN]
+        for member in self.members:
+            member.pool = self
+        self._selector = self._make_selector()
+        self.limit = Limit(max_active, queue_size)
+
+    def __len__(self):
+        return len(self.members)
+
+    def _make_selector(self):
+        if self.hash_key is not None:
+            # Over every member, ejected ones are skipped in `select` so the ring never changes
+            return ConsistentHash(self.members, self.hash_replicas)
+        return STRATEGIES[self.strategy](self.available)
+
+    def _rebuild(self):
+        if self.hash_key is None:
+            self._selector = self._make_selector()
+
+    def eject(self, member):
+        """Stop picking the proxy until its breaker cooldown is over"""
+        if member not in self.available:
+            return
+        self.available.remove(member)
+        self._rebuild()
+        logger.warning(f"Ejected proxy={member.host}:{member.port}; pool={self.name}; "
+                       f"cooldown={member.breaker.cooldown}s; available={len(self.available)};")
+        asyncio.get_event_loop().call_later(member.breaker.cooldown, self._half_open, member)
+
+    def admit(self, member):
+        """Start picking the proxy again"""
+        if member.pool is not self or member in self.available:
+            return
+        self.available.append(member)
+        self._rebuild()
+        logger.info(f"Admitted proxy={member.host}:{member.port}; pool={self.name}; "
+                    f"available={len(self.available)};")
+
+    def _half_open(self, member):
+        # The proxy may have been let back in by a health check already
+        if member.breaker.state == CircuitBreaker.OPEN:
+            member.breaker.state = CircuitBreaker.HALF_OPEN
+            self.admit(member)
+
+    def select(self, exclude=(), delay=None, affinity=None):
+        """Pick a proxy with the pool's strategy
+
+        Keyword Arguments:
+            exclude {set} -- Members not to pick, e.g. ones that already failed the request (default: {()})
+            delay {callable} -- Seconds a member would have to wait for a rate limit token, members that
+                                can go right away are picked over ones that can not (default: {None})
+            affinity {dict} -- The values of `HASH_KEYS` for the request, used by `consistent_hash`
+                               pools. Sticking to the proxy comes before rate limits (default: {None})
+
+        Returns:
+            PoolMember -- None if every available proxy is excluded or full, or the pool is full
+        """
+        if self.limit.full:
+            return None
+        if self.hash_key is not None:
+            key = affinity.get(self.hash_key) if affinity is not None else None
+            return self._selector.select(key, lambda m: (m.breaker.state != CircuitBreaker.OPEN and
+                                                         m not in exclude and not m.full))
+
+        member = self._selector.select()
+        if member is None or (member not in exclude and not member.full):
+            if member is None or delay is None:
+                return member
+            return self._least_delayed(member, exclude, delay)
+
+        left = [m for m in self.available if m not in exclude and not m.full]
+        if not left:
+            return None
+        # Give the strategy a few more tries so its choice is still used when it can be
+        for _ in range(len(left)):
+            member = self._selector.select()
+            if member not in exclude and not member.full:
+                break
+        else:
+            member = random.choice(left)
+        if delay is None:
+            return member
+        return self._least_delayed(member, exclude, delay)
+
+    def _least_delayed(self, member, exclude, delay):
+        """The strategy's pick if it has a token, otherwise the first of a few more picks that does
+
+        Only `RATE_TRIES` more proxies are looked at, so picking stays cheap in
+        big pools. If none of them have a token, the one with the shortest wait
+        is used.
+        """
+        wait = delay(member)
+        if not wait:
+            return member
+        for _ in range(RATE_TRIES):
+            other = self._selector.select()
+            if other is member or other in exclude or other.full:
+                continue
+            other_wait = delay(other)
+            if not other_wait:
+                return other
+            if other_wait < wait:
+                member, wait = other, other_wait
+        return member
+
+    def blocked(self, exclude=()):
+        """If `select` found nothing only because of the caps, so waiting for a slot can help"""
+        return any(m not in exclude for m in self.available)
+
+
+class PoolTable:
+    """All of the pools, by name"""
+    def __init__(self):
+        self._pools = {}
+        self.rate_limited = False  # If any proxy has a rate limit
+        self.hashed = False  # If any pool uses `consistent_hash`
+
+    def __getitem__(self, name):
+        return self._pools[name]
+
+    def __contains__(self, name):
+        return name in self._pools
+
+    def __iter__(self):
+        return iter(self._pools.values())
+
+    def load(self, pools_config, **options):
+        """Build the pools from the `Pools` section of the config and start using them, see `build`"""
+        self.swap(self.build(pools_config, **options))
+
+    def build(self, pools_config, breaker_threshold=5, breaker_cooldown=30, max_per_proxy=0, queue_size=100):
+        """Build the pools from the `Pools` section of the config, without using them yet
+
+        Nothing that requests use is changed, so this can run in another thread
+        while requests are being handled. A proxy that is already in a pool of
+        the same name keeps its scores, breaker state and rate limit tokens, see
+        `PoolMember.carry_over`.
+
+        The proxies of a pool are its `Proxies` followed by the ones in its
+        `Proxy_File`, which is read a line at a time, see `proxylist`.
+
+        Arguments:
+            pools_config {list} -- The `Pools` section of the config
+
+        Keyword Arguments:
+            breaker_threshold {int} -- Failed connections in a row before a proxy is ejected (default: {5})
+            breaker_cooldown {int} -- Seconds an ejected proxy is left out for (default: {30})
+            max_per_proxy {int} -- Requests a proxy can have at once unless it sets its own, 0 for no cap
+                                   (default: {0})
+            queue_size {int} -- Requests that can wait for a pool unless it sets its own (default: {100})
+
+        Raises:
+            ValueError -- A value in the config is not valid
+            OSError -- A `Proxy_File` could not be read
+
+        Returns:
+            dict -- Pool name -> Pool, to pass to `swap`
+        """
+        previous = {(pool.name, m.host, m.port, m.username): m for pool in self._pools.values() for m in pool.members}
+        pools = {}
+        for pool_config in pools_config:
+            proxies = pool_config.get('Proxies') or ()
+            if pool_config.get('Proxy_File'):
+                proxies = itertools.chain(proxies, read_proxy_file(pool_config['Proxy_File']))
+            rate = pool_config.get('Rate_Limit')
+            burst = pool_config.get('Rate_Burst')
+            members = []
+            for proxy in proxies:
+                member = PoolMember(host=proxy['Host'],
+                                    port=proxy.get('Port', 80),
+                                    username=proxy.get('User'),
+                                    password=proxy.get('Pass'),
+                                    types=proxy.get('Types', ('HTTP', 'HTTPS')),
+                                    weight=proxy.get('Weight', 1),
+                                    tls=proxy.get('Tls', False),
+                                    verify_tls=proxy.get('Verify_Tls', False),
+                                    breaker_threshold=breaker_threshold,
+                                    breaker_cooldown=breaker_cooldown,
+                                    max_active=proxy.get('Max_Connections', max_per_proxy),
+                                    rate=proxy.get('Rate_Limit', rate),
+                                    burst=proxy.get('Rate_Burst', burst))
+                if previous:
+                    before = previous.get((pool_config['Name'], member.host, member.port, member.username))
+                    if before is not None:
+                        member.carry_over(before)
+                members.append(member)
+            pool = Pool(pool_config['Name'], pool_config.get('Strategy', 'random'), members,
+                        max_active=pool_config.get('Max_Connections', 0),
+                        queue_size=pool_config.get('Queue_Size', queue_size),
+                        hash_key=pool_config.get('Hash_Key', 'client_ip'),
+                        hash_replicas=pool_config.get('Hash_Replicas', 100))
+            pools[pool.name] = pool
+            logger.info(f"Loaded pool={pool.name}; proxies={len(pool)}; strategy={pool.strategy};")
+        return pools
+
+    def swap(self, pools):
+        """Start using the pools made by `build`
+
+        Requests that already have a proxy keep it, and stay counted against
+        the caps: a pool with the same name keeps using the same `Limit`, and
+        each proxy still in it takes over the active requests of its previous
+        member.
+        """
+        old_pools, self._pools = self._pools, pools
+        self.rate_limited = any(member.bucket is not None for pool in pools.values() for member in pool.members)
+        self.hashed = any(pool.hash_key is not None for pool in pools.values())
+        for name, pool in pools.items():
+            old = old_pools.get(name)
+            if old is not None:
+                pool.limit = old.limit.update(pool.limit.max_active, pool.limit.queue_size)
+            for member in pool.members:
+                if member.previous is not None:
+                    member.take_over()
+                # Proxies that were ejected before the reload are let back in on trial like any other
+                if member.breaker.state == CircuitBreaker.OPEN:
+                    asyncio.get_event_loop().call_later(member.breaker.cooldown, pool._half_open, member)
+        for name, old in old_pools.items():
+            if name not in pools:
+                old.limit.wake_all()  # So the requests waiting for it see that it is gone
+
+    def select(self, pool_names, exclude=(), delay=None, affinity=None):
+        """Pick a proxy from the first pool that has one
+
+        When every proxy in a pool has been ejected or excluded, the next pool is used.
+
+        Arguments:
+            pool_names {list} -- Names of the pools in the order to try them
+
+        Keyword Arguments:
+            exclude {set} -- Members not to pick (default: {()})
+            delay {callable} -- See `Pool.select` (default: {None})
+            affinity {dict} -- See `Pool.select` (default: {None})
+
+        Returns:
+            tuple -- (PoolMember, pool name), (None, None) if no pool has a proxy
+        """
+        for name in pool_names:
+            pool = self._pools.get(name)
+            if pool is None:
+                continue
+            member = pool.select(exclude, delay, affinity)
+            if member is not None:
+                return member, name
+        return None, None
+
+    def blocked(self, pool_names, exclude=()):
+        """The limits of the pools that `select` skipped only because they were full
+
+        Returns:
+            list -- `admission.Limit` of each of those pools, empty if waiting would not help
+        """
+        limits = []
+        for name in pool_names:
+            pool = self._pools.get(name)
+            if pool is not None and pool.blocked(exclude):
+                limits.append(pool.limit)
+        return limits
+
+
+pool_table = PoolTable()
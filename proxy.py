@@ -1,207 +1,326 @@
-import re
 import time
-import base64
+import socket
 import logging
 import asyncio
-import sqlite3
 import ssl as _ssl
-from utils import db_conn
+from pools import pool_table
+from routing import rule_table
+from tls import tls_sessions
+from resolver import dns_cache
+from timing import RequestTiming
+import admission
+from ratelimit import rate_scheduler
 
-from errors import (ProxyConnError, ProxySendError, ProxyTimeoutError)
+from errors import (ProxyConnError, ProxySendError, ProxyTimeoutError, QueueTimeoutError)
 
 logger = logging.getLogger(__name__)
 
-_HTTP_PROTOS = {'HTTP', 'CONNECT:80', 'SOCKS4', 'SOCKS5'}
-_HTTPS_PROTOS = {'HTTPS', 'SOCKS4', 'SOCKS5'}
 
+async def get_proxy(host, port, exclude=(), timing=None, queue_timeout=None, affinity=None, connect_timeout=30):
+    """Route the host to its pools and pick a proxy from them
 
-async def get_proxy(host, port):
-    proxy = None
-    pool_name = None
-    rules = _get_rules(port)
+    Keyword Arguments:
+        exclude {set} -- `pools.PoolMember`s not to pick (default: {()})
+        timing {timing.RequestTiming} -- Where to add the route, queue and select times (default: {None})
+        queue_timeout {float} -- Max seconds to wait when the pools are at their caps or out of rate limit
+                                 tokens, None to not wait for the caps at all (default: {None})
+        affinity {dict} -- client_ip, host and session of the request, for `consistent_hash` pools (default: {None})
+        connect_timeout {float} -- Seconds the proxy has to connect, and for its TLS handshake (default: {30})
 
-    for rule in rules:
-        # TODO: make a cache for already known matches (memoize?)
-        logger.debug(f"Testing rule={rule[1]}; pool={rule[0]}; host={host};")
-        match = re.search(rule[1], host)
-        if match:
-            logger.debug(f"Found a match for host={host};")
-            proxy = _select_proxy(rule[0])
-            pool_name = rule[0]
-            # TODO: If there are no more proxies left in this pool, then check other pools
-            break
+    Raises:
+        AdmissionError -- The pools are full and waiting for them failed
 
+    Returns:
+        tuple -- (Proxy, pool name) that was picked, (None, None) if there is no proxy for the host
+    """
+    started = time.monotonic()
+    route = rule_table.match(host, port)
+    if timing is not None:
+        timing.add('route', time.monotonic() - started)
+
+    if route is None:
+        return None, None
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Found a match for host={host}; pools={route.pools};")
+    return await _select_proxy(route, host, exclude, timing, queue_timeout, affinity, connect_timeout)
+
+
+async def _select_proxy(route, host, exclude=(), timing=None, queue_timeout=None, affinity=None, connect_timeout=30):
+    """Pick a proxy from the first of the route's pools that has one
+
+    When rate limits are set, proxies that have a token free are picked over
+    ones that do not. If none of them do, the request waits for the next token
+    of the one it got, so it is delayed instead of failing.
+
+    Arguments:
+        route {routing.Route} -- Where the host is sent
+        host {str} -- The host being requested
+
+    Keyword Arguments:
+        exclude {set} -- `pools.PoolMember`s not to pick (default: {()})
+        timing {timing.RequestTiming} -- Timings of the request the proxy is for (default: {None})
+        queue_timeout {float} -- See `get_proxy` (default: {None})
+        affinity {dict} -- See `get_proxy` (default: {None})
+        connect_timeout {float} -- See `get_proxy` (default: {30})
+
+    Returns:
+        tuple -- (Proxy, pool name) that was picked, (None, None) if the pools are empty
+    """
+    started = time.monotonic()
+    delay = None
+    if route.host_rate or pool_table.rate_limited:
+        def delay(member):
+            return rate_scheduler.delay(member, host, route, time.monotonic())
+
+    member, pool_name = pool_table.select(route.pool_names, exclude, delay, affinity)
+    if timing is not None:
+        timing.add('select', time.monotonic() - started)
+
+    if member is None and queue_timeout is not None:
+        member, pool_name = await _wait_for_proxy(route.pool_names, exclude, queue_timeout, delay, timing,
+                                                  affinity)
+    if member is None:
+        logger.warning(f"No proxies left in pools={route.pools};")
+        return None, None
+
+    wait = 0
+    if delay is not None:
+        now = time.monotonic()
+        if queue_timeout is not None and rate_scheduler.delay(member, host, route, now) > queue_timeout:
+            rate_scheduler.rejected += 1
+            raise QueueTimeoutError('Rate limited')
+        wait = rate_scheduler.take(member, host, route, now)
+
+    member.acquire()
+    proxy = Proxy(member, timeout=connect_timeout, timing=timing)
+    if wait > 0:
+        try:
+            await asyncio.sleep(wait)
+        except asyncio.CancelledError:
+            proxy.close()
+            raise
+        if timing is not None:
+            timing.add('queue', wait)
     return proxy, pool_name
 
 
-def _select_proxy(pools):
-    proxy = None
+async def _wait_for_proxy(pool_names, exclude, queue_timeout, delay=None, timing=None, affinity=None):
+    """Wait in the queues of the full pools until one of them has a proxy free
 
-    sql_pools = pools.split(',')
-    desired_args = ','.join('?' * len(sql_pools))
-    try:
-        with db_conn:
-            cur = db_conn.cursor()
-            cur.execute(f"""SELECT host, port, username, password, types
-                            FROM proxy WHERE pool in ({desired_args})
-                            ORDER BY RANDOM() LIMIT 1""",
-                        sql_pools)
-            proxy = dict(cur.fetchone())
-
-    except sqlite3.IntegrityError:
-        logger.critical("Failed to select a proxy from the pool")
-
-    new_proxy = Proxy(host=proxy['host'],
-                      port=proxy['port'],
-                      username=proxy['username'],
-                      password=proxy['password'],
-                      types=proxy['types'].split(','))
-    return new_proxy
-
-
-def _get_rules(port):
-    # TODO: On server start, get and compile all rules,
-    #       re run if a rule is added/removed/modified while the server is running
-    rules = None
+    Returns:
+        tuple -- (PoolMember, pool name), (None, None) if the pools are empty and not just full
+    """
+    started = time.monotonic()
+    deadline = started + queue_timeout
     try:
-        with db_conn:
-            cur = db_conn.cursor()
-            cur.execute("SELECT pool, rule_re FROM pool_rule WHERE port=? ORDER BY rank ASC", (port,))
-            rules = cur.fetchall()
-
-    except sqlite3.IntegrityError:
-        logger.critical("Failed to select rules from the db")
-
-    return rules
+        while True:
+            limits = pool_table.blocked(pool_names, exclude)
+            if not limits:
+                return None, None
+            await admission.wait(limits, deadline - time.monotonic())
+            member, pool_name = pool_table.select(pool_names, exclude, delay, affinity)
+            if member is not None:
+                return member, pool_name
+    finally:
+        if timing is not None:
+            timing.add('queue', time.monotonic() - started)
 
 
 class Proxy:
-    """Proxy.
+    """A single request's connection through a proxy.
+
+    Everything about the proxy itself (address, types, auth header, ssl
+    context) lives on the long lived :class:`pools.PoolMember`, this only
+    holds the connection and the stats of the request, so it is cheap to
+    make one for each request.
 
-    :param str host: IP address of the proxy
-    :param int port: Port of the proxy
-    :param tuple types:
-        (optional) List of types (protocols) which may be supported
-        by the proxy and which can be checked to work with the proxy
+    :param member: The :class:`pools.PoolMember` to connect through
     :param int timeout:
         (optional) Timeout of a connection and receive a response in seconds
-    :param bool verify_ssl:
-        (optional) Flag indicating whether to check the SSL certificates.
-        Set to True to check ssl certifications
-
-    :raises ValueError: If the host not is IP address, or if the port > 65535
+    :param timing: (optional) The :class:`timing.RequestTiming` to add the dns, connect and tls times to
     """
-    def __init__(self, host=None, port=None, username=None, password=None, types=(),
-                 timeout=30, verify_ssl=False, geo_alpha2='US'):
-        self.host = host
-        self.port = int(port) if port is not None else 80
-        self._username = username
-        self._password = password
-
-        self._auth_token = None
-        if self._username or self._password:
-            self._auth_token = base64.encodestring(f'{self._username}:{self._password}'
-                                                   .encode()).decode()
-
-        if self.port > 65535:
-            raise ValueError('The port of proxy cannot be greater than 65535')
-
-        types = map(str.upper, types)
-        self._types = set(types) & set(('HTTP', 'HTTPS', 'CONNECT:80',
-                                        'CONNECT:25', 'SOCKS4', 'SOCKS5'))
+    __slots__ = ('member', '_timeout', 'timing', '_closed', '_released', 'reused', '_conn_created', 'stats',
+                 '_reader', '_writer')
+
+    def __init__(self, member, timeout=30, timing=None):
+        self.member = member
         self._timeout = timeout
-        self._ssl_context = (True if verify_ssl else
-                             _ssl._create_unverified_context())
-        self._geo = geo_alpha2
+        self.timing = timing if timing is not None else RequestTiming()
+        self._released = False  # If the slot on the member has been given back
         self.set_defaults()
 
     def set_defaults(self):
         self._closed = True
-        self.stats = {'total_time': 0,
-                      'bandwidth_up': 0,
+        self.reused = False  # If the connection came from the keep-alive pool
+        self._conn_created = None
+        self.stats = {'bandwidth_up': 0,
                       'bandwidth_down': 0,
                       'status_code': None,
+                      'connect_time': None,
+                      'first_byte': None,
                       }
-        self._reader = {'conn': None, 'ssl': None}
-        self._writer = {'conn': None, 'ssl': None}
+        self._reader = self._writer = None
 
     def __repr__(self):
-        return '<Proxy {code} [{types}] {host}:{port}>'.format(
-               code=self._geo, types=', '.join(self.types), host=self.host,
-               port=self.port)
+        return '<Proxy [{types}] {host}:{port}>'.format(
+               types=', '.join(self.types), host=self.host, port=self.port)
+
+    @property
+    def host(self):
+        return self.member.host
+
+    @property
+    def port(self):
+        return self.member.port
 
     @property
     def types(self):
         """Types (protocols) supported by the proxy.
-        :rtype: tuple
+        :rtype: frozenset
         """
-        return self._types
+        return self.member.types
 
     @property
     def writer(self):
-        return self._writer.get('ssl') or self._writer.get('conn')
+        return self._writer
 
     @property
     def reader(self):
-        return self._reader.get('ssl') or self._reader.get('conn')
+        return self._reader
 
-    def log(self, msg, stime=0, level='debug'):
+    def log(self, msg, *args, level=logging.DEBUG):
         """Always log proxy logs the same
 
+        Nothing is formatted unless the level is enabled, so it is free to call
+        on every request. How long things took is in `timing` instead.
+
         Arguments:
-            msg {[type]} -- [description]
+            msg {str} -- %-style message, formatted with `args`
 
         Keyword Arguments:
-            stime {int} -- The start time of the process (default: {0})
-            level {str} -- the level to log at (default: {'debug'})
+            level {int} -- The level to log at (default: {logging.DEBUG})
         """
-        log_levels = {'DEBUG': logger.debug, 'INFO': logger.info,
-                      'WARNING': logger.warning, 'ERROR': logger.error,
-                      'CRITICAL': logger.critical}
-        log_using = log_levels.get(level.upper(), logger.debug)
-
-        # Get runtime in ms
-        runtime = int((time.time() * 1000) - (stime * 1000)) if stime else 0
-        self.stats['total_time'] += runtime
-        log_using(f"{self.host}:{self.port} - {msg.strip()} Runtime: {runtime}ms")
-
-    async def connect(self, ssl=False):
-        msg = 'SSL: ' if ssl else ''
-        self.log(f'{msg}Initial connection')
-        stime = time.time()
+        if logger.isEnabledFor(level):
+            logger.log(level, f'%s:%d - {msg}', self.host, self.port, *args)
+
+    async def connect(self, reuse=False):
+        """Open a connection to the proxy, with TLS for proxies that have `tls` set
+
+        Keyword Arguments:
+            reuse {bool} -- Use an idle keep-alive connection if there is one (default: {False})
+        """
+        connections = self.member.connections
+        if reuse and connections is not None:
+            conn = connections.acquire()
+            if conn is not None:
+                self._reader, self._writer, self._conn_created = conn
+                self.reused = True
+                self._closed = False
+                self.stats['connect_time'] = 0
+                self.log('Connection: reused')
+                return
+
+        msg = ''
+        self.log('Initial connection')
+        stime = time.monotonic()
+        resolved = None
         try:
-            if ssl:
-                _type = 'ssl'
-                sock = self._writer['conn'].get_extra_info('socket')
-                params = {'ssl': self._ssl_context, 'sock': sock,
-                          'server_hostname': self.host}
-            else:
-                _type = 'conn'
-                params = {'host': self.host, 'port': self.port}
-            self._reader[_type], self._writer[_type] = \
-                await asyncio.wait_for(asyncio.open_connection(**params),
-                                       timeout=self._timeout)
+            addresses = await dns_cache.resolve_all(self.host)
+            resolved = time.monotonic()
+            self.timing.add('dns', resolved - stime)
+            # Each address gets an even share of the timeout, so one that never answers, like an
+            # unreachable IPv6 address, leaves time for the others
+            timeout = self._timeout / len(addresses)
+            for i, address in enumerate(addresses, 1):
+                if self.member.tls:
+                    opening = self._open_tls(address)
+                else:
+                    opening = asyncio.open_connection(address, self.port)
+                try:
+                    self._reader, self._writer = await asyncio.wait_for(opening, timeout=timeout)
+                    break
+                except (asyncio.TimeoutError, OSError) as e:
+                    if i == len(addresses):
+                        raise
+                    self.log('Connection: failed to %s, trying the next address; Error: %r', address, e)
 
         except asyncio.TimeoutError:
             msg += 'Connection: timeout'
+            self.member.connect_failed()
             raise ProxyTimeoutError(msg)
         except (ConnectionRefusedError, OSError, _ssl.SSLError):
             msg += 'Connection: failed'
+            self.member.connect_failed()
             raise ProxyConnError(msg)
         else:
             msg += 'Connection: success'
             self._closed = False
+            ssl_object = self.writer.get_extra_info('ssl_object')
+            if ssl_object is not None:
+                tls_sessions.handshake_done(self.host, self.port, ssl_object)
+            self._conn_created = time.time()
+            self.member.connect_succeeded()
         finally:
-            self.log(msg, stime)
+            ended = time.monotonic()
+            self.stats['connect_time'] = ended - stime
+            if resolved is not None and not self.member.tls:
+                self.timing.add('connect', ended - resolved)
+            self.log(msg)
+
+    async def _open_tls(self, address):
+        """Connect to a TLS proxy, the TCP connect and the handshake are done and timed apart"""
+        loop = asyncio.get_event_loop()
+        sock = socket.socket(socket.AF_INET6 if ':' in address else socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        try:
+            started = time.monotonic()
+            try:
+                await loop.sock_connect(sock, (address, self.port))
+            finally:
+                connected = time.monotonic()
+                self.timing.add('connect', connected - started)
+            try:
+                return await asyncio.open_connection(sock=sock, ssl=self.member.ssl_context,
+                                                     server_hostname=self.host)
+            finally:
+                self.timing.add('tls', time.monotonic() - connected)
+        except BaseException:
+            sock.close()
+            raise
+
+    async def reconnect(self):
+        """Drop the current connection and open a brand new one"""
+        if self.writer:
+            self.writer.close()
+        self._reader = self._writer = None
+        self.reused = False
+        await self.connect()
 
-    def close(self):
-        self.log(f'Connection: closed')
+    def close(self, reuse=False):
+        """Close the connection to the proxy
+
+        Keyword Arguments:
+            reuse {bool} -- Keep the connection open for another request (default: {False})
+        """
+        self.log('Connection: closed')
+
+        if not self._released:
+            self.member.release()
+            self._released = True
 
         if self._closed:
             self.set_defaults()
             return
 
-        if self.writer:
+        ssl_object = self.writer.get_extra_info('ssl_object') if self.writer else None
+        if ssl_object is not None:
+            # TLS 1.3 sessions arrive after the handshake, keep the latest one
+            tls_sessions.save(ssl_object)
+
+        connections = self.member.connections
+        if reuse and connections is not None:
+            connections.release(self._reader, self._writer, self._conn_created)
+        elif self.writer:
             self.writer.close()
 
         self.set_defaults()
@@ -209,20 +328,17 @@ class Proxy:
     async def send(self, req):
         msg = ''
 
-        if self._auth_token is not None:
-            # Add proxy auth to header
-            self.log("Setting Proxy-Authorization")
-            req = req.replace(b'\r\n\r\n',
-                              f'\r\nProxy-Authorization: Basic {self._auth_token.strip()}\r\n\r\n'.encode())
-
         _req = req.encode() if not isinstance(req, bytes) else req
+        if self.member.auth_header is not None:
+            # Add proxy auth to the end of the request head
+            _req = _req[:-2] + self.member.auth_header + b'\r\n'
 
         try:
             self.stats['bandwidth_up'] += len(_req)
             self.writer.write(_req)
             await self.writer.drain()
-        except ConnectionResetError:
+        except ConnectionError:
             msg = '; Sending: failed'
             raise ProxySendError(msg)
         finally:
-            self.log(f'Request: {req}{msg}')
+            self.log('Request: %d bytes%s', len(_req), msg)
@@ -0,0 +1,169 @@
+import csv
+import ipaddress
+
+# Columns of a csv proxy list -> the key of the proxy in the config
+CSV_COLUMNS = {'host': 'Host',
+               'port': 'Port',
+               'user': 'User',
+               'username': 'User',
+               'pass': 'Pass',
+               'password': 'Pass',
+               'types': 'Types',
+               'weight': 'Weight',
+               'tls': 'Tls',
+               'verify_tls': 'Verify_Tls',
+               'max_connections': 'Max_Connections',
+               'rate_limit': 'Rate_Limit',
+               'rate_burst': 'Rate_Burst',
+               }
+_NUMBERS = {'Port': int, 'Weight': int, 'Max_Connections': int, 'Rate_Limit': float, 'Rate_Burst': float}
+_FLAGS = {'Tls', 'Verify_Tls'}
+# The scheme at the start of a line of a plain list -> Types of the proxy
+_SCHEME_TYPES = {'http': ('http', 'https'),
+                 'https': ('http', 'https'),
+                 'socks4': ('socks4',),
+                 'socks5': ('socks5',),
+                 }
+
+
+def read_proxy_file(path):
+    """Read the proxies in a file, one at a time so the whole list is never held in memory
+
+    Files ending in `.csv` need a header row naming the columns, see
+    `CSV_COLUMNS`, multiple `types` are separated with spaces or `;`. Any
+    other file has a proxy on each line, written as
+    `[scheme://][user:pass@]host[:port]`. Blank lines and lines starting with
+    `#` are skipped.
+
+    Arguments:
+        path {str} -- The file to read
+
+    Raises:
+        OSError -- The file could not be read
+        ValueError -- A line is not a valid proxy, the message has the line number
+
+    Yields:
+        dict -- Each proxy, written the same as the ones in the `Proxies` of a pool in the config
+    """
+    with open(path, newline='') as f:
+        if path.lower().endswith('.csv'):
+            yield from _read_csv(path, f)
+        else:
+            yield from _read_lines(path, f)
+
+
+def _read_lines(path, f):
+    for line_number, line in enumerate(f, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            yield parse_proxy(line)
+        except ValueError as e:
+            raise ValueError(f'{path}:{line_number}: {e}') from None
+
+
+def _read_csv(path, f):
+    reader = csv.reader(f)
+    header = next(reader, None)
+    if header is None:
+        return
+    keys = [CSV_COLUMNS.get(column.strip().lower()) for column in header]
+    if 'Host' not in keys:
+        raise ValueError(f'{path}: The header needs a `host` column')
+
+    for row in reader:
+        if not row or row[0].startswith('#'):
+            continue
+        proxy = {}
+        try:
+            for key, val in zip(keys, row):
+                val = val.strip()
+                if key is None or not val:
+                    continue
+                if key in _NUMBERS:
+                    val = _NUMBERS[key](val)
+                elif key in _FLAGS:
+                    val = val.lower() in ('1', 'true', 'yes')
+                elif key == 'Types':
+                    val = val.replace(';', ' ').split()
+                proxy[key] = val
+        except ValueError as e:
+            raise ValueError(f'{path}:{reader.line_num}: {e}') from None
+        if 'Host' not in proxy:
+            raise ValueError(f'{path}:{reader.line_num}: No host')
+        yield proxy
+
+
+def check_proxy(proxy):
+    """Make sure a proxy is written the same as the ones in the `Proxies` of a pool in the config
+
+    Raises:
+        ValueError -- Something in the proxy is missing or the wrong type
+    """
+    if not isinstance(proxy, dict):
+        raise ValueError('A proxy must be a mapping')
+    if not isinstance(proxy.get('Host'), str) or not proxy['Host']:
+        raise ValueError('A proxy needs a `Host`')
+    for key in ('User', 'Pass'):
+        if proxy.get(key) is not None and not isinstance(proxy[key], str):
+            raise ValueError(f'`{key}` of a proxy must be a string')
+    for key, number in _NUMBERS.items():
+        val = proxy.get(key)
+        if val is None:
+            continue
+        # An int is fine where a float is wanted, a bool is not a number here
+        allowed = (int, float) if number is float else int
+        if isinstance(val, bool) or not isinstance(val, allowed):
+            raise ValueError(f'`{key}` of a proxy must be a number')
+    for key in _FLAGS:
+        if proxy.get(key) is not None and not isinstance(proxy[key], bool):
+            raise ValueError(f'`{key}` of a proxy must be true or false')
+    types = proxy.get('Types')
+    if types is not None and (not isinstance(types, (list, tuple)) or not all(isinstance(t, str) for t in types)):
+        raise ValueError('`Types` of a proxy must be a list of strings')
+
+
+def parse_proxy(text):
+    """Parse a proxy written as `[scheme://][user:pass@]host[:port]`
+
+    Raises:
+        ValueError -- It is not a valid proxy
+
+    Returns:
+        dict -- The proxy, written the same as the ones in the config
+    """
+    proxy = {}
+    scheme, sep, rest = text.partition('://')
+    if sep:
+        types = _SCHEME_TYPES.get(scheme.lower())
+        if types is None:
+            raise ValueError(f'Unknown scheme `{scheme}`')
+        proxy['Types'] = types
+    else:
+        rest = scheme
+
+    auth, sep, address = rest.rpartition('@')
+    if sep:
+        proxy['User'], _, proxy['Pass'] = auth.partition(':')
+
+    if address.startswith('['):  # [IPv6]:port
+        host, _, port = address[1:].partition(']')
+        port = port[1:]
+    elif address.count(':') == 1:
+        host, _, port = address.partition(':')
+    else:
+        host, port = address, ''
+        if ':' in host:
+            try:
+                ipaddress.IPv6Address(host)
+            except ValueError:
+                raise ValueError(f'Bad address in `{text}`') from None
+    if not host:
+        raise ValueError(f'No host in `{text}`')
+    proxy['Host'] = host
+    if port:
+        if not port.isdigit():
+            raise ValueError(f'Bad port in `{text}`')
+        proxy['Port'] = int(port)
+    return proxy
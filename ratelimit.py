@@ -0,0 +1,138 @@
+import logging
+from collections import OrderedDict
+
+from config import CONFIG
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Allows `rate` requests a second on average, with bursts of up to `burst`
+
+    The tokens are only topped up when the bucket is used, from the time since
+    it was last used, so an idle bucket costs nothing. Taking a token when
+    there are none left puts the bucket into debt, which reserves the next
+    token for the request instead of turning it away.
+
+    :param float rate: Tokens added a second
+    :param float burst: (optional) Max tokens the bucket holds, defaults to a second of tokens
+    :param float now: (optional) `time.monotonic()` the bucket is made at
+    """
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst=None, now=0.0):
+        self.rate = float(rate)
+        self.burst = float(burst or max(self.rate, 1))
+        self.tokens = self.burst
+        self.updated = now
+
+    def _refill(self, now):
+        tokens = self.tokens + (now - self.updated) * self.rate
+        self.tokens = tokens if tokens < self.burst else self.burst
+        self.updated = now
+
+    def delay(self, now):
+        """Seconds until a token is free, without taking it"""
+        self._refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        """Take a token
+
+        Returns:
+            float -- Seconds to wait before using it, 0 if it can be used now
+        """
+        self._refill(now)
+        self.tokens -= 1
+        return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def full(self, now):
+        """If the bucket has topped up completely, when it is no different to a new one"""
+        return self.tokens + (now - self.updated) * self.rate >= self.burst
+
+
+class RateScheduler:
+    """Token buckets for every proxy and for every (proxy, target host)
+
+    The bucket of a proxy lives on its `pools.PoolMember`. The (proxy, host)
+    buckets are keyed by the proxy's address instead of its member, so they
+    are kept when the config is reloaded and the members are made again. They
+    are made the first time a host is requested through a proxy and
+    are kept in least recently used order. Each new bucket drops up to two of
+    the oldest ones once they have topped up, which loses nothing since a full
+    bucket is the same as a new one, so the work per request stays the same
+    no matter how many buckets there are. Past `max_buckets` the oldest one is
+    dropped even if it is not full.
+
+    :param int max_buckets: (optional) Max (proxy, host) buckets to keep
+    """
+    def __init__(self, max_buckets=100000):
+        self.max_buckets = max_buckets
+        self._buckets = OrderedDict()  # (proxy host, proxy port, host) -> TokenBucket
+        self.delayed = 0  # Requests that had to wait for a token
+        self.delay_time = 0.0  # Seconds they waited, over all of them
+        self.rejected = 0  # Would have waited longer than allowed
+        self.evicted = 0
+
+    def delay(self, member, host, route, now):
+        """Seconds until the proxy and the (proxy, host) buckets both have a token free
+
+        Arguments:
+            member {pools.PoolMember} -- The proxy
+            host {str} -- The host being requested
+            route {routing.Route} -- The route the host matched, which has the host rate
+            now {float} -- `time.monotonic()`
+        """
+        wait = member.bucket.delay(now) if member.bucket is not None else 0
+        if route.host_rate:
+            bucket = self._buckets.get((member.host, member.port, host))
+            if bucket is not None:
+                host_wait = bucket.delay(now)
+                if host_wait > wait:
+                    wait = host_wait
+        return wait
+
+    def take(self, member, host, route, now):
+        """Take a token from the proxy's and the (proxy, host) buckets
+
+        Returns:
+            float -- Seconds to wait before sending the request
+        """
+        wait = member.bucket.take(now) if member.bucket is not None else 0
+        if route.host_rate:
+            key = (member.host, member.port, host)
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if self._buckets:
+                    self._evict(now)
+                bucket = self._buckets[key] = TokenBucket(route.host_rate, route.host_burst, now)
+            else:
+                self._buckets.move_to_end(key)
+            host_wait = bucket.take(now)
+            if host_wait > wait:
+                wait = host_wait
+        if wait > 0:
+            self.delayed += 1
+            self.delay_time += wait
+        return wait
+
+    def _evict(self, now):
+        for _ in range(2):
+            key = next(iter(self._buckets))
+            if len(self._buckets) < self.max_buckets and not self._buckets[key].full(now):
+                break
+            del self._buckets[key]
+            self.evicted += 1
+            if not self._buckets:
+                break
+
+    def stats(self):
+        return {'buckets': len(self._buckets),
+                'delayed': self.delayed,
+                'delay_time': self.delay_time,
+                'rejected': self.rejected,
+                'evicted': self.evicted,
+                }
+
+
+rate_scheduler = RateScheduler(max_buckets=CONFIG.get('Server', {}).get('Rate_Max_Buckets', 100000))
@@ -0,0 +1,143 @@
+import asyncio
+import logging
+
+from errors import ErrorOnStream
+
+logger = logging.getLogger(__name__)
+
+
+class RelayProtocol(asyncio.Protocol):
+    """One side of a relay, writes everything it receives to the other side
+
+    Backpressure comes from the transports: when the other side's write buffer
+    fills up, reading from this side is paused until it has drained.
+
+    :param relay: The :class:`Relay` this side belongs to
+    :param on_first_data:
+        (optional) Called with the first chunk of data, may raise to abort the relay
+    """
+    def __init__(self, relay, on_first_data=None):
+        self.relay = relay
+        self.peer = None
+        self.transport = None
+        self.bytes = 0
+        self.eof = False
+        self.buffered = None
+        self._on_first_data = on_first_data
+
+    def data_received(self, data):
+        if self._on_first_data is not None:
+            on_first_data, self._on_first_data = self._on_first_data, None
+            try:
+                on_first_data(data)
+            except Exception as e:
+                self.relay.abort(e)
+                return
+
+        self.bytes += len(data)
+        self.relay.deadline.touch()
+        self.peer.transport.write(data)
+
+    def eof_received(self):
+        self.eof = True
+        if self.peer.transport.can_write_eof():
+            self.peer.transport.write_eof()
+        else:
+            self.peer.transport.close()
+        self.relay.check_done()
+        # Keep the transport open so the other direction can finish, TLS transports close on EOF either way
+        return self.transport.get_extra_info('sslcontext') is None
+
+    def connection_lost(self, exc):
+        self.eof = True
+        if exc is not None:
+            self.relay.abort(exc)
+        else:
+            self.relay.finish()
+
+    # Called when the transport that this side *writes to* is full / drained.
+    # This side writes to the peer's transport, so the peer decides when this
+    # side has to stop reading.
+    def pause_writing(self):
+        self.peer.transport.pause_reading()
+
+    def resume_writing(self):
+        self.peer.transport.resume_reading()
+
+
+class Relay:
+    """Relay data between the client and the proxy using `asyncio.Protocol`s
+
+    Once the request has been sent to the proxy, the protocols on both
+    transports are swapped for :class:`RelayProtocol`s, so each chunk is
+    written straight to the other side from `data_received` without going
+    through a StreamReader, a task and a timer.
+
+    :param deadline:
+        The :class:`timeouts.Deadline` of the request, touched as data moves,
+        the relay is aborted once it expires
+    """
+    def __init__(self, client_reader, client_writer, proxy_reader, proxy_writer,
+                 deadline, on_response=None, loop=None):
+        self._loop = loop or asyncio.get_event_loop()
+        self._done = self._loop.create_future()
+        self.deadline = deadline
+        deadline.on_expire = lambda: self.abort(asyncio.TimeoutError())
+
+        self.client = RelayProtocol(self)
+        self.proxy = RelayProtocol(self, on_first_data=on_response)
+        self.client.peer, self.proxy.peer = self.proxy, self.client
+        self._attach(self.client, client_reader, client_writer)
+        self._attach(self.proxy, proxy_reader, proxy_writer)
+
+    @property
+    def bytes_up(self):
+        return self.client.bytes
+
+    @property
+    def bytes_down(self):
+        return self.proxy.bytes
+
+    def _attach(self, protocol, reader, writer):
+        protocol.transport = writer.transport
+        # Take over anything the StreamReader already has buffered
+        protocol.buffered = bytes(reader._buffer)
+        reader._buffer.clear()
+        protocol.eof = reader.at_eof()
+        writer.transport.set_protocol(protocol)
+
+    async def run(self):
+        """Relay until both sides are done
+
+        Raises:
+            ErrorOnStream -- If a side timed out or the connection broke
+
+        Returns:
+            tuple -- (bytes from the client, bytes from the proxy)
+        """
+        for protocol in (self.client, self.proxy):
+            buffered, protocol.buffered = protocol.buffered, None
+            if buffered:
+                protocol.data_received(buffered)
+            if protocol.eof:
+                protocol.eof_received()
+            protocol.transport.resume_reading()
+
+        await self._done
+        return self.bytes_up, self.bytes_down
+
+    def check_done(self):
+        if self.client.eof and self.proxy.eof:
+            self.finish()
+
+    def finish(self):
+        if not self._done.done():
+            self._done.set_result(None)
+
+    def abort(self, exc):
+        for protocol in (self.client, self.proxy):
+            protocol.transport.abort()
+        if not self._done.done():
+            if not isinstance(exc, ErrorOnStream):
+                exc = ErrorOnStream(exc)
+            self._done.set_exception(exc)
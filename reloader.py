@@ -0,0 +1,302 @@
+import re
+import copy
+import time
+import yaml
+import asyncio
+import logging
+import sqlite3
+import threading
+
+import workers
+from config import CONFIG, CONFIG_FILE, read_config
+from pools import pool_table
+from routing import rule_table, rule_rows, check_rule
+from proxylist import check_proxy
+from resolver import dns_cache
+from utils import DB_FILE
+
+logger = logging.getLogger(__name__)
+
+
+class ConfigReloader:
+    """Swaps in new `Pools` and `Rules` while the servers keep running
+
+    The new pools and rules are built in another thread, so requests are not
+    held up while thousands of proxies or rules are set up. Once they are
+    ready they replace the old ones in one step on the event loop. Requests
+    that already have a proxy keep it until they are done, so open tunnels
+    are not dropped. Only the `Pools` and `Rules` sections are reloaded,
+    changes to `Server` still need a restart.
+
+    With several workers the main process saves the config to the database
+    and sends it to each worker, which builds and swaps in its own copy.
+
+    :param str path: The yaml config file, read again by `reload_file`
+    :param dict pool_options: (optional) Keyword arguments for `pools.PoolTable.build`
+    """
+    def __init__(self, path, pool_options=None):
+        self.path = path
+        self.config = {'Pools': [], 'Rules': []}
+        self.pool_options = pool_options or {}
+        self.servers = {}  # Port -> server.Server listening in this process
+        self.reloads = 0
+        self.lock = asyncio.Lock()  # Held while a change to the config is made and applied
+        self._make_server = None
+        self._generation = 0
+        self._save_lock = threading.Lock()  # Saves run in other threads, only one writes at a time
+
+    def load(self, config):
+        """Build and use the pools and rules right away, for when the loop is not running yet"""
+        started = time.monotonic()
+        config = self._sections(config)
+        built = self._build(config)
+        self._save(built[0], built[1], self._generation)
+        self._swap(config, built)
+        self._log_loaded('Loaded config', started)
+
+    async def apply(self, config, primary=True, loop=None):
+        """Build the pools and rules in another thread and start using them
+
+        Arguments:
+            config {dict} -- A config with `Pools` and `Rules` sections
+
+        Keyword Arguments:
+            primary {bool} -- If this is the main process, which saves the config to the
+                              database and sends it to the workers (default: {True})
+
+        Raises:
+            ValueError -- The config is not valid or could not be saved, the old one is still used
+        """
+        loop = loop or asyncio.get_event_loop()
+        started = time.monotonic()
+        config = self._sections(config)
+        self._generation += 1
+        generation = self._generation
+        built = await loop.run_in_executor(None, self._build, config)
+        if primary:
+            await loop.run_in_executor(None, self._save, built[0], built[1], generation)
+        if generation != self._generation:
+            return  # A newer config was applied while this one was being built or saved
+        old_hosts = {member.host for pool in pool_table for member in pool.members}
+        self._swap(config, built)
+        self.reloads += 1
+        await self._update_listeners()
+
+        new_hosts = {member.host for pool in pool_table for member in pool.members} - old_hosts
+        if new_hosts:
+            asyncio.ensure_future(dns_cache.preload(new_hosts))
+        if primary and workers.worker_pool is not None:
+            workers.worker_pool.reload(config)
+        self._log_loaded('Reloaded config', started)
+
+    async def reload_file(self):
+        """Read the config file again and apply it
+
+        Raises:
+            ValueError -- The file could not be read or is not valid, the old config is still used
+        """
+        async with self.lock:
+            try:
+                config = read_config(self.path)
+            except (OSError, yaml.YAMLError) as e:
+                raise ValueError(f'Could not read {self.path}; Error: {e!r}') from e
+            await self.apply(config)
+
+    async def add_proxy(self, pool_name, proxy):
+        """Add a proxy to a pool
+
+        Arguments:
+            pool_name {str} -- Name of the pool
+            proxy {dict} -- The proxy, written like one in the `Proxies` of a pool in the config
+
+        Raises:
+            LookupError -- There is no such pool
+            ValueError -- The proxy is not valid
+        """
+        check_proxy(proxy)
+        async with self.lock:
+            config = copy.deepcopy(self.config)
+            self._find_pool(config, pool_name).setdefault('Proxies', []).append(proxy)
+            await self.apply(config)
+
+    async def remove_proxy(self, pool_name, host, port):
+        """Remove a proxy from a pool
+
+        Only proxies in the `Proxies` of the pool can be removed, the ones read
+        from its `Proxy_File` have to be taken out of the file, which is then
+        reloaded.
+
+        Raises:
+            LookupError -- There is no such pool, or the proxy is not in it
+            ValueError -- The proxy is from the pool's `Proxy_File`
+        """
+        async with self.lock:
+            config = copy.deepcopy(self.config)
+            pool_config = self._find_pool(config, pool_name)
+            proxies = [proxy for proxy in pool_config.get('Proxies') or []
+                       if (proxy['Host'], int(proxy.get('Port', 80))) != (host, port)]
+            if len(proxies) == len(pool_config.get('Proxies') or []):
+                pool = pool_table[pool_name] if pool_name in pool_table else None
+                if pool is not None and any((m.host, m.port) == (host, port) for m in pool.members):
+                    raise ValueError(f"Proxy {host}:{port} is from the Proxy_File of pool `{pool_name}`, "
+                                     f"remove it from {pool_config.get('Proxy_File')} and reload instead")
+                raise LookupError(f'No proxy {host}:{port} in pool `{pool_name}`')
+            pool_config['Proxies'] = proxies
+            await self.apply(config)
+
+    async def set_rule(self, rule):
+        """Add a rule, or replace the rule with the same `Name`
+
+        Arguments:
+            rule {dict} -- The rule, written like one in the `Rules` of the config
+
+        Raises:
+            ValueError -- The rule is not valid
+        """
+        check_rule(rule)
+        async with self.lock:
+            config = copy.deepcopy(self.config)
+            rules = config['Rules']
+            for i, existing in enumerate(rules):
+                if existing['Name'] == rule['Name']:
+                    rules[i] = rule
+                    break
+            else:
+                rules.append(rule)
+            await self.apply(config)
+
+    async def remove_rule(self, name):
+        """Remove the rule with the `Name`
+
+        Raises:
+            LookupError -- There is no such rule
+        """
+        async with self.lock:
+            config = copy.deepcopy(self.config)
+            rules = [rule for rule in config['Rules'] if rule['Name'] != name]
+            if len(rules) == len(config['Rules']):
+                raise LookupError(f'No rule `{name}`')
+            config['Rules'] = rules
+            await self.apply(config)
+
+    def listen(self, make_server):
+        """Start a server on the port of each rule, and on the new ports of every reload
+
+        Arguments:
+            make_server {callable} -- Called with a port, returns a `server.Server` for it
+        """
+        self._make_server = make_server
+        for port in sorted(self._ports()):
+            server = make_server(port)
+            server.start()
+            self.servers[port] = server
+
+    def stop(self):
+        for server in self.servers.values():
+            server.stop()
+        self.servers = {}
+
+    def _sections(self, config):
+        if not isinstance(config, dict):
+            raise ValueError('The config must be a mapping')
+        return {'Pools': config.get('Pools') or [], 'Rules': config.get('Rules') or []}
+
+    def _ports(self):
+        return {int(rule['Port']) for rule in self.config['Rules']}
+
+    def _find_pool(self, config, pool_name):
+        for pool_config in config['Pools']:
+            if pool_config['Name'] == pool_name:
+                return pool_config
+        raise LookupError(f'No pool `{pool_name}`')
+
+    def _log_loaded(self, what, started):
+        proxies = sum(len(pool) for pool in pool_table)
+        logger.info(f"{what}; pools={len(self.config['Pools'])}; proxies={proxies}; "
+                    f"rules={len(self.config['Rules'])}; ports={sorted(self._ports())}; "
+                    f"seconds={time.monotonic() - started:.3f};")
+
+    def _build(self, config):
+        """Everything that takes time, none of it is used by requests until `_swap`"""
+        try:
+            pools = pool_table.build(config['Pools'], **self.pool_options)
+            rows = rule_rows(config['Rules'])
+            routes = rule_table.compile(rows)
+        except (KeyError, TypeError, AttributeError, re.error) as e:
+            # Missing keys, wrong types and bad regexes are all mistakes in the config
+            raise ValueError(f'Invalid config; Error: {e!r}') from e
+        except OSError as e:
+            raise ValueError(f'Could not read a proxy file; Error: {e!r}') from e
+
+        for row in rows:
+            for name in row['pool'].split(','):
+                if name not in pools:
+                    raise ValueError(f"Rule `{row['rule']}` uses pool `{name}` which does not exist")
+        return pools, rows, routes
+
+    def _swap(self, config, built):
+        pools, rows, routes = built
+        pool_table.swap(pools)
+        rule_table.swap(routes)
+        self.config = config
+
+    def _save(self, pools, rows, generation):
+        """Replace the proxies and rules in the database, which the api reads from
+
+        Runs in another thread with its own connection. Everything is written
+        in one transaction, so it is only synced to disk once, and readers see
+        either the old or the new config. Nothing is written if a newer config
+        came in meanwhile, so an older save can not land after a newer one.
+
+        Raises:
+            ValueError -- The database could not be written, the config should not be used
+        """
+        with self._save_lock:
+            if generation != self._generation:
+                return
+            try:
+                self._write(pools, rows)
+            except sqlite3.Error as e:
+                raise ValueError(f'Could not save the config to the database; Error: {e!r}') from e
+
+    def _write(self, pools, rows):
+        conn = sqlite3.connect(DB_FILE)
+        try:
+            with conn:
+                conn.execute("DELETE FROM proxy")
+                conn.execute("DELETE FROM pool_rule")
+                conn.executemany("INSERT INTO proxy (host, username, password, port, types, pool) "
+                                 "VALUES (?,?,?,?,?,?)",
+                                 ((member.host, member.username, member.password, member.port,
+                                   ','.join(sorted(member.types)).lower(), pool.name)
+                                  for pool in pools.values() for member in pool.members))
+                conn.executemany("""INSERT INTO pool_rule (pool, port, rank, rule, rule_re, rule_type,
+                                                          host_rate, host_burst)
+                                    VALUES (:pool, :port, :rank, :rule, :rule_re, :rule_type,
+                                            :host_rate, :host_burst)""", rows)
+        finally:
+            conn.close()
+
+    async def _update_listeners(self):
+        if self._make_server is None:
+            return  # The servers run in the workers
+        ports = self._ports()
+        for port in sorted(ports - set(self.servers)):
+            server = self._make_server(port)
+            try:
+                await server.listen()
+            except OSError as e:
+                logger.error(f'Could not listen on port={port}; Error: {e!r}')
+                continue
+            self.servers[port] = server
+        for port in set(self.servers) - ports:
+            self.servers.pop(port).close()
+
+
+_server_config = CONFIG.get('Server', {})
+config_reloader = ConfigReloader(CONFIG_FILE,
+                                 pool_options={'breaker_threshold': _server_config.get('Breaker_Threshold', 5),
+                                               'breaker_cooldown': _server_config.get('Breaker_Cooldown', 30),
+                                               'max_per_proxy': _server_config.get('Max_Connections_Per_Proxy', 0),
+                                               'queue_size': _server_config.get('Queue_Size', 100),
+                                               })
@@ -0,0 +1,141 @@
+import time
+import socket
+import asyncio
+import logging
+import ipaddress
+
+from config import CONFIG
+
+logger = logging.getLogger(__name__)
+
+
+class DnsEntry:
+    """The addresses a hostname resolved to, handed out in turn"""
+    __slots__ = ('addresses', 'expires', 'error', '_next')
+
+    def __init__(self, addresses, ttl, error=None):
+        self.addresses = addresses
+        self.expires = time.monotonic() + ttl
+        self.error = error  # Why the lookup failed, when there are no addresses
+        self._next = 0
+
+    def ordered(self):
+        """Every address, starting with the next one in turn"""
+        start = self._next % len(self.addresses)
+        self._next += 1
+        return self.addresses[start:] + self.addresses[:start]
+
+
+class DnsCache:
+    """Resolved addresses of the proxies, so requests do not wait on `getaddrinfo`
+
+    `getaddrinfo` runs in the default executor, which is easy to fill up when
+    every request does a lookup. A hostname is only looked up the first time
+    it is used; after `ttl` seconds the cached addresses are still used while
+    a lookup runs in the background to refresh them. A failed lookup is only
+    used for `error_ttl` seconds, after that the next request waits for a new
+    one. When a name has several addresses each connection starts with the
+    next one, and moves on to the others when it can not connect.
+
+    :param int ttl: (optional) Seconds before the addresses of a hostname are looked up again
+    :param int error_ttl: (optional) Seconds a failed lookup is remembered for
+    """
+    def __init__(self, ttl=300, error_ttl=5):
+        self.ttl = ttl
+        self.error_ttl = error_ttl
+        self._entries = {}  # Hostname -> DnsEntry
+        self._pending = {}  # Hostname -> Task of a lookup in progress
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.errors = 0
+
+    async def resolve(self, host):
+        """An address to connect to for the host
+
+        Raises:
+            OSError -- If the host could not be resolved
+        """
+        return (await self.resolve_all(host))[0]
+
+    async def resolve_all(self, host):
+        """Every address of the host, each call starts with the next one in turn
+
+        Raises:
+            OSError -- If the host could not be resolved
+
+        Returns:
+            list -- The addresses in the order to try them, the first one that connects is used
+        """
+        entry = self._entries.get(host)
+        if entry is None or not entry.addresses and time.monotonic() >= entry.expires:
+            # An old failure is not worth using, the name may resolve again by now
+            self.misses += 1
+            entry = await self._lookup(host)
+        else:
+            self.hits += 1
+            if time.monotonic() >= entry.expires and host not in self._pending:
+                # Use the addresses we have while they are refreshed
+                self.refreshes += 1
+                self._start_lookup(host)
+
+        if not entry.addresses:
+            raise OSError(f'Could not resolve {host}: {entry.error}')
+        return entry.ordered()
+
+    async def preload(self, hosts):
+        """Look up every host up front, so the first requests do not have to"""
+        entries = await asyncio.gather(*[self._lookup(host) for host in set(hosts)])
+        failed = sum(1 for entry in entries if not entry.addresses)
+        logger.info(f"Resolved {len(entries) - failed} proxy hostnames; failed={failed};")
+
+    def _lookup(self, host):
+        task = self._pending.get(host)
+        if task is None:
+            task = self._start_lookup(host)
+        # Other requests may be waiting on the same lookup, do not cancel it with this one
+        return asyncio.shield(task)
+
+    def _start_lookup(self, host):
+        task = self._pending[host] = asyncio.ensure_future(self._query(host))
+        task.add_done_callback(lambda _: self._pending.pop(host, None))
+        return task
+
+    async def _query(self, host):
+        try:
+            ipaddress.ip_address(host)
+        except ValueError:
+            pass
+        else:
+            # Already an address, never needs to be looked up again
+            entry = self._entries[host] = DnsEntry([host], float('inf'))
+            return entry
+
+        try:
+            infos = await asyncio.get_event_loop().getaddrinfo(host, None, type=socket.SOCK_STREAM)
+        except OSError as e:
+            self.errors += 1
+            logger.warning(f"Failed to resolve host={host}; Error: {e!r}")
+            entry = self._entries.get(host)
+            if entry is not None and entry.addresses:
+                # Keep using the old addresses, they are better than nothing
+                entry.expires = time.monotonic() + self.error_ttl
+                return entry
+            entry = DnsEntry((), self.error_ttl, error=e)
+        else:
+            entry = DnsEntry(list(dict.fromkeys(info[4][0] for info in infos)), self.ttl)
+
+        self._entries[host] = entry
+        return entry
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'refreshes': self.refreshes,
+                'errors': self.errors,
+                'hosts': len(self._entries),
+                }
+
+
+dns_cache = DnsCache(ttl=CONFIG.get('Server', {}).get('Dns_Ttl', 300),
+                     error_ttl=CONFIG.get('Server', {}).get('Dns_Error_Ttl', 5))
@@ -0,0 +1,304 @@
+import re
+import logging
+import sqlite3
+from collections import OrderedDict
+
+from config import CONFIG
+from utils import db_conn
+
+logger = logging.getLogger(__name__)
+
+_NO_MATCH = object()  # Cached result for hosts that match no rule
+_NO_RANK = float('inf')
+
+# A domain with escaped dots (`httpbin\.org`), a bare `.` is a regex wildcard so it is not a literal
+_LITERAL_RE = re.compile(r'^(?:[A-Za-z0-9_-]+\\\.)*[A-Za-z0-9_-]+$')
+# Rules that `re.search` matches against any host, even an empty one
+_ANY_RULES = {'', '.*', '^.*', '.*$', '^.*$'}
+_DOMAIN_PREFIX = '(.*\\.)?'
+_SUFFIX_PREFIX = '.*\\.'
+
+
+class Route:
+    """Where a rule sends the hosts it matches
+
+    :param str pools: Comma separated pool names in the order to try them
+    :param float host_rate: (optional) Requests a second each proxy can send to one host, None for no limit
+    :param float host_burst: (optional) Requests each proxy can send to one host at once
+    """
+    __slots__ = ('pools', 'pool_names', 'host_rate', 'host_burst')
+
+    def __init__(self, pools, host_rate=None, host_burst=None):
+        self.pools = pools
+        self.pool_names = pools.split(',')
+        self.host_rate = host_rate
+        self.host_burst = host_burst
+
+    def __repr__(self):
+        return f'<Route pools={self.pools} host_rate={self.host_rate}>'
+
+
+def classify_rule(rule_re):
+    """Work out if a rule can be served from the domain index
+
+    Only rules where the index gives exactly the same answer as `re.search`
+    are indexed, which means they have to be anchored at both ends. A rule
+    like `google` is left as a regex, since it also matches `www.google.com`
+    and `google.com.au`.
+
+    - `^(.*\\.)?httpbin\\.org$`: The domain and any subdomain
+    - `^.*\\.example\\.com$`: Only subdomains of example.com
+    - `^httpbin\\.org$`: Only that exact domain
+    - `.*`: Every host
+
+    Arguments:
+        rule_re {str} -- The rule as written in the config
+
+    Returns:
+        tuple -- (rule_type, domain), domain is None for `regex` rules
+    """
+    if rule_re in _ANY_RULES:
+        return 'domain', ''
+    if not (rule_re.startswith('^') and rule_re.endswith('$')):
+        return 'regex', None
+
+    rule = rule_re[1:-1]
+    rule_type = 'exact'
+    if rule.startswith(_DOMAIN_PREFIX):
+        rule = rule[len(_DOMAIN_PREFIX):]
+        rule_type = 'domain'
+    elif rule.startswith(_SUFFIX_PREFIX):
+        rule = rule[len(_SUFFIX_PREFIX):]
+        rule_type = 'suffix'
+
+    if not _LITERAL_RE.match(rule):
+        return 'regex', None
+    # Not lowercased, the regex would be case sensitive as well
+    return rule_type, rule.replace('\\.', '.')
+
+
+def _is_number(val):
+    return isinstance(val, (int, float)) and not isinstance(val, bool)
+
+
+def check_rule(rule):
+    """Make sure a rule from the config is written the way `rule_rows` needs
+
+    Arguments:
+        rule {dict} -- A rule, written like one in the `Rules` of the config
+
+    Raises:
+        ValueError -- Something in the rule is missing or the wrong type
+    """
+    if not isinstance(rule, dict):
+        raise ValueError('A rule must be a mapping')
+    name = rule.get('Name')
+    if not isinstance(name, str) or not name:
+        raise ValueError('A rule needs a `Name`')
+    port = rule.get('Port')
+    if not isinstance(port, int) or isinstance(port, bool) or not 0 < port < 65536:
+        raise ValueError(f'`Port` of rule `{name}` must be a port number')
+    for key in ('Domains', 'Pools'):
+        values = rule.get(key)
+        if not isinstance(values, list) or not values or not all(isinstance(val, str) for val in values):
+            raise ValueError(f'`{key}` of rule `{name}` must be a list of strings')
+    if any(',' in pool for pool in rule['Pools']):
+        raise ValueError(f'`Pools` of rule `{name}` can not have a `,` in a name')
+    for key in ('Host_Rate_Limit', 'Host_Rate_Burst'):
+        if rule.get(key) is not None and not _is_number(rule[key]):
+            raise ValueError(f'`{key}` of rule `{name}` must be a number')
+
+
+def rule_rows(rules_config):
+    """The rows of the `pool_rule` table for the `Rules` section of the config
+
+    Each domain of a rule gets its own row, ranked in the order they are written.
+
+    Arguments:
+        rules_config {list} -- The `Rules` section of the config
+
+    Raises:
+        ValueError -- A rule is not written right, see `check_rule`
+
+    Returns:
+        list -- A dict for each row, sorted by rank
+    """
+    rows = []
+    for rule_rank, rule in enumerate(rules_config):
+        check_rule(rule)
+        rule_pools = ','.join(rule['Pools'])
+        for re_rank, re_rule in enumerate(rule['Domains']):
+            rule_type, _ = classify_rule(re_rule)
+            rows.append({'pool': rule_pools,
+                         'port': int(rule['Port']),
+                         'rank': rule_rank + (re_rank / 100),
+                         'rule': rule['Name'],
+                         'rule_re': re_rule,
+                         'rule_type': rule_type,
+                         'host_rate': rule.get('Host_Rate_Limit'),
+                         'host_burst': rule.get('Host_Rate_Burst'),
+                         })
+    rows.sort(key=lambda row: row['rank'])
+    return rows
+
+
+class RuleTable:
+    """In memory, compiled copy of the `pool_rule` table.
+
+    The rules for every port are read from the database and compiled once
+    when `load` is called. Each host that gets routed is remembered in a
+    bounded LRU cache so a repeat lookup is a single dict hit instead of a
+    database query plus a regex scan over every rule.
+
+    Domain and suffix rules are kept in a hash index keyed by the domain, so a
+    lookup only costs one dict hit per label in the host no matter how many
+    rules there are. Only `regex` rules are scanned, and only the ones ranked
+    above the best domain match.
+
+    :param int cache_size:
+        (optional) Max number of (port, host) matches to keep in the cache
+    """
+    def __init__(self, cache_size=10000):
+        self.cache_size = cache_size
+        self._pools = {}
+        self._domains = {}
+        self._regexes = {}
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, port=None):
+        """Read and compile the rules from the database
+
+        Keyword Arguments:
+            port {int} -- Only reload the rules for this port (default: {None})
+        """
+        sql = "SELECT pool, port, rule_re, rule_type, host_rate, host_burst FROM pool_rule ORDER BY rank ASC"
+        params = ()
+        if port is not None:
+            sql = ("SELECT pool, port, rule_re, rule_type, host_rate, host_burst FROM pool_rule "
+                   "WHERE port=? ORDER BY rank ASC")
+            params = (port,)
+
+        rows = []
+        try:
+            with db_conn:
+                cur = db_conn.cursor()
+                cur.execute(sql, params)
+                rows = cur.fetchall()
+
+        except sqlite3.IntegrityError:
+            logger.critical("Failed to select rules from the db")
+
+        pools, domains, regexes = self.compile(rows)
+        if port is not None:
+            pools = {**self._pools, port: pools.get(port, [])}
+            domains = {**self._domains, port: domains.get(port, {})}
+            regexes = {**self._regexes, port: regexes.get(port, [])}
+        self.swap((pools, domains, regexes))
+        logger.info(f"Loaded {len(rows)} rules for {len(pools)} port(s)")
+
+    def compile(self, rows):
+        """Compile rows of the `pool_rule` table, without using them yet
+
+        Nothing that requests use is changed, so this can run in another thread
+        while requests are being handled.
+
+        Arguments:
+            rows {list} -- The rows, sorted by rank
+
+        Raises:
+            re.error -- A rule is not a valid regex
+
+        Returns:
+            tuple -- The compiled rules, to pass to `swap`
+        """
+        pools, domains, regexes = {}, {}, {}
+        for row in rows:
+            port_pools = pools.setdefault(row['port'], [])
+            rank = len(port_pools)  # Rows are already sorted by rank
+            port_pools.append(Route(row['pool'], row['host_rate'], row['host_burst']))
+
+            rule_type, domain = 'regex', None
+            if row['rule_type'] != 'regex':
+                rule_type, domain = classify_rule(row['rule_re'])
+
+            if rule_type == 'regex':
+                regexes.setdefault(row['port'], []).append((rank, re.compile(row['rule_re'])))
+                continue
+
+            # [rank when the host is the domain, rank when the host is a subdomain]
+            entry = domains.setdefault(row['port'], {}).setdefault(domain, [_NO_RANK, _NO_RANK])
+            if rule_type in ('domain', 'exact'):
+                entry[0] = min(entry[0], rank)
+            if rule_type in ('domain', 'suffix'):
+                entry[1] = min(entry[1], rank)
+        return pools, domains, regexes
+
+    def swap(self, compiled):
+        """Start routing with the rules made by `compile`
+
+        Requests that have already been routed keep the `Route` they got.
+        """
+        self._pools, self._domains, self._regexes = compiled
+        self._cache.clear()
+
+    def match(self, host, port):
+        """Find the pools for the first rule that matches the host
+
+        Arguments:
+            host {str} -- The host the client is requesting
+            port {int} -- The port the client connected to
+
+        Returns:
+            Route -- Where to send the host, None if no rule matched
+        """
+        key = (port, host)
+        pools = self._cache.get(key)
+        if pools is not None:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return None if pools is _NO_MATCH else pools
+
+        self.misses += 1
+        pools = _NO_MATCH
+        rank = self._match_rank(host, port)
+        if rank is not None:
+            pools = self._pools[port][rank]
+
+        self._cache[key] = pools
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+        return None if pools is _NO_MATCH else pools
+
+    def _match_rank(self, host, port):
+        best = _NO_RANK
+        index = self._domains.get(port)
+        if index:
+            domain = host
+            entry = index.get(domain)
+            if entry is not None:
+                best = entry[0]
+
+            # Walk up each parent domain, ending with '' which matches any host
+            dot = 0
+            while dot != -1:
+                dot = domain.find('.', dot)
+                parent = domain[dot + 1:] if dot != -1 else ''
+                entry = index.get(parent)
+                if entry is not None and entry[1] < best:
+                    best = entry[1]
+                if dot != -1:
+                    dot += 1
+
+        for rank, rule_re in self._regexes.get(port, ()):
+            if rank >= best:
+                break
+            if rule_re.search(host):
+                return rank
+
+        return None if best == _NO_RANK else best
+
+
+rule_table = RuleTable(cache_size=CONFIG.get('Server', {}).get('Route_Cache_Size', 10000))
@@ -1,62 +1,99 @@
+import signal
 import asyncio
-import sqlite3
 import logging
 
 # Local
 import api
 from config import CONFIG
 from server import Server
-from utils import db_conn
+from pools import pool_table
+from connpool import connection_pools
+from health import HealthChecker
+from resolver import dns_cache
+import workers
+from reloader import config_reloader
 
 
 logger = logging.getLogger(__name__)
 
-# Add proxies to the database
-for pool_rank, pool in enumerate(CONFIG.get('Pools', [])):
-    for proxy in pool['Proxies']:
-        try:
-            with db_conn:
-                db_conn.execute("INSERT INTO proxy (host, username, password, port, types, pool) VALUES (?,?,?,?,?,?)",
-                                (proxy['Host'],
-                                 proxy.get('User'),
-                                 proxy.get('Pass'),
-                                 int(proxy.get('Port', 80)),
-                                 ','.join(proxy.get('types', ('HTTP', 'HTTPS'))),
-                                 pool['Name']))
-        except sqlite3.IntegrityError:
-            logger.critical("Failed to save proxy to database")
-
-server_ports = set()
-# Parse the rules in the config
-for rule_rank, rule in enumerate(CONFIG['Rules']):
-    rule_pools = ','.join(rule['Pools'])
-    server_ports.add(rule['Port'])
-
-    # Add rule to db
-    for re_rank, re_rule in enumerate(rule['Domains']):
-        logger.debug(f"Save rule to the database. rule={rule['Name']}; re_rule={re_rule}; pool={rule_pools};")
-        rank = rule_rank + (re_rank / 100)
-        try:
-            with db_conn:
-                db_conn.execute("""INSERT INTO pool_rule (pool, port, rank, rule, rule_re, rule_type)
-                                   VALUES (?,?,?,?,?,?)""",
-                                (rule_pools, rule['Port'], rank, rule['Name'], re_rule, 'domain'))
-        except sqlite3.IntegrityError:
-            logger.critical("Failed to save rules to database")
+# Proxies and rules are picked from memory, the database is only used by the api
+config_reloader.load(CONFIG)
+
+if CONFIG['Server'].get('Dns_Preload', True):
+    # Before the workers are forked, so they all start with the addresses
+    asyncio.get_event_loop().run_until_complete(
+        dns_cache.preload(member.host for pool in pool_table for member in pool.members))
+
+
+def make_server(port, loop=None, reuse_port=False):
+    return Server(CONFIG['Server'].get('Host', '0.0.0.0'), port,
+                  connect_timeout=CONFIG['Server'].get('Connect_Timeout', 30),
+                  header_timeout=CONFIG['Server'].get('Header_Timeout', 30),
+                  idle_timeout=CONFIG['Server'].get('Idle_Timeout', 30),
+                  lifetime_timeout=CONFIG['Server'].get('Lifetime_Timeout', 0),
+                  buffer_size=CONFIG['Server'].get('Buffer_Size', 65536),
+                  relay=CONFIG['Server'].get('Relay', 'stream'),
+                  reuse_port=reuse_port,
+                  retries=CONFIG['Server'].get('Connect_Retries', 2),
+                  hedge_percentile=CONFIG['Server'].get('Hedge_Percentile', 0),
+                  max_header_size=CONFIG['Server'].get('Max_Header_Size', 65536),
+                  max_connections=CONFIG['Server'].get('Max_Connections', 0),
+                  queue_size=CONFIG['Server'].get('Queue_Size', 100),
+                  session_header=CONFIG['Server'].get('Session_Header', 'X-Proxy-Session'),
+                  queue_timeout=CONFIG['Server'].get('Queue_Timeout', 5),
+                  loop=loop)
+
+
+def start_servers(loop=None, reuse_port=False):
+    # A server for the port of each rule, ports added by a reload get one too
+    config_reloader.listen(lambda port: make_server(port, loop, reuse_port))
+    server_pool_list = [config_reloader]
+
+    # Each process ejects proxies from its own copy of the pools, so each one checks them
+    if CONFIG['Server'].get('Health_Check_Interval', 0) > 0:
+        health_checker = HealthChecker(pool_table,
+                                       interval=CONFIG['Server']['Health_Check_Interval'],
+                                       timeout=CONFIG['Server'].get('Health_Check_Timeout', 5),
+                                       url=CONFIG['Server'].get('Health_Check_Url'),
+                                       concurrency=CONFIG['Server'].get('Health_Check_Concurrency', 100),
+                                       loop=loop)
+        health_checker.start()
+        server_pool_list.append(health_checker)
+    return server_pool_list
+
+
+async def reload_file():
+    try:
+        await config_reloader.reload_file()
+    except ValueError as e:
+        logger.error(f'Could not reload the config; Error: {e!r}')
+
+
+async def reload_worker(config):
+    try:
+        await config_reloader.apply(config, primary=False)
+    except ValueError as e:
+        logger.error(f'Could not reload the config in a worker; Error: {e!r}')
 
 
 server_pool_list = []
-# Add the server ports
-for port in server_ports:
-    server_pool_list.append(Server(CONFIG['Server'].get('Host', '0.0.0.0'), port))
+worker_count = CONFIG['Server'].get('Workers', 1)
+if worker_count > 1:
+    # The workers are forked before the api starts so they do not inherit its socket
+    workers.worker_pool = workers.WorkerPool(worker_count,
+                                             lambda loop: start_servers(loop, reuse_port=True),
+                                             interval=CONFIG['Server'].get('Stats_Interval', 1),
+                                             reload_worker=reload_worker)
+    workers.worker_pool.start()
+else:
+    server_pool_list = start_servers()
 
 # Start api server
 api.start_server(CONFIG['Server'].get('Host', '0.0.0.0'), CONFIG['Server'].get('API_Port', 8181))
 
-for server_pool in server_pool_list:
-    server_pool.start()
-
 loop = asyncio.get_event_loop()
+# `kill -HUP` reads the config file again
+loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.ensure_future(reload_file()))
 try:
     loop.run_forever()
 except KeyboardInterrupt:
@@ -65,3 +102,6 @@ except KeyboardInterrupt:
 logger.info('Servers shutting down.')
 for server_pool in server_pool_list:
     server_pool.stop()
+if workers.worker_pool is not None:
+    workers.worker_pool.stop()
+connection_pools.close()
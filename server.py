@@ -3,9 +3,15 @@ import asyncio
 import logging
 from config import CONFIG
 from proxy import get_proxy
+from pools import pool_table
+from relay import Relay
+from timeouts import timer_wheel
+from timing import RequestTiming, profiler
+import stats
+import admission
 from errors import (
-    BadStatusLine, BadResponseError, ErrorOnStream,
-    NoProxyError, ProxyRecvError, ProxyTimeoutError)
+    AdmissionError, BadStatusLine, BadResponseError, ErrorOnStream, NoProxyError, ProxyError,
+    ProxyConnError, ProxyRecvError, ProxySendError, ProxyTimeoutError)
 from utils import parse_headers, parse_status_line
 
 logger = logging.getLogger(__name__)
@@ -14,33 +20,80 @@ request_logger = logging.getLogger('proxy_request')
 global_requests = []
 
 CONNECTED = b'HTTP/1.1 200 Connection established\r\n\r\n'
+BAD_REQUEST = b'HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+HEADERS_TOO_LARGE = (b'HTTP/1.1 431 Request Header Fields Too Large\r\n'
+                     b'Content-Length: 0\r\nConnection: close\r\n\r\n')
+SERVICE_UNAVAILABLE = (b'HTTP/1.1 503 Service Unavailable\r\n'
+                       b'Content-Length: 0\r\nRetry-After: 1\r\nConnection: close\r\n\r\n')
+
+# Seconds to wait for `100 Continue` before sending the body of an `Expect: 100-continue` request anyway
+CONTINUE_TIMEOUT = 1
+# Largest request body kept to send again when a reused connection to a proxy turns out to be closed
+MAX_RESEND_BODY = 1024 * 1024
+
+# How data is relayed between the client and the proxy
+RELAYS = ('stream', 'protocol')
 
 
 class Server:
     """Server distributes incoming requests to its pool of proxies.
     Each instance of this calss is a 'pool' which has proxies.
-    TODOs:
-    - The pool should at all times have calculated stats about the proxies in its pool
-
+    The result of each request is fed into the running scores of the proxy
+    that handled it (see `pools.ProxyScore`).
     """
 
-    def __init__(self, host, port, timeout=30, loop=None):
+    def __init__(self, host, port, connect_timeout=30, header_timeout=30, idle_timeout=30, lifetime_timeout=0,
+                 buffer_size=65536, relay='stream', reuse_port=False, retries=2, hedge_percentile=0,
+                 max_header_size=65536, max_connections=0, queue_size=100, queue_timeout=5,
+                 session_header='X-Proxy-Session', loop=None):
+        if relay not in RELAYS:
+            raise ValueError(f'Unknown relay `{relay}`. Must be one of: {", ".join(RELAYS)}')
         self.host = host
         self.port = int(port)
         self._loop = loop or asyncio.get_event_loop()
-        self._timeout = timeout
+        self._connect_timeout = connect_timeout  # Seconds to connect to a proxy, and for its TLS handshake
+        self._header_timeout = header_timeout  # Seconds to read the head of a request or response
+        # Seconds a request is relayed for without any data either way, and in total, see `timeouts.TimerWheel`
+        self._idle_timeout = idle_timeout
+        self._lifetime_timeout = lifetime_timeout
+        self._buffer_size = buffer_size  # Max bytes read at a time when relaying
+        self._relay = relay
+        self._max_header_size = max_header_size  # Requests with a bigger head are turned away
+        self._reuse_port = reuse_port  # So several processes can listen on the same port
+        self._retries = retries  # Other proxies to try when one can not be connected to
+        # Recent connect times, a second proxy is raced once a connect takes longer than this percentile
+        self._connect_times = stats.RecentPercentile(hedge_percentile) if hedge_percentile else None
+        # Requests being handled at once, past that they wait up to `queue_timeout` and then get a 503
+        self._limit = admission.Limit(max_connections, queue_size)
+        self._queue_timeout = queue_timeout
+        admission.server_limits[self.port] = self._limit
+        # Header clients send to stick to a proxy, taken out of the request before it is sent on
+        self._session_header = session_header.title()
 
         self._server = None
         self._connections = {}
 
     def start(self):
-        srv = asyncio.start_server(
-            self._accept, host=self.host, port=self.port, loop=self._loop)
-        self._server = self._loop.run_until_complete(srv)
+        self._loop.run_until_complete(self.listen())
+
+    async def listen(self):
+        """Start accepting connections, the same as `start` but for when the loop is already running"""
+        self._server = await asyncio.start_server(
+            self._accept, host=self.host, port=self.port, reuse_port=self._reuse_port or None,
+            limit=self._max_header_size, loop=self._loop)
 
         logger.info('Listening established on {0}'.format(
             self._server.sockets[0].getsockname()))
 
+    def close(self):
+        """Stop accepting connections, the ones already open are left to finish"""
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+            logger.info(f'Stopped listening on port {self.port}')
+        if admission.server_limits.get(self.port) is self._limit:
+            del admission.server_limits[self.port]
+
     def stop(self):
         if not self._server:
             return
@@ -76,35 +129,144 @@ class Server:
         self._connections[f] = (client_reader, client_writer)
 
     async def _handle(self, client_reader, client_writer):
-        logger.debug(f"Accepted connection from {client_writer.get_extra_info('peername')}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Accepted connection from {client_writer.get_extra_info('peername')}")
+
+        # Keep-alive clients can send many requests, each one is routed on its own
+        while await self._handle_request(client_reader, client_writer):
+            pass
+
+    async def _handle_request(self, client_reader, client_writer):
+        """Read one request from the client and send it through a proxy
+
+        Returns:
+            bool -- True if the client connection can be used for another request
+        """
+        client = id(client_reader)
+        try:
+            request, headers, timing = await self._parse_request(client_reader)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, OSError) as e:
+            logger.debug(f'client: {client}; closed without sending a request; Error: {e!r}')
+            return False
+        except asyncio.LimitOverrunError:
+            logger.warning(f'client: {client}; request head is larger than {self._max_header_size} bytes')
+            client_writer.write(HEADERS_TOO_LARGE)
+            return False
+        except (BadStatusLine, ValueError) as e:
+            logger.warning(f'client: {client}; bad request; Error: {e!r}')
+            client_writer.write(BAD_REQUEST)
+            return False
+
+        session = headers.get(self._session_header)
+        if session is not None:
+            request = self._remove_header(request, self._session_header)
+        affinity = None
+        if pool_table.hashed:
+            affinity = {'client_ip': client_writer.get_extra_info('peername')[0],
+                        'host': headers['Host'],
+                        'session': session,
+                        }
 
         time_of_request = int(time.time())  # The time the request was requested
-        request, headers = await self._parse_request(client_reader)
-        scheme = self._identify_scheme(headers)
+        admitted = False
+        try:
+            if self._limit.max_active:
+                await self._admit(timing)
+                admitted = True
+            proxy, pool = await get_proxy(headers['Host'], self.port, timing=timing,
+                                          connect_timeout=self._connect_timeout,
+                                          queue_timeout=self._queue_timeout, affinity=affinity)
+            if proxy is None:
+                logger.warning(f"No proxy for client: {client}; host: {headers['Host']}")
+                return False
+            return await self._relay_request(client_reader, client_writer, proxy, pool, request, headers, timing,
+                                             affinity, time_of_request)
+        except AdmissionError as e:
+            logger.warning(f"Too busy for client: {client}; host: {headers['Host']}; Error: {e!r}")
+            client_writer.write(SERVICE_UNAVAILABLE)
+            return False
+        finally:
+            # Whatever happened, the slot is given back so it can not leak
+            if admitted:
+                self._limit.release()
+
+    async def _relay_request(self, client_reader, client_writer, proxy, pool, request, headers, timing, affinity,
+                             time_of_request):
+        """Send the request through the proxy, swapping it for another one if it fails before anything is sent
+
+        Arguments:
+            proxy {proxy.Proxy} -- The proxy picked for the request
+            pool {str} -- Name of the pool it was picked from
+            time_of_request {int} -- Unix time the request was read, for the request log
+
+        Returns:
+            bool -- True if the client connection can be used for another request
+        """
         client = id(client_reader)
+        scheme = self._identify_scheme(headers)
         error = None
-        stime = 0
-        proxy, pool = await get_proxy(headers['Host'], self.port)
-        proto = self._choice_proto(proxy, scheme)
-        logger.debug(f'client: {client}; request: {request}; headers: {headers}; '
-                     f'scheme: {scheme}; proxy: {proxy}; proto: {proto}')
+        proxy_failed = False
+        stime = 0  # `time.monotonic()` when the request started being relayed
+        stream = []
+        deadline = None
+        watch = profiler.watch(self._loop)
+        tried = set()  # Members that failed this request
+        retries = 0
+        hedged = False
+        reuse = False
+        keep_client = False
         try:
-            await proxy.connect()
+            # Nothing has been sent to the client until the request is sent, so up
+            # until then a failing proxy can be swapped for another one
+            while True:
+                try:
+                    proxy, pool, hedged = await self._connect(proxy, pool, scheme, headers, tried, affinity)
+                    proto = self._choice_proto(proxy, scheme)
+                    keep_alive = self._can_keep_alive(scheme, proto, headers)
+                    if not keep_alive and not (scheme == 'HTTPS' and proto in ('SOCKS4', 'SOCKS5')):
+                        await proxy.send(request)
+                    break
+                except (ProxyConnError, ProxyTimeoutError, ProxySendError) as e:
+                    if retries >= self._retries:
+                        raise
+                    next_proxy, next_pool = await get_proxy(headers['Host'], self.port,
+                                                            exclude=tried | {proxy.member}, timing=timing,
+                                                            connect_timeout=self._connect_timeout,
+                                                            affinity=affinity)
+                    if next_proxy is None:
+                        raise
+                    logger.warning(f"Retrying client: {client}; failed proxy: {proxy.host}:{proxy.port}; "
+                                   f"next proxy: {next_proxy.host}:{next_proxy.port}; Error: {e!r}")
+                    self._drop_proxy(proxy, tried, failed=True)
+                    proxy, pool = next_proxy, next_pool
+                    retries += 1
+
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"client: {client}; method: {headers.get('Method')}; host: {headers['Host']}; "
+                             f"scheme: {scheme}; proxy: {proxy}; proto: {proto}")
+
+            deadline = self._start_deadline(client_reader, client_writer, proxy)
+            if keep_alive:
+                stime = time.monotonic()
+                reuse, keep_client = await self._exchange(client_reader, client_writer, proxy, request, headers,
+                                                          deadline)
 
-            if proto in ('CONNECT:80', 'SOCKS4', 'SOCKS5'):
+            else:
                 if scheme == 'HTTPS' and proto in ('SOCKS4', 'SOCKS5'):
                     client_writer.write(CONNECTED)
                     await client_writer.drain()
-                else:  # HTTP
-                    await proxy.send(request)
-            else:  # proto: HTTP & HTTPS
-                await proxy.send(request)
 
-            stime = time.time()
-            stream = [asyncio.ensure_future(self._stream(reader=client_reader, writer=proxy.writer)),
-                      asyncio.ensure_future(self._stream(reader=proxy.reader, writer=client_writer, scheme=scheme))
-                      ]
-            await asyncio.gather(*stream, loop=self._loop)
+                stime = time.monotonic()
+                if self._relay == 'protocol':
+                    await self._relay_protocols(client_reader, client_writer, proxy, scheme, deadline)
+                else:
+                    stream = [asyncio.ensure_future(self._stream(reader=client_reader, writer=proxy.writer,
+                                                                 deadline=deadline)),
+                              asyncio.ensure_future(self._stream(reader=proxy.reader, writer=client_writer,
+                                                                 deadline=deadline, scheme=scheme,
+                                                                 stats=proxy.stats))
+                              ]
+                    await asyncio.gather(*stream, loop=self._loop)
 
         except asyncio.CancelledError:
             logger.error('Cancelled in server._handle')
@@ -120,6 +282,8 @@ class Server:
                 # TimeoutError, but all the data has already successfully
                 # returned, so do not consider this error of proxy
                 error = 'TimeoutError'
+            else:
+                proxy_failed = True
 
             if scheme == 'HTTPS':  # SSL Handshake probably failed
                 error = 'SSL Error'
@@ -127,40 +291,59 @@ class Server:
         except ProxyTimeoutError:
             logger.error("Proxy timeout")
             error = 'Proxy Timeout'
+            proxy_failed = True
             # TODO: Send client a 408 status code
 
         except Exception as e:
             # Catch anything that falls through
             logger.exception("Catch all in server")
             error = repr(e)
+            proxy_failed = isinstance(e, ProxyError)
 
         finally:
-            proxy.log(request.decode(), stime)
+            if deadline is not None:
+                deadline.cancel()
+            if watch is not None:
+                watch.cancel()
+            timing.finish(stime, proxy.stats['first_byte'])
+            proxy_url = f'{proxy.host}:{proxy.port}'
+            try:
+                proxy_bandwidth_up = proxy.stats.get('bandwidth_up', 0)
+                proxy_bandwidth_down = proxy.stats.get('bandwidth_down', 0)
+                if stream:
+                    proxy_bandwidth_up += stream[0].result()
+                    proxy_bandwidth_down += stream[1].result()
+            except Exception:
+                # Happens if something goes wrong with the connection
+                logger.warning(f"Issue saving bandwidth: proxy={proxy_url}; host={headers.get('Host')}")
+                proxy_bandwidth_up = None
+                proxy_bandwidth_down = None
+
+            try:
+                self._score_proxy(proxy, proxy_bandwidth_down, stime, proxy_failed)
+                stats.record_request(self.port, pool, proxy_url, error=error,
+                                     bandwidth_up=proxy_bandwidth_up,
+                                     bandwidth_down=proxy_bandwidth_down,
+                                     duration=timing.total,
+                                     retries=retries,
+                                     hedged=hedged,
+                                     timing=timing)
+            except Exception:
+                logger.exception("Failed to update proxy stats")
+
             # At this point, the client has already disconnected and now the stats can be processed and saved
             try:
                 if CONFIG.get('Server', {}).get('Log_Requests', True):
-                    proxy_url = f'{proxy.host}:{proxy.port}'
                     path = None
                     # Can get path for http requests, but not for https
                     if '/' in headers.get('Path', ''):
                         path = '/' + headers.get('Path', '').split('/')[-1]
 
-                    try:
-                        status_code = parse_status_line(stream[1].result().split(b'\r\n', 1)[0].decode()).get('Status')
-                    except Exception as e:
+                    status_code = proxy.stats['status_code']
+                    if status_code is None:
                         logger.warning(f"Issue saving status code: proxy={proxy_url}; host={headers.get('Host')}")
-                        status_code = None
                         if error is None:
-                            error = repr(e)
-
-                    try:
-                        proxy_bandwidth_up = len(stream[0].result()) + proxy.stats.get('bandwidth_up', 0)
-                        proxy_bandwidth_down = len(stream[1].result()) + proxy.stats.get('bandwidth_down', 0)
-                    except Exception:
-                        # Happens if something goes wrong with the connection
-                        logger.warning(f"Issue saving bandwidth: proxy={proxy_url}; host={headers.get('Host')}")
-                        proxy_bandwidth_up = None
-                        proxy_bandwidth_down = None
+                            error = 'No status code'
 
                     request_log = {'host': headers.get('Host'),
                                    'proxy': proxy_url,
@@ -170,25 +353,398 @@ class Server:
                                    'bw_down': proxy_bandwidth_down,
                                    'status_code': status_code,
                                    'error': error,
-                                   'total_time': proxy.stats['total_time'],
+                                   'total_time': int(timing.total * 1000),
+                                   'timings': timing.to_dict(),
                                    'ts': time_of_request,
                                    'pool_name': pool,
-                                   'proxy_port': self.port
+                                   'proxy_port': self.port,
+                                   'retries': retries,
+                                   'hedged': hedged,
                                    }
                     request_logger.info('Request made', extra=request_log)
 
             except Exception:
                 logger.exception("Failed to save request data")
 
-            proxy.close()
+            proxy.close(reuse=reuse)
+
+        return keep_client and error is None
+
+    async def _admit(self, timing):
+        """Take one of the `max_connections` slots, waiting in the queue for one if they are all in use
+
+        Raises:
+            AdmissionError -- The queue is full or no slot came free in time
+        """
+        if self._limit.full:
+            started = time.monotonic()
+            deadline = started + self._queue_timeout
+            try:
+                while self._limit.full:
+                    await admission.wait([self._limit], deadline - time.monotonic(), loop=self._loop)
+            finally:
+                timing.add('queue', time.monotonic() - started)
+        self._limit.acquire()
+
+    async def _connect(self, proxy, pool, scheme, headers, tried, affinity=None):
+        """Connect to the proxy, racing a second proxy if it is slow
+
+        With hedging on, once the connection has taken longer than the
+        `hedge_percentile` of recent connect times, another proxy from the
+        rule's pools is connected to as well and whichever connects first is
+        used. The other one is closed.
+
+        Arguments:
+            tried {set} -- Members that failed this request, a raced proxy that fails is added to it
+
+        If the first proxy fails it is left to the caller to record, like
+        when there is no hedging, so each failed attempt is only counted once.
+
+        Keyword Arguments:
+            affinity {dict} -- See `proxy.get_proxy` (default: {None})
+
+        Returns:
+            tuple -- (Proxy, pool name, if a second proxy was raced) of the proxy that connected
+        """
+        first = asyncio.ensure_future(self._connect_one(proxy, scheme, headers))
+        delay = self._connect_times.value if self._connect_times is not None else None
+        if delay is None:
+            await first
+            return proxy, pool, False
+
+        hedge, hedge_pool = None, None
+        try:
+            done, _ = await asyncio.wait([first], timeout=delay)
+            if not done:
+                hedge, hedge_pool = await get_proxy(headers['Host'], self.port, exclude=tried | {proxy.member},
+                                                    timing=proxy.timing, connect_timeout=self._connect_timeout,
+                                                    affinity=affinity)
+            if hedge is None:
+                await first
+                return proxy, pool, False
+
+            logger.debug(f"Hedging proxy: {proxy.host}:{proxy.port}; with: {hedge.host}:{hedge.port}; "
+                         f"after: {delay:.3f}s")
+            second = asyncio.ensure_future(self._connect_one(hedge, scheme, headers))
+            pending = {first, second}
+            winner = None
+            try:
+                while pending and winner is None:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        if task.exception() is None:
+                            winner = task
+                            break
+            finally:
+                for task in pending:
+                    task.cancel()
+                # Wait for the cancelled connects so none of them finish after being closed
+                await asyncio.gather(*pending, return_exceptions=True)
+        except asyncio.CancelledError:
+            # The request itself was cancelled. The first proxy is closed by the caller, and the raced
+            # one is closed here whether it connected, failed or is still connecting
+            first.cancel()
+            if hedge is not None:
+                hedge.close()
+            raise
+
+        if winner is second:
+            self._drop_proxy(proxy, tried, failed=not first.cancelled() and first.exception() is not None)
+            return hedge, hedge_pool, True
+        self._drop_proxy(hedge, tried, failed=not second.cancelled() and second.exception() is not None)
+        if winner is None:
+            first.result()  # Raise why the first proxy failed, the caller records it
+        return proxy, pool, True
+
+    async def _connect_one(self, proxy, scheme, headers):
+        reuse = self._can_keep_alive(scheme, self._choice_proto(proxy, scheme), headers)
+        await proxy.connect(reuse=reuse)
+        if self._connect_times is not None and not proxy.reused:
+            self._connect_times.add(proxy.stats['connect_time'])
+
+    def _drop_proxy(self, proxy, tried, failed=False):
+        """Close a proxy that will not be used for the rest of the request"""
+        if failed:
+            tried.add(proxy.member)
+            proxy.member.score.update(connect_time=proxy.stats['connect_time'], error=True)
+        proxy.close()
+
+    def _score_proxy(self, proxy, bandwidth_down, stime, proxy_failed):
+        """Feed how the request went into the running scores of the proxy"""
+        ttfb = None
+        throughput = None
+        first_byte = proxy.stats['first_byte']
+        if first_byte is not None:
+            ttfb = first_byte - stime
+            duration = time.monotonic() - stime
+            if duration > 0 and bandwidth_down is not None:
+                throughput = bandwidth_down / duration
+
+        proxy.member.score.update(connect_time=proxy.stats['connect_time'],
+                                  ttfb=ttfb,
+                                  throughput=throughput,
+                                  error=proxy_failed)
+
+    def _start_deadline(self, client_reader, client_writer, proxy):
+        """Start the idle and lifetime timeouts of relaying the request
+
+        Once either runs out both readers are failed with a `TimeoutError`,
+        so the relay stops the same way a read that timed out would. Both
+        connections are aborted too, as a relay waiting for a side that
+        stopped reading is stuck in `drain` and never reads again.
+
+        Returns:
+            timeouts.Deadline -- Cancel it once the request is done
+        """
+        def expire():
+            for reader in (client_reader, proxy.reader):
+                if reader is not None:
+                    reader.set_exception(asyncio.TimeoutError())
+            for writer in (client_writer, proxy.writer):
+                if writer is not None:
+                    writer.transport.abort()
+
+        return timer_wheel.add(self._idle_timeout, self._lifetime_timeout, expire)
+
+    async def _parse_request(self, reader):
+        """Read and parse the head of the request
+
+        The body is left in the reader, so it is streamed to the proxy along
+        with the rest of the connection instead of being read in here.
+
+        Returns:
+            tuple -- (The request head {bytes}, The parsed head {dict},
+                      The `timing.RequestTiming` of the request, started once the head was read)
+        """
+        head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self._header_timeout)
+        timing = RequestTiming()
+        headers = parse_headers(head)
+        if 'Host' not in headers:
+            raise BadStatusLine('No Host header')
+        timing.parse = time.monotonic() - timing.started
+        return head, headers, timing
+
+    def _can_keep_alive(self, scheme, proto, headers):
+        """If the request can be sent with `_exchange`, keeping the connections open
+
+        Only plain HTTP requests sent as-is to an HTTP proxy qualify, the end of
+        the response has to be found so the connection to the proxy can be
+        handed back and the client can send another request.
+        """
+        return (scheme == 'HTTP' and proto == 'HTTP' and
+                'Upgrade' not in headers and 'Transfer-Encoding' not in headers)
+
+    def _wants_keep_alive(self, headers):
+        """If the sender of the request or response wants to keep the connection open"""
+        connection = headers.get('Connection', headers.get('Proxy-Connection', '')).lower()
+        if headers['Version'] == 'HTTP/1.0':
+            return 'keep-alive' in connection
+        return 'close' not in connection
+
+    async def _exchange(self, client_reader, client_writer, proxy, request, headers, deadline):
+        """Send one plain HTTP request through the proxy and relay its response
+
+        Unlike `_stream` this works out where the response ends from its headers,
+        so the connections to the proxy and to the client can both be kept open
+        for the next request.
+
+        Arguments:
+            deadline {timeouts.Deadline} -- Timeouts of the request, from `_start_deadline`
+
+        Returns:
+            tuple -- (If the connection to the proxy can be used again,
+                      If the client connection can be used for another request)
+        """
+        length = int(headers.get('Content-Length', 0))
+        expect_continue = length > 0 and headers.get('Expect', '').lower() == '100-continue'
+        # An idle connection may have been closed by the proxy, which only shows once it is used. The body
+        # sent on a reused one is kept, so the request can be sent again on a new connection
+        kept = [] if proxy.reused and length <= MAX_RESEND_BODY else None
+
+        try:
+            try:
+                head, unread = await self._send_request(client_reader, client_writer, proxy, request, length,
+                                                        deadline, expect_continue, kept=kept)
+            except (ProxySendError, asyncio.IncompleteReadError, ConnectionError) as e:
+                # Closed or reset by the proxy. Only sent again if none of the response arrived, and all
+                # of the body sent is kept
+                if kept is None or (isinstance(e, asyncio.IncompleteReadError) and e.partial):
+                    raise
+                proxy.log('Connection: stale, reconnecting')
+                await proxy.reconnect()
+                head, unread = await self._send_request(client_reader, client_writer, proxy, request,
+                                                        length - sum(map(len, kept)), deadline, expect_continue,
+                                                        resend=kept)
+
+            proxy.stats['first_byte'] = time.monotonic()
+            response = parse_headers(head)
+            # Informational responses (100 Continue) come before the real one
+            while 100 <= response['Status'] < 200:
+                client_writer.write(head)
+                head = await asyncio.wait_for(proxy.reader.readuntil(b'\r\n\r\n'), self._header_timeout)
+                response = parse_headers(head)
+
+            proxy.stats['status_code'] = response['Status']
+            no_body = headers['Method'] == 'HEAD' or response['Status'] in (204, 304)
+            chunked = 'chunked' in response.get('Transfer-Encoding', '').lower()
+            # Without a length the body ends when the proxy closes the connection
+            framed = no_body or chunked or 'Content-Length' in response
+            # A request body that was never sent is still waiting on both connections
+            reusable = framed and not unread
+            keep_client = reusable and self._wants_keep_alive(headers)
+            client_writer.write(self._set_connection(head, keep_client))
+            bandwidth_down = len(head)
+
+            if no_body:
+                pass
+            elif chunked:
+                bandwidth_down += await self._relay_chunked(proxy.reader, client_writer, deadline)
+            elif framed:
+                bandwidth_down += await self._relay_length(proxy.reader, client_writer,
+                                                           int(response['Content-Length']), deadline)
+            else:
+                bandwidth_down += await self._stream(reader=proxy.reader, writer=client_writer, deadline=deadline)
+            await client_writer.drain()
+            proxy.stats['bandwidth_down'] += bandwidth_down
+
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                ConnectionResetError, OSError, ValueError, BadStatusLine, ProxyRecvError) as e:
+            raise ErrorOnStream(e)
+
+        return reusable and self._wants_keep_alive(response), keep_client
+
+    async def _send_request(self, client_reader, client_writer, proxy, request, length, deadline,
+                            expect_continue=False, resend=(), kept=None):
+        """Send the request and its body to the proxy and read the head of the response
+
+        With `Expect: 100-continue` the body is only sent once the proxy
+        answers with `100 Continue`, which is relayed so the client starts
+        sending it. If the proxy answers with a final response instead the
+        body is never sent. A proxy that says nothing for `CONTINUE_TIMEOUT`
+        gets the body anyway, like clients do.
+
+        Arguments:
+            length {int} -- Bytes of the body still to be read from the client
+            deadline {timeouts.Deadline} -- Touched for every chunk, see `_stream`
+
+        Keyword Arguments:
+            expect_continue {bool} -- If the client waits for `100 Continue` before sending the body (default: {False})
+            resend {list} -- Chunks of the body already read from the client, sent before the rest (default: {()})
+            kept {list} -- The chunks read from the client are added to it (default: {None})
 
-    async def _parse_request(self, reader, length=65536):
-        request = await reader.read(length)
-        headers = parse_headers(request)
-        if headers['Method'] == 'POST' and request.endswith(b'\r\n\r\n'):
-            # For aiohttp. POST data returns on second reading
-            request += await reader.read(length)
-        return request, headers
+        Raises:
+            ProxySendError -- Sending to the proxy failed
+
+        Returns:
+            tuple -- (Head of the response, Bytes of the body left unread because the proxy answered early)
+        """
+        await proxy.send(request)
+        if expect_continue:
+            try:
+                head = await asyncio.wait_for(proxy.reader.readuntil(b'\r\n\r\n'),
+                                              min(CONTINUE_TIMEOUT, self._header_timeout))
+            except asyncio.TimeoutError:
+                head = None
+            while head is not None:
+                status = parse_headers(head)['Status']
+                if status >= 200:
+                    return head, length
+                client_writer.write(head)
+                if status == 100:
+                    break
+                head = await asyncio.wait_for(proxy.reader.readuntil(b'\r\n\r\n'), self._header_timeout)
+
+        for data in resend:
+            await self._send_body(proxy, data)
+        while length > 0:
+            try:
+                data = await client_reader.read(min(length, self._buffer_size))
+            except ConnectionError:
+                data = b''  # So a reset from the client is not taken for one from the proxy
+            deadline.touch()
+            if not data:
+                raise ProxyRecvError('Connection closed before the body was complete')
+            length -= len(data)
+            if kept is not None:
+                kept.append(data)
+            await self._send_body(proxy, data)
+
+        head = await asyncio.wait_for(proxy.reader.readuntil(b'\r\n\r\n'), self._header_timeout)
+        return head, 0
+
+    async def _send_body(self, proxy, data):
+        """Send part of the request body to the proxy
+
+        Raises:
+            ProxySendError -- Sending to the proxy failed
+        """
+        try:
+            proxy.writer.write(data)
+            await proxy.writer.drain()
+        except ConnectionError:
+            raise ProxySendError('; Sending body: failed')
+        proxy.stats['bandwidth_up'] += len(data)
+
+    async def _relay_length(self, reader, writer, length, deadline):
+        """Relay exactly `length` bytes
+
+        Arguments:
+            deadline {timeouts.Deadline} -- Touched for every chunk, see `_stream`
+
+        Returns:
+            int -- Number of bytes relayed
+        """
+        left = length
+        while left > 0:
+            data = await reader.read(min(left, self._buffer_size))
+            deadline.touch()
+            if not data:
+                raise ProxyRecvError('Connection closed before the body was complete')
+            left -= len(data)
+            writer.write(data)
+            await writer.drain()
+        return length
+
+    async def _relay_chunked(self, reader, writer, deadline):
+        """Relay a `Transfer-Encoding: chunked` body as-is
+
+        Arguments:
+            deadline {timeouts.Deadline} -- Touched for every chunk, see `_stream`
+
+        Returns:
+            int -- Number of bytes relayed
+        """
+        total = 0
+        while True:
+            line = await reader.readuntil(b'\r\n')
+            deadline.touch()
+            writer.write(line)
+            total += len(line)
+            size = int(line.split(b';', 1)[0].strip(), 16)
+            if size == 0:
+                break
+            total += await self._relay_length(reader, writer, size + 2, deadline)  # Chunk & its CRLF
+
+        # Trailers, ending with an empty line
+        while line != b'\r\n':
+            line = await reader.readuntil(b'\r\n')
+            deadline.touch()
+            writer.write(line)
+            total += len(line)
+        return total
+
+    def _set_connection(self, head, keep_alive):
+        """Replace the hop-by-hop connection headers with our own `Connection` header"""
+        lines = [line for line in head[:-4].split(b'\r\n')
+                 if not line.lower().startswith((b'connection:', b'proxy-connection:', b'keep-alive:'))]
+        lines.append(b'Connection: keep-alive' if keep_alive else b'Connection: close')
+        return b'\r\n'.join(lines) + b'\r\n\r\n'
+
+    def _remove_header(self, head, name):
+        """The request head without the header `name`"""
+        prefix = name.lower().encode('latin-1') + b':'
+        lines = [line for line in head[:-4].split(b'\r\n') if not line.lower().startswith(prefix)]
+        return b'\r\n'.join(lines) + b'\r\n\r\n'
 
     def _identify_scheme(self, headers):
         if headers['Method'] == 'CONNECT':
@@ -209,21 +765,39 @@ class Server:
             proto = relevant.pop()
         return proto
 
-    async def _stream(self, reader, writer, length=65536, scheme=None):
+    async def _stream(self, reader, writer, deadline, scheme=None, stats=None):
+        """Relay data from the reader to the writer until EOF
+
+        Nothing is kept once it has been written, so the memory used does not
+        depend on the size of the request or response. There is no timer for
+        each read, the deadline is touched instead and fails the reader with
+        a `TimeoutError` once it expires.
+
+        Arguments:
+            deadline {timeouts.Deadline} -- Timeouts of the request, from `_start_deadline`
+
+        Keyword Arguments:
+            scheme {str} -- Set when this is the response, so the status line can be checked (default: {None})
+            stats {dict} -- Where to save the status code and the time of the first byte (default: {None})
+
+        Returns:
+            int -- Number of bytes relayed
+        """
         checked = False
-        total_data = b''
+        total = 0
         try:
             while not reader.at_eof():
-                data = await asyncio.wait_for(reader.read(length), self._timeout)
+                data = await reader.read(self._buffer_size)
+                deadline.touch()
                 if not data:
                     writer.close()
                     break
 
                 elif scheme and not checked:
-                    self._check_response(data, scheme)
+                    self._on_response(data, scheme, stats)
                     checked = True
 
-                total_data += data
+                total += len(data)
                 writer.write(data)
                 await writer.drain()
 
@@ -231,13 +805,31 @@ class Server:
                 ProxyRecvError, BadResponseError) as e:
             raise ErrorOnStream(e)
 
-        return total_data
+        return total
+
+    async def _relay_protocols(self, client_reader, client_writer, proxy, scheme, deadline):
+        """Same as running a `_stream` each way, but using `relay.Relay`"""
+        relay = Relay(client_reader, client_writer, proxy.reader, proxy.writer, deadline, loop=self._loop,
+                      on_response=lambda data: self._on_response(data, scheme, proxy.stats))
+        try:
+            await relay.run()
+        finally:
+            proxy.stats['bandwidth_up'] += relay.bytes_up
+            proxy.stats['bandwidth_down'] += relay.bytes_down
+
+    def _on_response(self, data, scheme, stats=None):
+        """Check the first chunk of the response and save its stats"""
+        status_code = self._check_response(data, scheme)
+        if stats is not None:
+            stats['first_byte'] = time.monotonic()
+            stats['status_code'] = status_code
 
     def _check_response(self, data, scheme):
         if scheme.startswith('HTTP'):
             # Check both HTTP & HTTPS requests
-            line = data.split(b'\r\n', 1)[0].decode()
+            end = data.find(b'\r\n')
+            line = (data[:end] if end != -1 else data).decode()
             try:
-                parse_status_line(line)
+                return parse_status_line(line).get('Status')
             except BadStatusLine:
                 raise BadResponseError
@@ -0,0 +1,412 @@
+import os
+import logging
+from bisect import bisect_left
+from collections import deque
+
+from pools import pool_table, CircuitBreaker
+from routing import rule_table
+from connpool import connection_pools
+from tls import tls_sessions
+from resolver import dns_cache
+from timing import PHASES, profiler
+from admission import server_limits
+from ratelimit import rate_scheduler
+from timeouts import timer_wheel
+from config import handler as request_log_handler
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds, in seconds, of the request latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def error_class(error):
+    """Group errors like `ProxyConnError('Connection: failed')` by their class"""
+    return error.split('(', 1)[0]
+
+
+class RecentPercentile:
+    """A percentile of the most recent samples, like the time to connect to a proxy
+
+    The samples are only sorted again after every `size // 10` new ones, so
+    reading `value` costs nothing and adding a sample is almost always O(1).
+
+    :param float percentile: Which percentile to keep, 0 - 100
+    :param int size: (optional) Number of recent samples to use
+    :param int min_samples: (optional) `value` stays None until there are this many samples
+    """
+    def __init__(self, percentile, size=1000, min_samples=20):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.value = None
+        self._samples = deque(maxlen=size)
+        self._refresh_every = max(size // 10, 1)
+        self._added = 0
+
+    def add(self, sample):
+        self._samples.append(sample)
+        self._added += 1
+        if len(self._samples) < self.min_samples:
+            return
+        if self.value is None or self._added >= self._refresh_every:
+            ordered = sorted(self._samples)
+            self.value = ordered[min(int(len(ordered) * self.percentile / 100), len(ordered) - 1)]
+            self._added = 0
+
+
+class RequestStats:
+    """Counters for the requests of one port, pool or proxy
+
+    Recording a request is a fixed amount of work no matter how many requests
+    have been recorded, so it can be done for every request.
+    """
+    __slots__ = ('requests', 'errors', 'bytes_up', 'bytes_down', 'latency_buckets', 'latency_sum',
+                 'retries', 'hedges', 'phase_sums', 'phase_counts')
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = {}  # Error class -> count
+        self.bytes_up = 0
+        self.bytes_down = 0
+        self.latency_buckets = [0] * (len(LATENCY_BUCKETS) + 1)  # The last one is +Inf
+        self.latency_sum = 0.0
+        self.retries = 0  # Proxies that failed before one worked
+        self.hedges = 0  # Requests that raced a second proxy
+        self.phase_sums = [0.0] * len(PHASES)  # Seconds spent in each of `timing.PHASES`
+        self.phase_counts = [0] * len(PHASES)  # Requests that went through each phase
+
+    def record(self, error=None, bandwidth_up=None, bandwidth_down=None, duration=None,
+               retries=0, hedged=False, phases=None):
+        self.requests += 1
+        self.retries += retries
+        if hedged:
+            self.hedges += 1
+        if error is not None:
+            error = error_class(error)
+            self.errors[error] = self.errors.get(error, 0) + 1
+        if bandwidth_up:
+            self.bytes_up += bandwidth_up
+        if bandwidth_down:
+            self.bytes_down += bandwidth_down
+        if duration is not None:
+            self.latency_buckets[bisect_left(LATENCY_BUCKETS, duration)] += 1
+            self.latency_sum += duration
+        if phases is not None:
+            for i, seconds in enumerate(phases):
+                if seconds is not None:
+                    self.phase_sums[i] += seconds
+                    self.phase_counts[i] += 1
+
+    def to_dict(self):
+        return {'requests': self.requests,
+                'errors': dict(self.errors),
+                'bytes_up': self.bytes_up,
+                'bytes_down': self.bytes_down,
+                'latency_buckets': list(self.latency_buckets),
+                'latency_sum': self.latency_sum,
+                'retries': self.retries,
+                'hedges': self.hedges,
+                'phase_sums': list(self.phase_sums),
+                'phase_counts': list(self.phase_counts),
+                }
+
+
+# Requests handled by this process, by the port, pool and proxy that handled them
+request_stats = {'ports': {}, 'pools': {}, 'proxies': {}}
+
+
+def record_request(port, pool, proxy, error=None, bandwidth_up=None, bandwidth_down=None, duration=None,
+                   retries=0, hedged=False, timing=None):
+    """Count a finished request
+
+    Arguments:
+        port {int} -- The port the client connected to
+        pool {str} -- Name of the pool the proxy was picked from
+        proxy {str} -- `host:port` of the proxy
+
+    Keyword Arguments:
+        error {str} -- The error the request failed with (default: {None})
+        bandwidth_up {int} -- Bytes sent to the proxy (default: {None})
+        bandwidth_down {int} -- Bytes received from the proxy (default: {None})
+        duration {float} -- Seconds the request took (default: {None})
+        retries {int} -- Other proxies that failed before this one worked (default: {0})
+        hedged {bool} -- If a second proxy was raced to connect (default: {False})
+        timing {timing.RequestTiming} -- How long each phase of the request took (default: {None})
+    """
+    phases = timing.values() if timing is not None else None
+    for group, key in (('ports', port), ('pools', pool), ('proxies', proxy)):
+        group_stats = request_stats[group].get(key)
+        if group_stats is None:
+            group_stats = request_stats[group][key] = RequestStats()
+        group_stats.record(error, bandwidth_up, bandwidth_down, duration, retries, hedged, phases)
+
+
+def snapshot(detail=True):
+    """Stats of this process
+
+    Keyword Arguments:
+        detail {bool} -- Include the stats of each proxy, which grow with the number of proxies (default: {True})
+
+    Returns:
+        dict -- Can be combined with the stats of other processes using `merge`
+    """
+    scores = {}
+    if detail:
+        for pool in pool_table:
+            scores[pool.name] = {f'{member.host}:{member.port}': dict(member.score.to_dict(), active=member.active,
+                                                                      state=member.breaker.state)
+                                 for member in pool.members}
+
+    return {'pid': os.getpid(),
+            'requests': {group: {key: group_stats.to_dict() for key, group_stats in values.items()}
+                         if detail or group != 'proxies' else {}
+                         for group, values in request_stats.items()},
+            'scores': scores,
+            'routes': {'hits': rule_table.hits, 'misses': rule_table.misses},
+            'connections': connection_pools.stats(detail),
+            'tls': tls_sessions.stats(detail),
+            'dns': dns_cache.stats(),
+            'request_log': request_log_handler.stats(),
+            'profile': profiler.stats(),
+            'admission': {'servers': {port: limit.stats() for port, limit in server_limits.items()},
+                          'pools': {pool.name: pool.limit.stats() for pool in pool_table}},
+            'rate_limits': rate_scheduler.stats(),
+            'timeouts': timer_wheel.stats(),
+            }
+
+
+def _merge_score(total, score):
+    """Add a proxy score into the running total, averages are weighted by requests"""
+    requests = total['requests'] + score['requests']
+    for name in ('connect_time', 'ttfb', 'throughput', 'error_rate'):
+        if score[name] is None or not score['requests']:
+            continue
+        if total[name] is None or not total['requests']:
+            total[name] = score[name]
+        else:
+            total[name] = (total[name] * total['requests'] + score[name] * score['requests']) / requests
+    total['requests'] = requests
+    total['active'] += score['active']
+    # Each worker has its own breakers, count how many have the proxy ejected
+    if score['state'] == CircuitBreaker.OPEN:
+        total['ejected'] += 1
+
+
+def _merge_limit(total, limit):
+    """Add the admission stats of a `Limit` into the running total, the caps add up across workers"""
+    for key in ('active', 'max_active', 'queued', 'waited', 'wait_time'):
+        total[key] += limit[key]
+    for reason, count in limit['rejected'].items():
+        total['rejected'][reason] += count
+
+
+def _merge_requests(total, counts):
+    for key in ('requests', 'bytes_up', 'bytes_down', 'latency_sum', 'retries', 'hedges'):
+        total[key] += counts[key]
+    for error, count in counts['errors'].items():
+        total['errors'][error] = total['errors'].get(error, 0) + count
+    total['latency_buckets'] = [a + b for a, b in zip(total['latency_buckets'], counts['latency_buckets'])]
+    total['phase_sums'] = [a + b for a, b in zip(total['phase_sums'], counts['phase_sums'])]
+    total['phase_counts'] = [a + b for a, b in zip(total['phase_counts'], counts['phase_counts'])]
+
+
+def merge(snapshots):
+    """Combine the stats of each process into a single view
+
+    Arguments:
+        snapshots {list} -- Results of `snapshot` from each process
+
+    Returns:
+        dict -- Same layout as a single `snapshot`, with `pid` replaced by `workers`
+    """
+    merged = {'workers': len(snapshots),
+              'latency_buckets': LATENCY_BUCKETS,
+              'phases': PHASES,
+              'requests': {'ports': {}, 'pools': {}, 'proxies': {}},
+              'scores': {},
+              'routes': {'hits': 0, 'misses': 0},
+              'connections': {'hits': 0, 'misses': 0, 'hit_rate': None, 'idle': 0, 'proxies': {}},
+              'tls': {'full': 0, 'resumed': 0, 'resumption_rate': None, 'proxies': {}},
+              'dns': {'hits': 0, 'misses': 0, 'refreshes': 0, 'errors': 0, 'hosts': 0},
+              'request_log': {'queued': 0, 'written': 0, 'dropped': 0, 'failed': 0, 'waiting': 0},
+              'profile': {'samples': 0, 'dropped': 0, 'stacks': {}},
+              'admission': {'servers': {}, 'pools': {}},
+              'rate_limits': {'buckets': 0, 'delayed': 0, 'delay_time': 0.0, 'rejected': 0, 'evicted': 0},
+              'timeouts': {'relays': 0, 'expired': 0},
+              }
+
+    for snap in snapshots:
+        for group, values in snap['requests'].items():
+            for key, counts in values.items():
+                total = merged['requests'][group].get(key)
+                if total is None:
+                    merged['requests'][group][key] = total = RequestStats().to_dict()
+                _merge_requests(total, counts)
+
+        for pool_name, proxies in snap['scores'].items():
+            pool = merged['scores'].setdefault(pool_name, {})
+            for proxy_url, score in proxies.items():
+                total = pool.setdefault(proxy_url, {'connect_time': None, 'ttfb': None, 'throughput': None,
+                                                    'error_rate': None, 'requests': 0, 'active': 0,
+                                                    'ejected': 0})
+                _merge_score(total, score)
+
+        for key in ('hits', 'misses'):
+            merged['routes'][key] += snap['routes'][key]
+
+        for key in merged['request_log']:
+            merged['request_log'][key] += snap['request_log'][key]
+
+        for key in merged['dns']:
+            merged['dns'][key] += snap['dns'][key]
+
+        for key in merged['rate_limits']:
+            merged['rate_limits'][key] += snap['rate_limits'][key]
+
+        for key in merged['timeouts']:
+            merged['timeouts'][key] += snap['timeouts'][key]
+
+        for group, limits in snap['admission'].items():
+            for key, limit in limits.items():
+                total = merged['admission'][group].setdefault(
+                    key, {'active': 0, 'max_active': 0, 'queued': 0, 'waited': 0, 'wait_time': 0.0,
+                          'rejected': {'queue_full': 0, 'queue_timeout': 0}})
+                _merge_limit(total, limit)
+
+        profile = merged['profile']
+        for key in ('samples', 'dropped'):
+            profile[key] += snap['profile'][key]
+        for stack, count in snap['profile']['stacks'].items():
+            profile['stacks'][stack] = profile['stacks'].get(stack, 0) + count
+
+        connections = merged['connections']
+        for key in ('hits', 'misses', 'idle'):
+            connections[key] += snap['connections'][key]
+        for proxy_url, conn_stats in snap['connections']['proxies'].items():
+            total = connections['proxies'].setdefault(proxy_url, {'idle': 0, 'hits': 0, 'misses': 0})
+            for key in total:
+                total[key] += conn_stats[key]
+
+        tls = merged['tls']
+        for key in ('full', 'resumed'):
+            tls[key] += snap['tls'][key]
+        for proxy_url, tls_stats in snap['tls']['proxies'].items():
+            total = tls['proxies'].setdefault(proxy_url, {'full': 0, 'resumed': 0})
+            for key in total:
+                total[key] += tls_stats[key]
+
+    tls = merged['tls']
+    if tls['full'] + tls['resumed']:
+        tls['resumption_rate'] = tls['resumed'] / (tls['full'] + tls['resumed'])
+
+    connections = merged['connections']
+    if connections['hits'] + connections['misses']:
+        connections['hit_rate'] = connections['hits'] / (connections['hits'] + connections['misses'])
+
+    return merged
+
+
+def _labels(**labels):
+    escaped = (str(val).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for val in labels.values())
+    return ','.join(f'{name}="{val}"' for name, val in zip(labels, escaped))
+
+
+def to_prometheus(merged):
+    """Render the result of `merge` in the Prometheus text format
+
+    Returns:
+        str -- The metrics, ready to be served from `/metrics`
+    """
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for labels, val in samples:
+            lines.append(f'{name}{{{labels}}} {val}' if labels else f'{name} {val}')
+
+    label_names = {'ports': 'port', 'pools': 'pool', 'proxies': 'proxy'}
+    groups = [({label_names[group]: key}, counts)
+              for group, values in merged['requests'].items() for key, counts in values.items()]
+
+    metric('plb_requests_total', 'counter', 'Requests handled',
+           [(_labels(**label), counts['requests']) for label, counts in groups])
+    metric('plb_request_errors_total', 'counter', 'Requests that failed, by error',
+           [(_labels(**label, error=error), count)
+            for label, counts in groups for error, count in counts['errors'].items()])
+    metric('plb_bytes_total', 'counter', 'Bytes relayed to and from the proxies',
+           [(_labels(**label, direction=direction), counts[f'bytes_{direction}'])
+            for label, counts in groups for direction in ('up', 'down')])
+    metric('plb_request_retries_total', 'counter', 'Proxies that failed before another one was used',
+           [(_labels(**label), counts['retries']) for label, counts in groups])
+    metric('plb_request_hedges_total', 'counter', 'Requests that raced a second proxy to connect',
+           [(_labels(**label), counts['hedges']) for label, counts in groups])
+
+    lines.append('# HELP plb_request_duration_seconds Time to handle a request')
+    lines.append('# TYPE plb_request_duration_seconds histogram')
+    for label, counts in groups:
+        cumulative = 0
+        for le, count in zip(LATENCY_BUCKETS + ('+Inf',), counts['latency_buckets']):
+            cumulative += count
+            lines.append(f'plb_request_duration_seconds_bucket{{{_labels(**label, le=le)}}} {cumulative}')
+        lines.append(f'plb_request_duration_seconds_sum{{{_labels(**label)}}} {counts["latency_sum"]}')
+        lines.append(f'plb_request_duration_seconds_count{{{_labels(**label)}}} {cumulative}')
+
+    lines.append('# HELP plb_request_phase_seconds Time spent in each phase of the requests')
+    lines.append('# TYPE plb_request_phase_seconds summary')
+    for label, counts in groups:
+        for phase, seconds, count in zip(PHASES, counts['phase_sums'], counts['phase_counts']):
+            lines.append(f'plb_request_phase_seconds_sum{{{_labels(**label, phase=phase)}}} {seconds}')
+            lines.append(f'plb_request_phase_seconds_count{{{_labels(**label, phase=phase)}}} {count}')
+
+    scores = [(_labels(pool=pool, proxy=proxy), score)
+              for pool, proxies in merged['scores'].items() for proxy, score in proxies.items()]
+    metric('plb_proxy_active_requests', 'gauge', 'Requests currently using the proxy',
+           [(labels, score['active']) for labels, score in scores])
+    metric('plb_proxy_error_rate', 'gauge', 'Moving average of the error rate of the proxy',
+           [(labels, score['error_rate']) for labels, score in scores if score['error_rate'] is not None])
+    metric('plb_proxy_ejected', 'gauge', 'Number of workers that have the proxy ejected',
+           [(labels, score['ejected']) for labels, score in scores])
+    limits = [(_labels(**{label: key}), limit)
+              for group, label in (('servers', 'port'), ('pools', 'pool'))
+              for key, limit in merged['admission'][group].items()]
+    metric('plb_admission_active', 'gauge', 'Requests holding a slot, by port and by pool',
+           [(labels, limit['active']) for labels, limit in limits])
+    metric('plb_queue_depth', 'gauge', 'Requests waiting for a slot, by port and by pool',
+           [(labels, limit['queued']) for labels, limit in limits])
+    metric('plb_queue_waits_total', 'counter', 'Times a request had to wait for a slot',
+           [(labels, limit['waited']) for labels, limit in limits])
+    metric('plb_queue_wait_seconds_total', 'counter', 'Seconds requests spent waiting for a slot',
+           [(labels, limit['wait_time']) for labels, limit in limits])
+    metric('plb_admission_rejected_total', 'counter', 'Requests turned away with a 503, by why',
+           [(f'{labels},{_labels(reason=reason)}', count)
+            for labels, limit in limits for reason, count in limit['rejected'].items()])
+    rate_limits = merged['rate_limits']
+    metric('plb_rate_limit_delays_total', 'counter', 'Requests delayed for a rate limit token',
+           [('', rate_limits['delayed'])])
+    metric('plb_rate_limit_delay_seconds_total', 'counter', 'Seconds requests were delayed for rate limit tokens',
+           [('', rate_limits['delay_time'])])
+    metric('plb_rate_limit_rejected_total', 'counter', 'Requests that would have waited past Queue_Timeout',
+           [('', rate_limits['rejected'])])
+    metric('plb_rate_limit_buckets', 'gauge', 'Token buckets kept for (proxy, host) pairs',
+           [('', rate_limits['buckets'])])
+    metric('plb_relays_timed', 'gauge', 'Relays with an idle or lifetime timeout running',
+           [('', merged['timeouts']['relays'])])
+    metric('plb_relay_timeouts_total', 'counter', 'Relays stopped by their idle or lifetime timeout',
+           [('', merged['timeouts']['expired'])])
+    metric('plb_route_cache_total', 'counter', 'Routing lookups, by if they were in the cache',
+           [(_labels(result='hit'), merged['routes']['hits']), (_labels(result='miss'), merged['routes']['misses'])])
+    metric('plb_upstream_connections_total', 'counter', 'Connections to proxies, by if they were reused',
+           [(_labels(result='hit'), merged['connections']['hits']),
+            (_labels(result='miss'), merged['connections']['misses'])])
+    metric('plb_tls_handshakes_total', 'counter', 'TLS handshakes with proxies, by if a session was resumed',
+           [(_labels(proxy=proxy, result=result), counts[result])
+            for proxy, counts in merged['tls']['proxies'].items() for result in ('full', 'resumed')])
+    metric('plb_dns_lookups_total', 'counter', 'Proxy hostname lookups, by what happened',
+           [(_labels(result=key), merged['dns'][key]) for key in ('hits', 'misses', 'refreshes', 'errors')])
+    metric('plb_request_log_records_total', 'counter', 'Request log records, by what happened to them',
+           [(_labels(result=key), merged['request_log'][key]) for key in ('written', 'dropped', 'failed')])
+    metric('plb_workers', 'gauge', 'Number of processes the stats came from', [('', merged['workers'])])
+
+    return '\n'.join(lines) + '\n'
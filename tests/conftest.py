@@ -0,0 +1,14 @@
+import os
+import sys
+import tempfile
+
+# The modules read the config file named on the command line, and write their logs and database
+# to the working directory, as soon as they are imported
+_workdir = tempfile.mkdtemp()
+os.makedirs(os.path.join(_workdir, 'logs'))
+_config = os.path.join(_workdir, 'config.yaml')
+with open(_config, 'w') as f:
+    f.write('Server: {}\nPools: []\nRules: []\n')
+os.chdir(_workdir)
+sys.argv = [sys.argv[0], '-c', _config]
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,105 @@
+import asyncio
+
+import pytest
+
+from admission import Limit, wait
+from errors import QueueFullError, QueueTimeoutError
+
+
+def test_waiting_request_is_woken_when_a_slot_is_released():
+    limit = Limit(max_active=1)
+    limit.acquire()
+
+    async def main():
+        waiting = asyncio.ensure_future(wait([limit], timeout=1))
+        await asyncio.sleep(0)
+        assert len(limit.waiters) == 1
+        limit.release()
+        await asyncio.wait_for(waiting, 1)
+        assert not limit.full
+        assert (len(limit.waiters), limit.waited) == (0, 1)
+
+    asyncio.get_event_loop().run_until_complete(main())
+
+
+def test_waiters_are_woken_in_the_order_they_came():
+    limit = Limit(max_active=1)
+    limit.acquire()
+    woken = []
+
+    async def request(name):
+        await wait([limit], timeout=1)
+        woken.append(name)
+
+    async def main():
+        waiting = [asyncio.ensure_future(request(name)) for name in ('first', 'second')]
+        await asyncio.sleep(0)
+        limit.release()
+        await asyncio.sleep(0.01)
+        assert woken == ['first']
+        limit.release()
+        await asyncio.gather(*waiting)
+        assert woken == ['first', 'second']
+
+    asyncio.get_event_loop().run_until_complete(main())
+
+
+def test_request_that_is_not_woken_in_time_is_turned_away():
+    limit = Limit(max_active=1)
+    limit.acquire()
+
+    async def main():
+        with pytest.raises(QueueTimeoutError):
+            await wait([limit], timeout=0.05)
+        with pytest.raises(QueueTimeoutError):
+            await wait([limit], timeout=0)
+
+    asyncio.get_event_loop().run_until_complete(main())
+    assert not limit.waiters
+    assert limit.timeout_rejected == 2
+
+
+def test_request_is_turned_away_when_every_queue_is_full():
+    limit = Limit(max_active=1, queue_size=1)
+    limit.acquire()
+
+    async def main():
+        waiting = asyncio.ensure_future(wait([limit], timeout=1))
+        await asyncio.sleep(0)
+        with pytest.raises(QueueFullError):
+            await wait([limit], timeout=1)
+        waiting.cancel()
+
+    asyncio.get_event_loop().run_until_complete(main())
+    assert limit.full_rejected == 1
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    limit = Limit(max_active=1)
+    limit.acquire()
+
+    async def main():
+        first = asyncio.ensure_future(wait([limit], timeout=1))
+        second = asyncio.ensure_future(wait([limit], timeout=1))
+        await asyncio.sleep(0)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        assert len(limit.waiters) == 1
+        limit.release()
+        await asyncio.wait_for(second, 1)
+
+    asyncio.get_event_loop().run_until_complete(main())
+
+
+def test_raising_the_cap_wakes_every_waiter():
+    limit = Limit(max_active=1)
+    limit.acquire()
+
+    async def main():
+        waiting = [asyncio.ensure_future(wait([limit], timeout=1)) for _ in range(3)]
+        await asyncio.sleep(0)
+        assert limit.update(max_active=5, queue_size=100) is limit
+        await asyncio.wait_for(asyncio.gather(*waiting), 1)
+
+    asyncio.get_event_loop().run_until_complete(main())
@@ -0,0 +1,54 @@
+import socket
+import asyncio
+
+import pytest
+
+import server
+from bench import standins
+from bench.__main__ import compare
+from bench.loadgen import LoadGenerator
+from pools import pool_table
+from routing import rule_table, rule_rows
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _results(requests_per_s=1000, p99=10, error_rate=0.0):
+    return {'requests_per_s': requests_per_s, 'bytes_per_s': requests_per_s * 1024, 'cpu_percent': 50,
+            'peak_rss_mb': 40, 'error_rate': error_rate, 'latency_ms': {'p50': 2, 'p90': 5, 'p99': p99}}
+
+
+def test_compare_flags_what_got_worse_by_more_than_the_tolerance():
+    assert compare(_results(), _results(requests_per_s=1050, p99=9), tolerance=0.1) == []
+    assert compare(_results(), _results(requests_per_s=800), tolerance=0.1) == ['requests_per_s', 'bytes_per_s']
+    assert compare(_results(), _results(p99=12, error_rate=0.01), tolerance=0.1) == ['error_rate', 'latency_p99_ms']
+
+
+@pytest.mark.parametrize('relay', ['stream', 'protocol'])
+def test_load_goes_through_the_stand_in_proxies(relay):
+    origin_port, port = _free_port(), _free_port()
+    proxy_ports = [_free_port(), _free_port()]
+
+    async def main():
+        stand_ins = await standins.start(origin_port, proxy_ports)
+        pool_table.load([{'Name': 'Bench', 'Strategy': 'round_robin',
+                          'Proxies': [{'Host': '127.0.0.1', 'Port': p} for p in proxy_ports]}])
+        rule_table.swap(rule_table.compile(rule_rows([{'Name': 'Bench', 'Port': port, 'Domains': ['.*'],
+                                                       'Pools': ['Bench']}])))
+        srv = server.Server('127.0.0.1', port, relay=relay, loop=asyncio.get_event_loop())
+        await srv.listen()
+        try:
+            load = LoadGenerator(port, origin_port, clients=4, requests=40, mode='mixed', body_size=4096)
+            result = (await asyncio.wait_for(load.run(), 10)).to_dict()
+        finally:
+            srv.close()
+            for stand_in in stand_ins:
+                stand_in.close()
+        assert (result['requests'], result['errors']) == (40, {})
+        assert result['latency_ms']['p50'] is not None
+
+    asyncio.get_event_loop().run_until_complete(main())
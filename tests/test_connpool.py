@@ -0,0 +1,89 @@
+import asyncio
+
+import connpool
+from connpool import ConnectionPool, ConnectionPools
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+class _Writer:
+    def __init__(self):
+        self.closed = False
+
+    def is_closing(self):
+        return self.closed
+
+    def close(self):
+        self.closed = True
+
+
+def _connection(clock):
+    return asyncio.StreamReader(), _Writer(), clock.now
+
+
+def test_most_recently_released_connection_is_used_first(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(connpool, 'time', clock)
+    pool = ConnectionPool()
+    older, newer = _connection(clock), _connection(clock)
+    pool.release(*older)
+    pool.release(*newer)
+    assert pool.acquire() == newer
+    assert pool.acquire() == older
+    assert pool.acquire() is None
+    assert (pool.hits, pool.misses) == (2, 1)
+
+
+def test_connections_idle_or_alive_for_too_long_are_closed(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(connpool, 'time', clock)
+    pool = ConnectionPool(max_idle=30, max_lifetime=300)
+    idle = _connection(clock)
+    pool.release(*idle)
+    clock.now += 31
+    assert pool.acquire() is None
+    assert idle[1].closed
+
+    old = _connection(clock)
+    clock.now += 299
+    pool.release(*old)
+    clock.now += 2
+    assert pool.acquire() is None
+    assert old[1].closed
+
+
+def test_connections_the_proxy_closed_are_not_used(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(connpool, 'time', clock)
+    pool = ConnectionPool()
+    at_eof, closing = _connection(clock), _connection(clock)
+    pool.release(*at_eof)
+    pool.release(*closing)
+    at_eof[0].feed_eof()
+    closing[1].closed = True
+    assert pool.acquire() is None
+    assert at_eof[1].closed
+
+
+def test_release_closes_the_connection_when_the_pool_is_full(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(connpool, 'time', clock)
+    pool = ConnectionPool(max_size=1)
+    kept, extra = _connection(clock), _connection(clock)
+    pool.release(*kept)
+    pool.release(*extra)
+    assert extra[1].closed and not kept[1].closed
+    assert len(pool) == 1
+
+
+def test_each_proxy_gets_its_own_pool():
+    pools = ConnectionPools()
+    assert pools.get('10.0.0.1', 8080) is pools.get('10.0.0.1', 8080)
+    assert pools.get('10.0.0.1', 8080) is not pools.get('10.0.0.1', 8080, 'user')
+    assert ConnectionPools(max_size=0).get('10.0.0.1', 8080) is None
@@ -0,0 +1,157 @@
+import asyncio
+import collections
+
+import pytest
+
+from pools import CircuitBreaker, Pool, PoolMember, PoolTable, ProxyScore
+
+
+def _members(count, **options):
+    return [PoolMember(f'10.0.0.{i}', 8080, **options) for i in range(1, count + 1)]
+
+
+def _hosts(pool, count, **options):
+    return [pool.select(**options).host for _ in range(count)]
+
+
+def test_round_robin_hands_out_each_proxy_in_turn():
+    pool = Pool('Test', 'round_robin', _members(3))
+    assert _hosts(pool, 6) == ['10.0.0.1', '10.0.0.2', '10.0.0.3'] * 2
+
+
+def test_weighted_round_robin_spreads_the_heavy_proxy_out():
+    light, heavy = PoolMember('10.0.0.1', weight=1), PoolMember('10.0.0.2', weight=3)
+    pool = Pool('Test', 'weighted_round_robin', [light, heavy])
+    hosts = _hosts(pool, 8)
+    assert collections.Counter(hosts) == {'10.0.0.1': 2, '10.0.0.2': 6}
+    assert hosts[:4].count('10.0.0.1') == 1
+
+
+@pytest.mark.parametrize('strategy', ['round_robin', 'weighted_round_robin', 'random', 'power_of_two',
+                                      'least_latency', 'consistent_hash'])
+def test_excluded_and_full_proxies_are_not_picked(strategy):
+    members = _members(3, max_active=1)
+    pool = Pool('Test', strategy, members)
+    members[1].acquire()
+    assert set(_hosts(pool, 20, exclude={members[0]})) == {'10.0.0.3'}
+    assert pool.select(exclude={members[0], members[2]}) is None
+
+
+def test_nothing_is_picked_while_the_pool_is_at_its_cap():
+    pool = Pool('Test', 'round_robin', _members(2), max_active=1)
+    member = pool.select()
+    member.acquire()
+    assert pool.select() is None
+    assert pool.blocked()
+    member.release()
+    assert pool.select() is not None
+
+
+def test_power_of_two_picks_the_less_busy_proxy():
+    idle, busy = _members(2)
+    busy.active = 5
+    pool = Pool('Test', 'power_of_two', [idle, busy])
+    assert set(_hosts(pool, 20)) == {idle.host}
+
+
+def test_least_latency_picks_the_faster_proxy():
+    fast, slow = _members(2)
+    fast.score.update(connect_time=0.01, ttfb=0.05)
+    slow.score.update(connect_time=0.5, ttfb=1)
+    pool = Pool('Test', 'least_latency', [fast, slow])
+    assert set(_hosts(pool, 20)) == {fast.host}
+
+
+def test_errors_raise_the_cost_of_a_proxy():
+    score = ProxyScore()
+    score.update(connect_time=0.1, ttfb=0.1)
+    cost = score.cost()
+    score.update(connect_time=0.1, ttfb=0.1, error=True)
+    assert score.error_rate == pytest.approx(0.3)
+    assert score.cost() > cost
+    assert score.cost(active=1) == pytest.approx(score.cost() * 2)
+
+
+def test_consistent_hash_keeps_a_key_on_its_proxy():
+    pool = Pool('Test', 'consistent_hash', _members(5), hash_key='host')
+    picked = pool.select(affinity={'host': 'example.com'})
+    assert all(pool.select(affinity={'host': 'example.com'}) is picked for _ in range(10))
+    # Only goes elsewhere while the proxy can not be used
+    assert pool.select(exclude={picked}, affinity={'host': 'example.com'}) is not picked
+    assert pool.select(affinity={'host': 'example.com'}) is picked
+
+
+def test_rate_limited_proxy_is_passed_over_for_one_with_a_token():
+    members = _members(2)
+    pool = Pool('Test', 'round_robin', members)
+    delays = {members[0]: 1.0, members[1]: 0}
+    assert {pool.select(delay=delays.get) for _ in range(4)} == {members[1]}
+    delays[members[1]] = 0.5
+    assert {pool.select(delay=delays.get) for _ in range(4)} == {members[1]}
+
+
+def test_table_falls_back_to_the_next_pool():
+    table = PoolTable()
+    table.load([{'Name': 'First', 'Proxies': [{'Host': '10.0.0.1'}]},
+                {'Name': 'Second', 'Proxies': [{'Host': '10.0.0.2'}]}])
+    first = table['First'].members[0]
+    assert table.select(['First', 'Second']) == (first, 'First')
+    assert table.select(['Missing', 'First', 'Second'], exclude={first}) == (table['Second'].members[0], 'Second')
+    assert table.select(['First'], exclude={first}) == (None, None)
+
+
+def test_breaker_opens_after_threshold_failures_in_a_row():
+    breaker = CircuitBreaker(threshold=3, cooldown=10)
+    assert not breaker.failure()
+    assert not breaker.failure()
+    assert not breaker.success()
+    assert not breaker.failure()
+    assert not breaker.failure()
+    assert breaker.failure()
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_half_open_breaker_closes_on_success_and_backs_off_on_failure():
+    breaker = CircuitBreaker(threshold=3, cooldown=10, max_cooldown=30)
+    breaker.trip()
+    for cooldown in (20, 30, 30):
+        breaker.state = CircuitBreaker.HALF_OPEN
+        assert breaker.failure()
+        assert (breaker.state, breaker.cooldown) == (CircuitBreaker.OPEN, cooldown)
+    breaker.state = CircuitBreaker.HALF_OPEN
+    assert breaker.success()
+    assert (breaker.state, breaker.cooldown, breaker.failures) == (CircuitBreaker.CLOSED, 10, 0)
+
+
+def test_failing_proxy_is_ejected_and_let_back_in_on_trial():
+    members = _members(2, breaker_threshold=2, breaker_cooldown=0.1)
+    pool = Pool('Test', 'round_robin', members)
+
+    async def main():
+        members[0].connect_failed()
+        members[0].connect_failed()
+        assert pool.available == [members[1]]
+        assert set(_hosts(pool, 4)) == {members[1].host}
+        await asyncio.sleep(0.2)
+        assert members[0].breaker.state == CircuitBreaker.HALF_OPEN
+        assert members[0] in pool.available
+        members[0].connect_succeeded()
+        assert members[0].breaker.state == CircuitBreaker.CLOSED
+        assert set(_hosts(pool, 4)) == {members[0].host, members[1].host}
+
+    asyncio.get_event_loop().run_until_complete(main())
+
+
+def test_ejected_proxy_stays_out_after_a_reload():
+    table = PoolTable()
+    config = [{'Name': 'Test', 'Proxies': [{'Host': '10.0.0.1'}, {'Host': '10.0.0.2'}]}]
+
+    async def main():
+        table.load(config, breaker_threshold=1, breaker_cooldown=0.1)
+        table['Test'].members[0].connect_failed()
+        table.load(config, breaker_threshold=1, breaker_cooldown=0.1)
+        assert [m.host for m in table['Test'].available] == ['10.0.0.2']
+        await asyncio.sleep(0.2)
+        assert [m.host for m in table['Test'].available] == ['10.0.0.2', '10.0.0.1']
+
+    asyncio.get_event_loop().run_until_complete(main())
@@ -0,0 +1,67 @@
+import asyncio
+
+from pools import PoolMember
+from proxy import Proxy
+from resolver import DnsCache, DnsEntry, dns_cache
+from tls import tls_sessions
+
+
+def test_connect_tries_the_other_addresses_of_the_host(monkeypatch):
+    async def handle(reader, writer):
+        writer.close()
+
+    async def main():
+        server = await asyncio.start_server(handle, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        # Nothing listens on 127.0.0.3, so every other connect starts with an address that is refused
+        monkeypatch.setitem(dns_cache._entries, 'proxy.test', DnsEntry(['127.0.0.3', '127.0.0.1'], 300))
+        member = PoolMember('proxy.test', port, breaker_threshold=1)
+        try:
+            for _ in range(4):
+                proxy = Proxy(member, timeout=5)
+                await proxy.connect()
+                assert proxy.writer.get_extra_info('peername')[0] == '127.0.0.1'
+                proxy.close()
+        finally:
+            server.close()
+        assert member.breaker.failures == 0
+
+    asyncio.get_event_loop().run_until_complete(main())
+
+
+def test_addresses_are_handed_out_in_turn():
+    entry = DnsEntry(['10.0.0.1', '10.0.0.2', '10.0.0.3'], 300)
+    assert entry.ordered() == ['10.0.0.1', '10.0.0.2', '10.0.0.3']
+    assert entry.ordered() == ['10.0.0.2', '10.0.0.3', '10.0.0.1']
+    assert entry.ordered() == ['10.0.0.3', '10.0.0.1', '10.0.0.2']
+
+
+def test_expired_failure_is_looked_up_again(monkeypatch):
+    answers = [OSError('down'), [(0, 0, 0, '', ('10.0.0.1', 0))]]
+
+    async def getaddrinfo(host, port, type=None):
+        answer = answers.pop(0)
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+    async def main():
+        monkeypatch.setattr(asyncio.get_event_loop(), 'getaddrinfo', getaddrinfo)
+        cache = DnsCache(ttl=300, error_ttl=0)
+        try:
+            await cache.resolve('proxy.test')
+        except OSError:
+            pass
+        else:
+            raise AssertionError('The first lookup should fail')
+        assert await cache.resolve('proxy.test') == '10.0.0.1'
+
+    asyncio.get_event_loop().run_until_complete(main())
+
+
+def test_tls_sessions_are_kept_apart_for_each_port():
+    assert tls_sessions.context(443) is tls_sessions.context(443)
+    assert tls_sessions.context(443) is not tls_sessions.context(8443)
+    assert tls_sessions.context(443) is not tls_sessions.context(443, verify=True)
+    assert PoolMember('proxy.test', 443, tls=True).ssl_context is PoolMember('other.test', 443, tls=True).ssl_context
+    assert PoolMember('proxy.test', 8443).ssl_context is None
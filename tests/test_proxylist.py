@@ -0,0 +1,68 @@
+import pytest
+
+from pools import PoolTable
+from proxylist import check_proxy, parse_proxy, read_proxy_file
+
+
+@pytest.mark.parametrize('text, proxy', [
+    ('10.0.0.1', {'Host': '10.0.0.1'}),
+    ('10.0.0.1:3128', {'Host': '10.0.0.1', 'Port': 3128}),
+    ('socks5://user:p@ss@proxy.test:1080', {'Types': ('socks5',), 'User': 'user', 'Pass': 'p@ss',
+                                            'Host': 'proxy.test', 'Port': 1080}),
+    ('http://[::1]:8080', {'Types': ('http', 'https'), 'Host': '::1', 'Port': 8080}),
+    ('::1', {'Host': '::1'}),
+])
+def test_parse_proxy(text, proxy):
+    assert parse_proxy(text) == proxy
+
+
+@pytest.mark.parametrize('text', ['ftp://10.0.0.1', 'user:pass@', '10.0.0.1:port', 'a:b:c'])
+def test_parse_proxy_rejects_bad_proxies(text):
+    with pytest.raises(ValueError):
+        parse_proxy(text)
+
+
+def test_plain_list_skips_blank_lines_and_comments(tmp_path):
+    path = tmp_path / 'proxies.txt'
+    path.write_text('# Office proxies\n10.0.0.1:3128\n\n  socks4://10.0.0.2:1080  \n')
+    assert list(read_proxy_file(str(path))) == [{'Host': '10.0.0.1', 'Port': 3128},
+                                                {'Types': ('socks4',), 'Host': '10.0.0.2', 'Port': 1080}]
+
+
+def test_csv_list_is_read_by_its_header(tmp_path):
+    path = tmp_path / 'proxies.csv'
+    path.write_text('Host,Port,Types,Tls,Rate_Limit,Notes\n'
+                    '10.0.0.1,3128,http;https,yes,2.5,first\n'
+                    '# 10.0.0.9,3128\n'
+                    '10.0.0.2,8080,,,,\n')
+    assert list(read_proxy_file(str(path))) == [
+        {'Host': '10.0.0.1', 'Port': 3128, 'Types': ['http', 'https'], 'Tls': True, 'Rate_Limit': 2.5},
+        {'Host': '10.0.0.2', 'Port': 8080}]
+
+
+@pytest.mark.parametrize('name, text, error', [
+    ('proxies.txt', '10.0.0.1\nftp://10.0.0.2\n', 'proxies.txt:2: Unknown scheme'),
+    ('proxies.csv', 'host,port\n10.0.0.1,80\n10.0.0.2,http\n', 'proxies.csv:3:'),
+    ('proxies.csv', 'port\n80\n', 'needs a `host` column'),
+])
+def test_bad_line_is_reported_with_its_line_number(tmp_path, name, text, error):
+    path = tmp_path / name
+    path.write_text(text)
+    with pytest.raises(ValueError, match=error):
+        list(read_proxy_file(str(path)))
+
+
+@pytest.mark.parametrize('proxy', [{'Port': 80}, {'Host': '10.0.0.1', 'Port': '80'},
+                                   {'Host': '10.0.0.1', 'Tls': 'yes'}, {'Host': '10.0.0.1', 'Types': 'http'}])
+def test_check_proxy_rejects_badly_written_proxies(proxy):
+    with pytest.raises(ValueError):
+        check_proxy(proxy)
+
+
+def test_pool_has_its_proxies_followed_by_the_ones_in_its_file(tmp_path):
+    path = tmp_path / 'proxies.txt'
+    path.write_text(''.join(f'10.1.{i // 256}.{i % 256}:3128\n' for i in range(1000)))
+    pools = PoolTable().build([{'Name': 'Test', 'Proxies': [{'Host': '10.0.0.1'}], 'Proxy_File': str(path)}])
+    members = pools['Test'].members
+    assert len(members) == 1001
+    assert (members[0].host, members[1].host, members[-1].host) == ('10.0.0.1', '10.1.0.0', '10.1.3.231')
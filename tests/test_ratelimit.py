@@ -0,0 +1,61 @@
+import pytest
+
+from pools import PoolMember
+from ratelimit import RateScheduler, TokenBucket
+from routing import Route
+
+
+def test_bucket_allows_a_burst_then_spaces_requests_out():
+    bucket = TokenBucket(rate=2, burst=3, now=0)
+    assert [bucket.take(0) for _ in range(3)] == [0, 0, 0]
+    assert bucket.delay(0) == pytest.approx(0.5)
+    assert bucket.take(0) == pytest.approx(0.5)
+    # In debt now, so the next one waits behind it
+    assert bucket.take(0) == pytest.approx(1)
+
+
+def test_bucket_tops_up_with_time_but_not_past_the_burst():
+    bucket = TokenBucket(rate=2, burst=3, now=0)
+    for _ in range(3):
+        bucket.take(0)
+    assert bucket.delay(0.5) == 0
+    assert not bucket.full(1)
+    assert bucket.full(1.5)
+    bucket.delay(100)
+    assert bucket.tokens == 3
+
+
+def test_delay_does_not_take_a_token():
+    bucket = TokenBucket(rate=1, now=0)
+    assert bucket.delay(0) == 0
+    assert bucket.delay(0) == 0
+    assert bucket.take(0) == 0
+    assert bucket.delay(0) == pytest.approx(1)
+
+
+def test_request_waits_for_the_slower_of_the_proxy_and_host_buckets():
+    scheduler = RateScheduler()
+    member = PoolMember('10.0.0.1', 8080, rate=10, burst=1)
+    route = Route('Test', host_rate=1, host_burst=1)
+    now = member.bucket.updated
+    assert scheduler.take(member, 'example.com', route, now) == 0
+    assert scheduler.delay(member, 'example.com', route, now) == pytest.approx(1)
+    assert scheduler.delay(member, 'other.com', route, now + 0.1) == 0
+    assert scheduler.take(member, 'example.com', route, now + 0.1) == pytest.approx(0.9)
+    assert (scheduler.delayed, scheduler.delay_time) == (1, pytest.approx(0.9))
+
+
+def test_host_buckets_that_topped_up_are_dropped():
+    scheduler = RateScheduler(max_buckets=3)
+    member = PoolMember('10.0.0.1', 8080)
+    route = Route('Test', host_rate=1, host_burst=1)
+    scheduler.take(member, 'a.com', route, 0)
+    scheduler.take(member, 'b.com', route, 0.5)
+    # `a.com` has topped up by now, `b.com` has not
+    scheduler.take(member, 'c.com', route, 1)
+    assert list(scheduler._buckets) == [(member.host, member.port, 'b.com'), (member.host, member.port, 'c.com')]
+    scheduler.take(member, 'd.com', route, 1)
+    scheduler.take(member, 'e.com', route, 1)
+    # Past `max_buckets` the oldest goes even though it has not topped up
+    assert len(scheduler._buckets) == 3
+    assert scheduler.evicted == 2
@@ -0,0 +1,79 @@
+import asyncio
+
+import pytest
+
+from errors import ErrorOnStream
+from relay import Relay
+from timeouts import TimerWheel
+
+
+async def _pair():
+    """Both ends of a connection on localhost, as (reader, writer) of the accepting side and of the connecting side"""
+    accepted = asyncio.get_event_loop().create_future()
+    server = await asyncio.start_server(lambda reader, writer: accepted.set_result((reader, writer)), '127.0.0.1', 0)
+    connected = await asyncio.open_connection('127.0.0.1', server.sockets[0].getsockname()[1])
+    server.close()
+    return await accepted, connected
+
+
+async def _relay(wheel, idle=0, on_response=None):
+    """A relay between a client and a proxy, with the ends the test talks through as the client and the proxy
+
+    The streams given to the relay are returned too, a writer closes its connection once it is garbage collected.
+    """
+    relayed_client, client = await _pair()
+    proxy, relayed_proxy = await _pair()
+    relay = Relay(*relayed_client, *relayed_proxy, wheel.add(idle=idle), on_response=on_response)
+    return relay, client, proxy, (relayed_client, relayed_proxy)
+
+
+def test_relays_both_ways_until_both_sides_are_done():
+    async def main():
+        (client_reader, client_writer), client = await _pair()
+        (proxy_reader, proxy_writer), (relay_reader, relay_writer) = await _pair()
+        # Sent before the relay starts, so it is already in the StreamReader and has to be passed on from there
+        client[1].write(b'early ')
+        await asyncio.sleep(0.05)
+        relay = Relay(client_reader, client_writer, relay_reader, relay_writer, TimerWheel().add())
+        running = asyncio.ensure_future(relay.run())
+
+        client[1].write(b'request')
+        client[1].write_eof()
+        assert await proxy_reader.read() == b'early request'
+        proxy_writer.write(b'response')
+        proxy_writer.write_eof()
+        assert await client[0].read() == b'response'
+        assert await asyncio.wait_for(running, 1) == (13, 8)
+
+    asyncio.get_event_loop().run_until_complete(main())
+
+
+def test_bad_first_response_aborts_the_relay():
+    def on_response(data):
+        if not data.startswith(b'HTTP/'):
+            raise ValueError(data)
+
+    async def main():
+        relay, (client_reader, client_writer), (proxy_reader, proxy_writer), _ = await _relay(
+            TimerWheel(), on_response=on_response)
+        running = asyncio.ensure_future(relay.run())
+        proxy_writer.write(b'garbage\r\n')
+        with pytest.raises(ErrorOnStream):
+            await asyncio.wait_for(running, 1)
+        assert await client_reader.read() == b''
+
+    asyncio.get_event_loop().run_until_complete(main())
+
+
+def test_idle_relay_is_aborted_by_its_deadline():
+    async def main():
+        wheel = TimerWheel(tick=0.05)
+        relay, (client_reader, client_writer), (proxy_reader, proxy_writer), _ = await _relay(wheel, idle=0.2)
+        running = asyncio.ensure_future(relay.run())
+        client_writer.write(b'request')
+        assert await proxy_reader.readexactly(7) == b'request'
+        with pytest.raises(ErrorOnStream):
+            await asyncio.wait_for(running, 1)
+        assert wheel.expired == 1
+
+    asyncio.get_event_loop().run_until_complete(main())
@@ -0,0 +1,85 @@
+import time
+import asyncio
+
+import pytest
+
+from pools import pool_table
+from reloader import ConfigReloader
+from routing import rule_table
+from utils import db_conn
+
+
+def _config(pool, *hosts):
+    return {'Pools': [{'Name': pool, 'Proxies': [{'Host': host} for host in hosts]}],
+            'Rules': [{'Name': pool, 'Port': 8989, 'Domains': ['.*'], 'Pools': [pool]}]}
+
+
+def _saved_proxies():
+    return sorted((row['host'], row['pool']) for row in db_conn.execute('SELECT host, pool FROM proxy'))
+
+
+def test_apply_swaps_in_and_saves_the_new_config():
+    config_reloader = ConfigReloader('config.yaml')
+
+    async def main():
+        await config_reloader.apply(_config('First', '10.0.0.1'))
+        await config_reloader.apply(_config('Second', '10.0.0.2', '10.0.0.3'))
+
+    asyncio.get_event_loop().run_until_complete(main())
+    assert [pool.name for pool in pool_table] == ['Second']
+    assert rule_table.match('example.com', 8989).pools == 'Second'
+    assert _saved_proxies() == [('10.0.0.2', 'Second'), ('10.0.0.3', 'Second')]
+    assert config_reloader.reloads == 2
+
+
+@pytest.mark.parametrize('config', [
+    {'Pools': [], 'Rules': [{'Name': 'Bad', 'Port': 8989, 'Domains': ['.*'], 'Pools': ['Missing']}]},
+    {'Pools': [{'Name': 'Bad', 'Proxies': [{'Port': 8080}]}], 'Rules': []},
+    {'Pools': [{'Name': 'Bad', 'Proxy_File': '/does/not/exist.txt'}], 'Rules': []},
+    ['not', 'a', 'mapping'],
+])
+def test_invalid_config_leaves_the_old_one_in_use(config):
+    config_reloader = ConfigReloader('config.yaml')
+
+    async def main():
+        await config_reloader.apply(_config('Good', '10.0.0.1'))
+        with pytest.raises(ValueError):
+            await config_reloader.apply(config)
+
+    asyncio.get_event_loop().run_until_complete(main())
+    assert [pool.name for pool in pool_table] == ['Good']
+    assert _saved_proxies() == [('10.0.0.1', 'Good')]
+    assert [pool['Name'] for pool in config_reloader.config['Pools']] == ['Good']
+
+
+def test_config_applied_later_wins_over_one_that_was_slower_to_build(monkeypatch):
+    config_reloader = ConfigReloader('config.yaml')
+    build = config_reloader._build
+
+    def slow_build(config):
+        if config['Pools'][0]['Name'] == 'Older':
+            time.sleep(0.2)
+        return build(config)
+
+    monkeypatch.setattr(config_reloader, '_build', slow_build)
+
+    async def main():
+        older = asyncio.ensure_future(config_reloader.apply(_config('Older', '10.0.0.1')))
+        await asyncio.sleep(0.05)
+        await config_reloader.apply(_config('Newer', '10.0.0.2'))
+        await older
+
+    asyncio.get_event_loop().run_until_complete(main())
+    assert [pool.name for pool in pool_table] == ['Newer']
+    assert _saved_proxies() == [('10.0.0.2', 'Newer')]
+    assert config_reloader.reloads == 1
+
+
+def test_save_of_an_older_generation_is_skipped(monkeypatch):
+    config_reloader = ConfigReloader('config.yaml')
+    written = []
+    monkeypatch.setattr(config_reloader, '_write', lambda pools, rows: written.append(pools))
+    config_reloader._generation = 2
+    config_reloader._save({'Older': None}, [], 1)
+    config_reloader._save({'Newer': None}, [], 2)
+    assert written == [{'Newer': None}]
@@ -0,0 +1,109 @@
+import re
+
+import pytest
+
+from routing import RuleTable, classify_rule, rule_rows
+
+
+def _table(*domains, port=8989):
+    """A rule table with a rule for each of the domains, ranked in order, each sending to a pool named by its index"""
+    rules = [{'Name': str(i), 'Port': port, 'Domains': [domain], 'Pools': [str(i)]}
+             for i, domain in enumerate(domains)]
+    table = RuleTable()
+    table.swap(table.compile(rule_rows(rules)))
+    return table
+
+
+def _pool(table, host, port=8989):
+    route = table.match(host, port)
+    return route.pools if route is not None else None
+
+
+@pytest.mark.parametrize('rule, host', [
+    ('google', 'www.google.com'),
+    ('google', 'google.com.au'),
+    ('httpbin.org', 'www.httpbin.org'),
+    ('httpbin.org', 'httpbin-org.com'),
+    (r'httpbin\.org', 'httpbin.org.evil.com'),
+    ('^foo', 'foo.bar.com'),
+    (r'example\.com$', 'notexample.com'),
+    (r'(.*\.)?example\.com', 'example.com.au'),
+])
+def test_unanchored_rules_keep_regex_search(rule, host):
+    assert classify_rule(rule) == ('regex', None)
+    assert re.search(rule, host)
+    assert _pool(_table(rule), host) == '0'
+
+
+@pytest.mark.parametrize('rule, expected', [
+    (r'^(.*\.)?httpbin\.org$', ('domain', 'httpbin.org')),
+    (r'^.*\.example\.com$', ('suffix', 'example.com')),
+    (r'^api\.ipify\.org$', ('exact', 'api.ipify.org')),
+    ('.*', ('domain', '')),
+    ('^api.ipify.org$', ('regex', None)),  # A bare `.` matches any character
+    ('.+', ('regex', None)),  # Does not match an empty host
+])
+def test_classify_rule(rule, expected):
+    assert classify_rule(rule) == expected
+
+
+@pytest.mark.parametrize('host', ['httpbin.org', 'www.httpbin.org', 'a.b.httpbin.org', 'xhttpbin.org',
+                                  'httpbin.org.au', 'api.ipify.org', 'ipify.org', '.example.com', 'a.example.com',
+                                  'example.com', 'HTTPBIN.ORG', 'httpbin.org:443', ''])
+def test_index_agrees_with_regex(host):
+    rules = [r'^(.*\.)?httpbin\.org$', r'^api\.ipify\.org$', r'^.*\.example\.com$', 'google', '.*']
+    expected = next(str(i) for i, rule in enumerate(rules) if re.search(rule, host))
+    assert _pool(_table(*rules), host) == expected
+
+
+def test_first_rule_wins():
+    table = _table('google', r'^(.*\.)?google\.com$')
+    assert _pool(table, 'www.google.com') == '0'
+    table = _table(r'^(.*\.)?google\.com$', 'google')
+    assert _pool(table, 'www.google.com') == '0'
+    assert _pool(table, 'google.de') == '1'
+
+
+def test_no_match():
+    table = _table(r'^(.*\.)?httpbin\.org$')
+    assert _pool(table, 'example.com') is None
+    assert _pool(table, 'httpbin.org', port=1) is None
+
+
+@pytest.mark.parametrize('change', [
+    {'Domains': 'x.com'},
+    {'Pools': 'Set A'},
+    {'Port': '8989'},
+    {'Pools': ['Set A,Set B']},
+    {'Domains': [1]},
+    {'Host_Rate_Limit': 'fast'},
+])
+def test_rule_rows_rejects_badly_written_rules(change):
+    rule = dict({'Name': 'Bad', 'Port': 8989, 'Domains': ['x.com'], 'Pools': ['Set A']}, **change)
+    with pytest.raises(ValueError):
+        rule_rows([rule])
+
+
+def test_repeat_lookups_come_from_the_cache():
+    table = _table(r'^(.*\.)?httpbin\.org$')
+    assert _pool(table, 'httpbin.org') == '0'
+    assert _pool(table, 'httpbin.org') == '0'
+    assert _pool(table, 'example.com') is None
+    assert _pool(table, 'example.com') is None
+    assert (table.hits, table.misses) == (2, 2)
+
+
+def test_cache_drops_the_least_recently_used_host():
+    table = _table('.*')
+    table.cache_size = 2
+    for host in ('a.com', 'b.com', 'a.com', 'c.com'):
+        table.match(host, 8989)
+    assert list(table._cache) == [(8989, 'a.com'), (8989, 'c.com')]
+
+
+def test_swap_forgets_the_cached_matches():
+    table = _table('google')
+    assert _pool(table, 'www.google.com') == '0'
+    table.swap(table.compile(rule_rows([{'Name': 'New', 'Port': 8989, 'Domains': ['example'], 'Pools': ['New']}])))
+    assert _pool(table, 'www.google.com') is None
+    assert _pool(table, 'example.com') == 'New'
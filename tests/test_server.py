@@ -0,0 +1,216 @@
+import socket
+import asyncio
+
+import pytest
+
+import server
+import proxy
+from errors import ProxyConnError
+from pools import pool_table
+from routing import rule_table, rule_rows
+from timeouts import TimerWheel
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _route(port, proxy_ports):
+    """Send every request to the port through a pool of proxies on localhost"""
+    pool_table.load([{'Name': 'Test', 'Proxies': [{'Host': '127.0.0.1', 'Port': p} for p in proxy_ports]}])
+    rule_table.swap(rule_table.compile(rule_rows([{'Name': 'Test', 'Port': port, 'Domains': ['.*'],
+                                                   'Pools': ['Test']}])))
+
+
+async def _start(handle_proxy, **options):
+    """A server on a free port that sends every request through a single proxy run by `handle_proxy`"""
+    proxy_server = await asyncio.start_server(handle_proxy, '127.0.0.1', 0)
+    port = _free_port()
+    _route(port, [proxy_server.sockets[0].getsockname()[1]])
+    srv = server.Server('127.0.0.1', port, loop=asyncio.get_event_loop(), **options)
+    await srv.listen()
+    return srv, proxy_server
+
+
+async def _wait_for(condition, timeout):
+    for _ in range(int(timeout / 0.05)):
+        if condition():
+            return True
+        await asyncio.sleep(0.05)
+    return condition()
+
+
+@pytest.mark.parametrize('head, status', [
+    (b'GET http://example.com/ HTTP/1.1\r\nHost: example.com\r\nCookie: ' + b'x' * 2048 + b'\r\n\r\n',
+     b'HTTP/1.1 431 Request Header Fields Too Large'),
+    (b'GET http://example.com/\r\nHost: example.com\r\n\r\n', b'HTTP/1.1 400 Bad Request'),
+    (b'GET http://example.com/ HTTP/1.1\r\n\r\n', b'HTTP/1.1 400 Bad Request'),
+])
+def test_request_head_that_can_not_be_used_is_turned_away(head, status):
+    async def handle_proxy(reader, writer):
+        writer.close()
+
+    async def main():
+        srv, proxy_server = await _start(handle_proxy, max_header_size=1024)
+        reader, writer = await asyncio.open_connection('127.0.0.1', srv.port)
+        try:
+            writer.write(head)
+            response = await asyncio.wait_for(reader.read(), 1)
+            assert response.split(b'\r\n')[0] == status
+        finally:
+            writer.close()
+            srv.close()
+            proxy_server.close()
+
+    asyncio.get_event_loop().run_until_complete(main())
+
+
+@pytest.mark.parametrize('queue_timeout, status', [(2, b'HTTP/1.1 200 OK'), (0.1, b'HTTP/1.1 503 Service Unavailable')])
+def test_request_past_the_cap_waits_for_a_slot(queue_timeout, status):
+    answer = asyncio.Event()
+
+    async def handle_proxy(reader, writer):
+        await reader.readuntil(b'\r\n\r\n')
+        await answer.wait()
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+        writer.close()
+
+    async def request(port):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(b'GET http://example.com/ HTTP/1.1\r\nHost: example.com\r\nConnection: close\r\n\r\n')
+        try:
+            return (await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 5)).split(b'\r\n')[0]
+        finally:
+            writer.close()
+
+    async def main():
+        srv, proxy_server = await _start(handle_proxy, max_connections=1, queue_timeout=queue_timeout)
+        try:
+            first = asyncio.ensure_future(request(srv.port))
+            assert await _wait_for(lambda: srv._limit.active == 1, timeout=1)
+            second = asyncio.ensure_future(request(srv.port))
+            assert await _wait_for(lambda: srv._limit.waiters, timeout=1)
+            if queue_timeout < 1:
+                assert await second == status
+            answer.set()
+            assert await first == b'HTTP/1.1 200 OK'
+            assert await second == status
+        finally:
+            srv.close()
+            proxy_server.close()
+
+    asyncio.get_event_loop().run_until_complete(main())
+
+
+def test_idle_timeout_stops_a_request_whose_client_stopped_reading(monkeypatch):
+    wheel = TimerWheel(tick=0.05)
+    monkeypatch.setattr(server, 'timer_wheel', wheel)
+    body = b'x' * (16 * 1024 * 1024)
+
+    async def handle_proxy(reader, writer):
+        await reader.readuntil(b'\r\n\r\n')
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n' % len(body) + body)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+    async def main():
+        srv, proxy_server = await _start(handle_proxy, idle_timeout=0.3)
+        reader, writer = await asyncio.open_connection('127.0.0.1', srv.port)
+        writer.write(b'GET http://example.com/ HTTP/1.1\r\nHost: example.com\r\n\r\n')
+        await reader.readuntil(b'\r\n\r\n')
+        # Never read the body, so the server is left waiting for the client to take it
+        try:
+            assert await _wait_for(lambda: not srv._connections, timeout=3)
+            assert wheel.expired == 1
+            assert [member.active for member in pool_table['Test'].members] == [0]
+        finally:
+            writer.close()
+            srv.close()
+            proxy_server.close()
+
+    asyncio.get_event_loop().run_until_complete(main())
+
+
+def test_cancelled_hedge_releases_both_proxies(monkeypatch):
+    port = _free_port()
+    _route(port, [1, 2])
+    hedge_failed = asyncio.Event()
+
+    async def connect(self, reuse=False):
+        if self.port == 1:
+            await asyncio.sleep(10)
+        hedge_failed.set()
+        raise ProxyConnError('Connection: failed')
+
+    monkeypatch.setattr(proxy.Proxy, 'connect', connect)
+
+    async def main():
+        srv = server.Server('127.0.0.1', port, loop=asyncio.get_event_loop(), hedge_percentile=50)
+        for _ in range(20):
+            srv._connect_times.add(0.01)
+        # Pick the slow proxy first, so the other one is raced in and fails while the first is still connecting
+        first = next(m for m in pool_table['Test'].members if m.port == 1)
+        first.acquire()
+        slow = proxy.Proxy(first)
+        connecting = asyncio.ensure_future(srv._connect(slow, 'Test', 'HTTP', {'Host': 'example.com'}, set()))
+        await asyncio.wait_for(hedge_failed.wait(), 1)
+        connecting.cancel()
+        try:
+            await connecting
+        except asyncio.CancelledError:
+            pass
+        slow.close()  # Done by `_relay_request` for the proxy it passed in
+        assert [member.active for member in pool_table['Test'].members] == [0, 0]
+
+    asyncio.get_event_loop().run_until_complete(main())
+
+
+@pytest.mark.parametrize('side, method, error', [
+    ('writer', 'drain', BrokenPipeError),
+    ('writer', 'drain', ConnectionResetError),
+    ('reader', 'readuntil', ConnectionResetError),
+])
+def test_reused_connection_that_was_closed_is_sent_again(side, method, error):
+    connections = []
+
+    async def handle_proxy(reader, writer):
+        connections.append(writer)
+        try:
+            while True:
+                head = await reader.readuntil(b'\r\n\r\n')
+                body = await reader.readexactly(int(head.split(b'Content-Length: ')[1].split(b'\r\n')[0]))
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n' % len(body) + body)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+
+    async def request(reader, writer, body):
+        writer.write(b'POST http://example.com/ HTTP/1.1\r\nHost: example.com\r\nContent-Length: %d\r\n\r\n'
+                     % len(body) + body)
+        head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 5)
+        return head.split(b'\r\n')[0], await reader.readexactly(len(body))
+
+    async def main():
+        srv, proxy_server = await _start(handle_proxy)
+        reader, writer = await asyncio.open_connection('127.0.0.1', srv.port)
+        try:
+            assert await request(reader, writer, b'first') == (b'HTTP/1.1 200 OK', b'first')
+            # Break the idle connection the way a proxy that closed it would show up on its next use
+            idle = pool_table['Test'].members[0].connections._idle[0]
+            stream = idle[0] if side == 'reader' else idle[1]
+
+            async def fail(*args, **kwargs):
+                raise error()
+            setattr(stream, method, fail)
+
+            assert await request(reader, writer, b'second') == (b'HTTP/1.1 200 OK', b'second')
+            assert len(connections) == 2
+        finally:
+            writer.close()
+            srv.close()
+            proxy_server.close()
+
+    asyncio.get_event_loop().run_until_complete(main())
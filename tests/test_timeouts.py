@@ -0,0 +1,106 @@
+import time
+import asyncio
+
+from timeouts import TimerWheel
+
+
+def _run(main):
+    asyncio.get_event_loop().run_until_complete(main())
+
+
+def test_idle_deadline_expires_once_nothing_moves():
+    wheel = TimerWheel(tick=0.05)
+    expired = []
+
+    async def main():
+        wheel.add(idle=0.1, on_expire=lambda: expired.append(time.monotonic()))
+        started = time.monotonic()
+        await asyncio.sleep(0.3)
+        assert len(expired) == 1
+        # Due after 0.1s, expired within a tick of that
+        assert 0.1 <= expired[0] - started <= 0.2
+
+    _run(main)
+    assert (len(wheel), wheel.expired) == (0, 1)
+
+
+def test_touch_puts_off_the_idle_timeout():
+    wheel = TimerWheel(tick=0.05)
+    expired = []
+
+    async def main():
+        deadline = wheel.add(idle=0.15, on_expire=lambda: expired.append(True))
+        for _ in range(6):
+            await asyncio.sleep(0.05)
+            deadline.touch()
+        assert not expired
+        await asyncio.sleep(0.3)
+        assert expired == [True]
+
+    _run(main)
+
+
+def test_lifetime_expires_even_while_data_moves():
+    wheel = TimerWheel(tick=0.05)
+    expired = []
+
+    async def main():
+        deadline = wheel.add(idle=1, lifetime=0.15, on_expire=lambda: expired.append(True))
+        for _ in range(6):
+            await asyncio.sleep(0.05)
+            deadline.touch()
+        assert expired == [True]
+
+    _run(main)
+
+
+def test_cancelled_deadline_never_expires():
+    wheel = TimerWheel(tick=0.05)
+    expired = []
+
+    async def main():
+        wheel.add(idle=0.1, on_expire=lambda: expired.append(True)).cancel()
+        assert len(wheel) == 0
+        await asyncio.sleep(0.2)
+
+    _run(main)
+    assert not expired
+    assert wheel._handle is None  # Nothing left to check, so the wheel stopped its timer
+
+
+def test_deadline_further_than_a_turn_goes_round_the_wheel():
+    wheel = TimerWheel(tick=0.02, slots=4)
+    expired = []
+
+    async def main():
+        wheel.add(idle=0.2, on_expire=lambda: expired.append(True))
+        await asyncio.sleep(0.1)
+        assert not expired
+        await asyncio.sleep(0.2)
+        assert expired == [True]
+
+    _run(main)
+
+
+def test_deadline_without_timeouts_is_not_tracked():
+    wheel = TimerWheel()
+    wheel.add()
+    assert len(wheel) == 0
+    assert wheel._handle is None
+
+
+def test_failing_callback_does_not_stop_the_others():
+    wheel = TimerWheel(tick=0.05)
+    expired = []
+
+    def fail():
+        raise RuntimeError('Failed')
+
+    async def main():
+        wheel.add(idle=0.05, on_expire=fail)
+        wheel.add(idle=0.05, on_expire=lambda: expired.append(True))
+        await asyncio.sleep(0.2)
+
+    _run(main)
+    assert expired == [True]
+    assert wheel.expired == 2
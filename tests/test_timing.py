@@ -0,0 +1,70 @@
+import asyncio
+from types import SimpleNamespace
+
+from timing import PHASES, RequestTiming, SlowRequestProfiler
+
+
+def test_phases_add_up_over_every_proxy_tried():
+    timing = RequestTiming(started=0)
+    timing.add('connect', 0.25)
+    timing.add('connect', 0.5)
+    assert timing.connect == 0.75
+    assert timing.dns is None
+
+
+def test_finish_splits_the_relay_into_first_byte_and_stream(monkeypatch):
+    timing = RequestTiming(started=100.0)
+    monkeypatch.setattr('timing.time.monotonic', lambda: 103.0)
+    timing.finish(sent=101.0, first_byte=101.5)
+    assert timing.to_dict() == dict(dict.fromkeys(PHASES), first_byte=500.0, stream=1500.0, total=3000.0)
+
+
+def test_finish_without_sending_only_has_the_total(monkeypatch):
+    timing = RequestTiming(started=100.0)
+    monkeypatch.setattr('timing.time.monotonic', lambda: 100.5)
+    timing.finish()
+    assert (timing.first_byte, timing.stream, timing.total) == (None, None, 0.5)
+
+
+def test_profiler_samples_the_stack_of_a_slow_request():
+    profiler = SlowRequestProfiler(threshold=0.05, sample_rate=1, interval=0.05)
+
+    async def slow_request():
+        watch = profiler.watch()
+        try:
+            await asyncio.sleep(0.3)
+        finally:
+            watch.cancel()
+
+    async def fast_request():
+        watch = profiler.watch()
+        watch.cancel()
+
+    async def main():
+        await fast_request()
+        assert profiler.samples == 0
+        await slow_request()
+
+    asyncio.get_event_loop().run_until_complete(main())
+    assert profiler.samples >= 3
+    assert all('slow_request' in stack for stack in profiler.stacks)
+
+
+def test_profiler_only_watches_when_turned_on():
+    async def main():
+        assert SlowRequestProfiler(threshold=0).watch() is None
+        assert SlowRequestProfiler(threshold=1, sample_rate=0).watch() is None
+
+    asyncio.get_event_loop().run_until_complete(main())
+
+
+def test_profiler_drops_new_stacks_past_its_limit():
+    def frame(name, line):
+        return SimpleNamespace(f_code=SimpleNamespace(co_filename='/repo/server.py', co_name=name), f_lineno=line)
+
+    profiler = SlowRequestProfiler(threshold=1, max_stacks=1)
+    profiler.add([frame('_accept', 1), frame('_stream', 2)])
+    profiler.add([frame('_accept', 1), frame('_stream', 2)])
+    profiler.add([frame('_accept', 1), frame('_connect', 3)])
+    assert profiler.stacks == {'server.py:_accept:1;server.py:_stream:2': 2}
+    assert (profiler.samples, profiler.dropped) == (3, 1)
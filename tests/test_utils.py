@@ -0,0 +1,38 @@
+import pytest
+
+import utils
+from errors import BadStatusLine
+from utils import parse_headers
+
+
+@pytest.fixture(params=['python', 'httptools'])
+def parser(request, monkeypatch):
+    """Run the test with the request heads parsed by each of the parsers"""
+    if request.param == 'httptools':
+        monkeypatch.setattr(utils, 'httptools', pytest.importorskip('httptools'))
+    else:
+        monkeypatch.setattr(utils, 'httptools', None)
+
+
+def test_request_head_is_parsed_without_the_body(parser):
+    headers = parse_headers(b'POST http://example.com/path HTTP/1.1\r\nHost: example.com:8080\r\n'
+                            b'content-length: 4\r\n\r\nbody')
+    assert headers == {'Version': 'HTTP/1.1', 'Method': 'POST', 'Path': 'http://example.com/path',
+                       'Host': 'example.com', 'Port': 8080, 'Content-Length': '4'}
+
+
+def test_connect_request_has_the_host_and_port_of_the_tunnel(parser):
+    headers = parse_headers(b'CONNECT example.com:443 HTTP/1.1\r\nHost: example.com:443\r\n\r\n')
+    assert (headers['Method'], headers['Host'], headers['Port']) == ('CONNECT', 'example.com', 443)
+
+
+@pytest.mark.parametrize('head', [b'GET /\r\nHost: example.com\r\n\r\n',
+                                  b'GET / HTTP/1.1\r\nHost example.com\r\n\r\n'])
+def test_bad_request_head_is_rejected(parser, head):
+    with pytest.raises(BadStatusLine):
+        parse_headers(head)
+
+
+def test_response_head_is_parsed():
+    headers = parse_headers(b'HTTP/1.1 404 not found\r\nContent-Length: 0\r\n\r\n')
+    assert (headers['Status'], headers['Reason'], headers['Content-Length']) == (404, 'Not Found', '0')
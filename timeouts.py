@@ -0,0 +1,148 @@
+import time
+import asyncio
+import logging
+
+from config import CONFIG
+
+logger = logging.getLogger(__name__)
+
+
+class Deadline:
+    """The idle and lifetime timeouts of one relay, see :class:`TimerWheel`
+
+    :param wheel: The :class:`TimerWheel` checking it
+    :param float idle: Seconds without any data before it expires, 0 for no idle timeout
+    :param float expires: `time.monotonic()` it expires at no matter what, None for no lifetime
+    :param on_expire: Called once it expires, can be replaced until then
+    :param float now: `time.monotonic()` it is made at
+    """
+    __slots__ = ('wheel', 'idle', 'expires', 'on_expire', 'last_activity', 'slot')
+
+    def __init__(self, wheel, idle, expires, on_expire, now):
+        self.wheel = wheel
+        self.idle = idle
+        self.expires = expires
+        self.on_expire = on_expire
+        self.last_activity = now
+        self.slot = None  # Index of the slot it is in, None when it is not in the wheel
+
+    def touch(self):
+        """Data moved, only saves the time so it is cheap enough to call for every chunk"""
+        self.last_activity = time.monotonic()
+
+    def due(self):
+        """`time.monotonic()` it expires at if nothing moves before then"""
+        due = self.last_activity + self.idle if self.idle else None
+        if self.expires is not None and (due is None or self.expires < due):
+            due = self.expires
+        return due
+
+    def cancel(self):
+        self.wheel.cancel(self)
+
+
+class TimerWheel:
+    """Idle and lifetime timeouts for every relay, checked in bulk
+
+    Instead of a timer for every read, each relay has a :class:`Deadline`
+    that only has its time saved when data moves. Deadlines are put in the
+    slot of the tick they are due in, and every `tick` seconds only that
+    slot is looked at. The ones that saw data since they were put there are
+    moved to the slot they are now due in, the rest are expired together.
+    So the loop has one timer however many relays are open, and a timeout
+    fires up to `tick` seconds late. Deadlines due more than `slots` ticks
+    away just go round the wheel again.
+
+    :param float tick: (optional) Seconds between checks
+    :param int slots: (optional) Slots in the wheel
+    """
+    def __init__(self, tick=1, slots=512):
+        self.tick = tick
+        self.slots = slots
+        self._slots = [set() for _ in range(slots)]
+        self._count = 0
+        self._current = 0  # Last tick that was checked
+        self._handle = None
+        self._loop = None
+        self.expired = 0
+
+    def __len__(self):
+        return self._count
+
+    def add(self, idle=0, lifetime=0, on_expire=None):
+        """Start the timeouts of a relay
+
+        Keyword Arguments:
+            idle {float} -- Seconds without any data before it expires, 0 to never (default: {0})
+            lifetime {float} -- Seconds before it expires even if data is moving, 0 to never (default: {0})
+            on_expire {callable} -- Called once it expires (default: {None})
+
+        Returns:
+            Deadline -- `touch` it whenever data moves and `cancel` it once the relay is done
+        """
+        now = time.monotonic()
+        deadline = Deadline(self, idle, now + lifetime if lifetime else None, on_expire, now)
+        if idle or lifetime:
+            if self._handle is None:
+                # Got the loop here instead of when made, so workers forked after it use their own
+                self._loop = asyncio.get_event_loop()
+                self._current = int(now / self.tick)
+                self._handle = self._loop.call_later(self.tick, self._run)
+            self._insert(deadline, deadline.due())
+        return deadline
+
+    def cancel(self, deadline):
+        if deadline.slot is not None:
+            self._slots[deadline.slot].discard(deadline)
+            deadline.slot = None
+            self._count -= 1
+
+    def _insert(self, deadline, due):
+        tick = int(due / self.tick) + 1
+        if tick <= self._current:
+            tick = self._current + 1
+        deadline.slot = tick % self.slots
+        self._slots[deadline.slot].add(deadline)
+        self._count += 1
+
+    def _run(self):
+        now = time.monotonic()
+        target = int(now / self.tick)
+        expired = []
+        # Also catch up on the ticks missed while the loop was busy, a full turn at most
+        for tick in range(max(self._current + 1, target - self.slots + 1), target + 1):
+            index = tick % self.slots
+            slot = self._slots[index]
+            if not slot:
+                continue
+            self._slots[index] = set()
+            self._count -= len(slot)
+            for deadline in slot:
+                deadline.slot = None
+                due = deadline.due()
+                if due <= now:
+                    expired.append(deadline)
+                else:
+                    self._insert(deadline, due)
+        self._current = target
+
+        for deadline in expired:
+            self.expired += 1
+            try:
+                if deadline.on_expire is not None:
+                    deadline.on_expire()
+            except Exception:
+                logger.exception('Failed to expire a relay')
+
+        if self._count:
+            self._handle = self._loop.call_later(self.tick, self._run)
+        else:
+            self._handle = None
+
+    def stats(self):
+        return {'relays': self._count,
+                'expired': self.expired,
+                }
+
+
+timer_wheel = TimerWheel(tick=CONFIG.get('Server', {}).get('Timeout_Tick', 1))
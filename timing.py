@@ -0,0 +1,161 @@
+import os
+import time
+import random
+import asyncio
+import logging
+
+from config import CONFIG
+
+logger = logging.getLogger(__name__)
+
+# The phases of a request, in the order they happen
+PHASES = ('parse', 'queue', 'route', 'select', 'dns', 'connect', 'tls', 'first_byte', 'stream', 'total')
+
+
+class RequestTiming:
+    """Seconds each phase of a single request took
+
+    Only `time.monotonic()` is read along the way, nothing is formatted until
+    the request is logged. Queue, route, select, dns, connect and tls are added up
+    over every proxy that was tried, so with retries or hedging they can add
+    up to more than the time the request waited. Phases that never happened
+    stay None.
+
+    :param float started: (optional) `time.monotonic()` when the request head was read
+    """
+    __slots__ = PHASES + ('started',)
+
+    def __init__(self, started=None):
+        self.started = started if started is not None else time.monotonic()
+        self.parse = None
+        self.queue = None
+        self.route = None
+        self.select = None
+        self.dns = None
+        self.connect = None
+        self.tls = None
+        self.first_byte = None
+        self.stream = None
+        self.total = None
+
+    def add(self, phase, seconds):
+        current = getattr(self, phase)
+        setattr(self, phase, seconds if current is None else current + seconds)
+
+    def finish(self, sent=None, first_byte=None):
+        """Work out the phases after the request was sent, once it is done
+
+        Keyword Arguments:
+            sent {float} -- `time.monotonic()` when the request started being relayed (default: {None})
+            first_byte {float} -- `time.monotonic()` when the response started (default: {None})
+        """
+        ended = time.monotonic()
+        if sent:
+            if first_byte is not None:
+                self.first_byte = first_byte - sent
+            self.stream = ended - (first_byte or sent)
+        self.total = ended - self.started
+
+    def values(self):
+        return (self.parse, self.queue, self.route, self.select, self.dns, self.connect, self.tls,
+                self.first_byte, self.stream, self.total)
+
+    def to_dict(self):
+        """Milliseconds of each phase"""
+        return {phase: round(val * 1000, 3) if val is not None else None
+                for phase, val in zip(PHASES, self.values())}
+
+
+class _Watch:
+    """Samples the stack of one request until it is done"""
+    __slots__ = ('profiler', 'task', 'loop', 'handle')
+
+    def __init__(self, profiler, task, loop):
+        self.profiler = profiler
+        self.task = task
+        self.loop = loop
+        self.handle = loop.call_later(profiler.threshold, self.sample)
+
+    def sample(self):
+        if self.task.done():
+            return
+        # `Task.get_stack` stops at the task's own coroutine, follow what each one is awaiting instead
+        frames = []
+        coro = self.task.get_coro()
+        while coro is not None:
+            frame = getattr(coro, 'cr_frame', None) or getattr(coro, 'gi_frame', None)
+            if frame is None:
+                break
+            frames.append(frame)
+            coro = getattr(coro, 'cr_await', None) or getattr(coro, 'gi_yieldfrom', None)
+        self.profiler.add(frames)
+        self.handle = self.loop.call_later(self.profiler.interval, self.sample)
+
+    def cancel(self):
+        self.handle.cancel()
+
+
+class SlowRequestProfiler:
+    """Samples where slow requests spend their time
+
+    A `sample_rate` share of the requests are watched. Once a watched request
+    has run for `threshold` seconds its stack is taken every `interval`
+    seconds until it is done. The stacks are counted in the folded format,
+    `frame;frame;frame`, that flame graph tools read. Requests that are not
+    watched only cost a call to `random.random()`.
+
+    :param float threshold: Seconds a request runs before it counts as slow, 0 to turn off
+    :param float sample_rate: (optional) Share of the requests to watch, 0 - 1
+    :param float interval: (optional) Seconds between the stacks taken of a slow request
+    :param int max_stacks: (optional) Different stacks to count, new ones are dropped after that
+    """
+    def __init__(self, threshold=0, sample_rate=0.01, interval=0.1, max_stacks=1000):
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self.max_stacks = max_stacks
+        self.stacks = {}  # Folded stack -> samples
+        self.samples = 0
+        self.dropped = 0
+
+    @property
+    def enabled(self):
+        return self.threshold > 0 and self.sample_rate > 0
+
+    def watch(self, loop=None):
+        """Maybe watch the request running in the current task
+
+        Returns:
+            _Watch -- Cancel it once the request is done, None if the request is not watched
+        """
+        if not self.enabled or random.random() >= self.sample_rate:
+            return None
+        loop = loop or asyncio.get_event_loop()
+        task = asyncio.current_task(loop)
+        if task is None:
+            return None
+        return _Watch(self, task, loop)
+
+    def add(self, frames):
+        """Count a stack, `frames` goes from the outermost call in"""
+        stack = ';'.join(f'{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}:{frame.f_lineno}'
+                         for frame in frames)
+        self.samples += 1
+        if stack in self.stacks:
+            self.stacks[stack] += 1
+        elif len(self.stacks) < self.max_stacks:
+            self.stacks[stack] = 1
+        else:
+            self.dropped += 1
+
+    def stats(self):
+        return {'samples': self.samples,
+                'dropped': self.dropped,
+                'stacks': dict(self.stacks),
+                }
+
+
+_server_config = CONFIG.get('Server', {})
+profiler = SlowRequestProfiler(threshold=_server_config.get('Profile_Slow_Requests', 0),
+                               sample_rate=_server_config.get('Profile_Sample_Rate', 0.01),
+                               interval=_server_config.get('Profile_Interval', 0.1))
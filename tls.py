@@ -0,0 +1,101 @@
+import ssl
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class ResumingContext(ssl.SSLContext):
+    """SSLContext that resumes the last TLS session it had with a host
+
+    asyncio has no way to pass a session in when it opens a connection, so
+    the context picks it when asyncio wraps the connection instead. Resuming
+    skips the certificate exchange and most of the key exchange of a full
+    handshake. Only the hostname is known then, so each port gets its own
+    context, see `TlsSessions.context`.
+    """
+    def __new__(cls, protocol=ssl.PROTOCOL_TLS_CLIENT, *args, **kwargs):
+        self = super().__new__(cls, protocol, *args, **kwargs)
+        self.sessions = {}  # Server hostname -> the latest SSLSession
+        return self
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        if session is None and not server_side:
+            session = self.sessions.get(server_hostname)
+        return super().wrap_bio(incoming, outgoing, server_side, server_hostname, session)
+
+
+class TlsSessions:
+    """The shared TLS contexts, and how often connecting to each proxy resumed a session"""
+    def __init__(self):
+        self._contexts = {}
+        self._lock = threading.Lock()  # `context` is called from `pools.PoolTable.build` in another thread
+        self.full = 0
+        self.resumed = 0
+        self._proxies = {}  # `host:port` -> [full handshakes, resumed handshakes]
+
+    def context(self, port, verify=False):
+        """The context to use for a port and verify mode, made the first time it is asked for
+
+        Creating a context loads the CA certificates, so it is only done once
+        for each. Proxies on the same host but different ports are different
+        servers, keeping their contexts apart keeps them from being offered
+        each other's sessions.
+
+        Arguments:
+            port {int} -- Port of the proxy
+
+        Keyword Arguments:
+            verify {bool} -- Check the proxy's certificate and hostname (default: {False})
+        """
+        with self._lock:
+            context = self._contexts.get((port, verify))
+            if context is None:
+                context = ResumingContext()
+                if verify:
+                    context.load_default_certs()
+                else:
+                    context.check_hostname = False
+                    context.verify_mode = ssl.CERT_NONE
+                self._contexts[port, verify] = context
+        return context
+
+    def handshake_done(self, host, port, ssl_object):
+        """Count a finished handshake and keep its session to resume the next one with"""
+        counts = self._proxies.get(f'{host}:{port}')
+        if counts is None:
+            counts = self._proxies[f'{host}:{port}'] = [0, 0]
+        if ssl_object.session_reused:
+            self.resumed += 1
+            counts[1] += 1
+        else:
+            self.full += 1
+            counts[0] += 1
+        self.save(ssl_object)
+
+    def save(self, ssl_object):
+        """Keep the connection's session, with TLS 1.3 it only shows up after data has been read"""
+        context = ssl_object.context
+        session = ssl_object.session
+        if isinstance(context, ResumingContext) and session is not None:
+            context.sessions[ssl_object.server_hostname] = session
+
+    def stats(self, detail=True):
+        """Handshake counts for every proxy and the totals
+
+        Keyword Arguments:
+            detail {bool} -- Include the breakdown by proxy (default: {True})
+
+        Returns:
+            dict -- The totals and a breakdown by proxy, empty without `detail`
+        """
+        total = self.full + self.resumed
+        return {'full': self.full,
+                'resumed': self.resumed,
+                'resumption_rate': self.resumed / total if total else None,
+                'proxies': {proxy: {'full': full, 'resumed': resumed}
+                            for proxy, (full, resumed) in self._proxies.items()} if detail else {},
+                }
+
+
+tls_sessions = TlsSessions()
@@ -3,12 +3,20 @@ import sqlite3
 
 from errors import BadStatusLine
 
+try:
+    # Optional, parses request heads in C when it is installed
+    import httptools
+except ImportError:
+    httptools = None
+
 logger = logging.getLogger(__name__)
 
 
+DB_FILE = "stats.db"
+
 # Used globaly to keep track of the stats for a given pool
 db_conn = None
-db_conn = sqlite3.connect("stats.db", check_same_thread=False)
+db_conn = sqlite3.connect(DB_FILE, check_same_thread=False)
 db_conn.row_factory = sqlite3.Row
 
 try:
@@ -36,9 +44,17 @@ try:
                                rank NUMERIC,
                                rule varchar(1024),
                                rule_re varchar(1024),
-                               rule_type varchar(64)
+                               rule_type varchar(64),
+                               host_rate NUMERIC,
+                               host_burst NUMERIC
                            );
                         """)
+        # `stats.db` files made before the rate limits were added do not have their columns
+        for column in ('host_rate', 'host_burst'):
+            try:
+                db_conn.execute(f"ALTER TABLE pool_rule ADD COLUMN {column} NUMERIC")
+            except sqlite3.OperationalError:
+                pass  # Already there
         db_conn.execute("DELETE FROM pool_rule")  # Needed until we get a more fancy when the server starts
 except sqlite3.IntegrityError:
     logger.critical("Could not create the in menory `request` table")
@@ -71,18 +87,72 @@ def parse_status_line(line):
     return _headers
 
 
-def parse_headers(headers):
-    headers = headers.decode('utf-8', 'ignore').split('\r\n')
-    _headers = {}
-    _headers.update(parse_status_line(headers.pop(0)))
+def parse_headers(head):
+    """Parse the status line and headers of a request or response
+
+    Only the header block is decoded, anything after the blank line that ends
+    it (the start of the body) is ignored.
+
+    Arguments:
+        head {bytes} -- The header block, ending with a blank line
 
-    for h in headers:
-        if not h:
-            break
-        name, val = h.split(':', 1)
-        _headers[name.strip().title()] = val.strip()
+    Returns:
+        dict -- The fields of the status line, along with each header by its title cased name
+    """
+    if httptools is not None and not head.startswith(b'HTTP/'):
+        return _parse_request_httptools(head)
 
+    end = head.find(b'\r\n\r\n')
+    lines = (head[:end] if end != -1 else head).split(b'\r\n')
+    _headers = parse_status_line(lines[0].decode('latin-1'))
+
+    for line in lines[1:]:
+        name, sep, val = line.partition(b':')
+        if not sep:
+            raise BadStatusLine(line)
+        _headers[name.decode('latin-1').strip().title()] = val.decode('latin-1').strip()
+
+    return _split_host(_headers)
+
+
+def _split_host(_headers):
     if ':' in _headers.get('Host', ''):
-        host, port = _headers['Host'].split(':')
+        host, port = _headers['Host'].rsplit(':', 1)
         _headers['Host'], _headers['Port'] = host, int(port)
     return _headers
+
+
+class _RequestHead:
+    """Collects what `httptools` finds in a request head"""
+    def __init__(self):
+        self.url = b''
+        self.headers = []
+
+    def on_url(self, url):
+        self.url += url
+
+    def on_header(self, name, val):
+        self.headers.append((name, val))
+
+
+def _parse_request_httptools(head):
+    request_head = _RequestHead()
+    parser = httptools.HttpRequestParser(request_head)
+    try:
+        parser.feed_data(head)
+    except httptools.HttpParserUpgrade:
+        pass  # CONNECT and Upgrade requests, the head has been parsed
+    except httptools.HttpParserError as e:
+        raise BadStatusLine(head.split(b'\r\n', 1)[0]) from e
+
+    method = parser.get_method().decode('latin-1').upper()
+    path = request_head.url.decode('latin-1')
+    _headers = {'Version': f'HTTP/{parser.get_http_version()}', 'Method': method, 'Path': path}
+    if method == 'CONNECT':
+        host, port = path.rsplit(':', 1)
+        _headers['Host'], _headers['Port'] = host, int(port)
+
+    for name, val in request_head.headers:
+        _headers[name.decode('latin-1').strip().title()] = val.decode('latin-1').strip()
+
+    return _split_host(_headers)
@@ -0,0 +1,202 @@
+import os
+import signal
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+import stats
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerPool:
+    """Run the servers in several processes so more than one core is used
+
+    Each worker binds the same ports with SO_REUSEPORT, so the kernel spreads
+    new connections across them. Every `interval` seconds each worker sends a
+    `stats.snapshot` without the stats of each proxy to the main process over
+    a pipe, which the api combines into one view with `stats`. Those grow with
+    the number of proxies, so they are only sent when asked for, see
+    `detailed_stats`. New configs are sent the other way over the same pipe,
+    see `reload`.
+
+    :param int count: Number of worker processes
+    :param run_worker:
+        Called in each worker with the `asyncio` loop to use, should start the
+        servers and return them
+    :param int interval: (optional) Seconds between sending stats
+    :param reload_worker:
+        (optional) Coroutine function called in each worker with every config sent by `reload`
+    :param float detail_timeout:
+        (optional) Seconds to wait for the detailed stats of a worker before using its latest stats instead
+    """
+    def __init__(self, count, run_worker, interval=1, reload_worker=None, detail_timeout=5, loop=None):
+        self.count = count
+        self._run_worker = run_worker
+        self._reload_worker = reload_worker
+        self._interval = interval
+        self._detail_timeout = detail_timeout
+        self._loop = loop or asyncio.get_event_loop()
+        self._workers = {}  # pid -> Connection to read stats from and send configs to
+        self._stats = {}  # pid -> Latest snapshot
+        self._details = {}  # pid -> Future of the detailed snapshot asked for
+
+    def start(self):
+        for _ in range(self.count):
+            conn, worker_conn = multiprocessing.Pipe()
+            pid = os.fork()
+            if pid == 0:
+                conn.close()
+                for other in self._workers.values():
+                    other.close()
+                try:
+                    self._worker(worker_conn)
+                finally:
+                    os._exit(0)
+
+            worker_conn.close()
+            self._workers[pid] = conn
+            self._loop.add_reader(conn.fileno(), self._read_stats, pid)
+            logger.info(f'Started worker pid={pid}')
+
+    def reload(self, config):
+        """Send a new config to every worker"""
+        for pid, conn in self._workers.items():
+            try:
+                conn.send(('config', config))
+            except (BrokenPipeError, OSError) as e:
+                logger.error(f'Could not send the config to worker pid={pid}; Error: {e!r}')
+
+    def stop(self):
+        for pid, reader in self._workers.items():
+            self._loop.remove_reader(reader.fileno())
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+            reader.close()
+        self._workers = {}
+        logger.info('Workers are stopped')
+
+    def stats(self):
+        """The combined stats of all of the workers, without the stats of each proxy"""
+        return stats.merge(list(self._stats.values()))
+
+    async def detailed_stats(self):
+        """The combined stats of all of the workers, asking each of them for the stats of every proxy
+
+        A worker that does not answer within `detail_timeout` is counted with its latest stats.
+        """
+        waiting = {}
+        for pid, conn in self._workers.items():
+            future = self._details.get(pid)
+            if future is None:
+                try:
+                    conn.send(('detail', None))
+                except (BrokenPipeError, OSError):
+                    continue
+                future = self._details[pid] = self._loop.create_future()
+            waiting[pid] = future
+        if waiting:
+            await asyncio.wait(list(waiting.values()), timeout=self._detail_timeout)
+
+        snapshots = []
+        for pid in self._workers:
+            future = waiting.get(pid)
+            snap = future.result() if future is not None and future.done() else None
+            if snap is None:
+                snap = self._stats.get(pid)
+            if snap is not None:
+                snapshots.append(snap)
+        return stats.merge(snapshots)
+
+    def _read_stats(self, pid):
+        try:
+            kind, snap = self._workers[pid].recv()
+        except (EOFError, OSError):
+            logger.error(f'Worker pid={pid} has exited')
+            self._loop.remove_reader(self._workers[pid].fileno())
+            kind, snap = 'detail', None  # Nothing more is coming, stop waiting for it
+        if kind == 'detail':
+            future = self._details.pop(pid, None)
+            if future is not None and not future.done():
+                future.set_result(snap)
+        else:
+            self._stats[pid] = snap
+
+    def _worker(self, conn):
+        # The parent's loop can not be shared, each worker gets its own
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.add_signal_handler(signal.SIGTERM, loop.stop)
+        # The main process reloads the config on SIGHUP and sends it on
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+        servers = self._run_worker(loop)
+
+        # Sent from a thread so a main process that is slow to read can not block the loop,
+        # one at a time so the messages are not mixed up in the pipe
+        sender = ThreadPoolExecutor(max_workers=1)
+        sending = None
+
+        def _sent(future):
+            if not future.cancelled() and isinstance(future.exception(), (BrokenPipeError, OSError)):
+                loop.stop()
+
+        def _send(message):
+            future = loop.run_in_executor(sender, conn.send, message)
+            future.add_done_callback(_sent)
+            return future
+
+        def _send_stats():
+            nonlocal sending
+            # Skip a turn rather than queue up stats while the last ones are still being sent
+            if sending is None or sending.done():
+                sending = _send(('stats', stats.snapshot(detail=False)))
+            loop.call_later(self._interval, _send_stats)
+        loop.call_soon(_send_stats)
+
+        def _read_config():
+            try:
+                kind, message = conn.recv()
+            except (EOFError, OSError):
+                loop.remove_reader(conn.fileno())
+                return
+            if kind == 'detail':
+                _send(('detail', stats.snapshot()))
+            elif self._reload_worker is not None:
+                asyncio.ensure_future(self._reload_worker(message))
+        loop.add_reader(conn.fileno(), _read_config)
+
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+
+        for server in servers:
+            server.stop()
+        # A send can be stuck on a full pipe once the main process stops reading
+        sender.shutdown(wait=False)
+        conn.close()
+        # os._exit skips the normal shutdown, flush the queued request logs first
+        logging.shutdown()
+
+
+# Set by `run.py` when running with more than one worker
+worker_pool = None
+
+
+async def global_stats(detail=True):
+    """Stats for every request handled, no matter which process handled it
+
+    Keyword Arguments:
+        detail {bool} -- Include the stats of each proxy, which have to be asked for from each worker (default: {True})
+
+    Returns:
+        dict -- The result of `stats.merge`
+    """
+    if worker_pool is not None:
+        return await worker_pool.detailed_stats() if detail else worker_pool.stats()
+    return stats.merge([stats.snapshot(detail)])